@@ -16,6 +16,7 @@ import fastlmm.util.stats as ss
 import time
 from .Result import *
 from .PairResult import *
+from .SnpSetCache import SnpSetCache
 from fastlmm.association.tests import *
 import fastlmm.util.genphen as gp
 import scipy as sp
@@ -75,6 +76,8 @@ class FastLmmSet: # implements IDistributable
         datestamp       : Defaults to None. Use "auto" to have it generate a unique date and time string
                           to append to filenames. Otherwise, it appends whatever you set it to.
         log             : (Defaults to not changing logging level) Level of log messages, e.g. logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO
+        batchsnps=20000 : The SNPs of the sets are read and standardized in batches of sets needing at most this many distinct SNPs,
+                          so SNPs shared by overlapping sets are read only once per batch.
         '''
 
         # member variables with default values, or those not defined in the input file    
@@ -115,6 +118,7 @@ class FastLmmSet: # implements IDistributable
 
         self.alt_snpreader = None
         self.show_pvalue_5050 = False
+        self.batchsnps = 20000 #the most distinct SNPs to read and standardize at once for a batch of (perhaps overlapping) sets
 
         
         if hasattr(self,"ipheno"):
@@ -201,11 +205,13 @@ class FastLmmSet: # implements IDistributable
             haswrittenphen=False;                            
                 
             if self.altset_list2 is None: #singleton sets            
-                for iset, altset in enumerate(self.altsetlist_filtbysnps):
+                #read & standardize the SNPs of overlapping sets once per batch, and (for score tests with a cached null) project them once, too
+                rotate = self.rotate_closure() if self.genphen is None and self.permute is None else None
+                for iset, altset, SNPsalt, rotated_unscaled in SnpSetCache(self.altsetlist_filtbysnps, max_snp_count=self.batchsnps, rotate=rotate):
+                    scale = 1.0/sp.sqrt(SNPsalt['snps'].shape[1]) if SNPsalt['snps'].shape[1] > 0 else 1.0
+                    G1 = SNPsalt['snps']*scale
+                    rotated = None if rotated_unscaled is None else tuple(None if r is None else r*scale for r in rotated_unscaled)
                     for iperm in range(-1, self.nperm):   #note that self.nperm is the 'stop', not the 'count'
-                        SNPsalt=altset.read()
-                        SNPsalt['snps'] = util.standardize(SNPsalt['snps'])
-                        G1 = SNPsalt['snps']/sp.sqrt(SNPsalt['snps'].shape[1])  
                         ichrm =  ",".join(sp.array(sp.unique(SNPsalt['pos'][:,0]),dtype=str)) 
                         minpos= str(sp.min(SNPsalt['pos'][:,2]))
                         maxpos= str(sp.max(SNPsalt['pos'][:,2]))
@@ -256,7 +262,7 @@ class FastLmmSet: # implements IDistributable
                                 y=gp.genphen(y_G0=y_G0+y_back,G1=G1,covDat=self.__X,options=self.genphen,nInd=nInd,randseed=newseed) 
                                                                 
                         assert y is not None, "y is None"                                   
-                        yield lambda altset=altset,iset=iset,iperm=iperm,y=y,ichrm=ichrm, iposrange=iposrange : self.run_test(SNPs1=SNPsalt,G1=G1, y=y, altset=altset, iset=iset, iperm=iperm, ichrm=ichrm, iposrange=iposrange)
+                        yield lambda altset=altset,iset=iset,iperm=iperm,y=y,ichrm=ichrm, iposrange=iposrange, SNPsalt=SNPsalt, G1=G1, rotated=rotated : self.run_test(SNPs1=SNPsalt,G1=G1, y=y, altset=altset, iset=iset, iperm=iperm, ichrm=ichrm, iposrange=iposrange, rotated=rotated)
             else: #pairs of sets
                 raise Exception("not implemented, started a long time ago and never finished")
                 #for iperm in xrange(-1, self.nperm):   #note that self.nperm is the 'stop', not the 'count'
@@ -600,6 +606,22 @@ class FastLmmSet: # implements IDistributable
         
         logging.info("    used " + str(pm+1) + " permutations to compute p=" + str(pv) + ", p50=" + str(result.test['pv']))
         
+    def rotate_closure(self):
+        '''
+        If the cached null model can project test SNPs (score tests with a background kernel), returns a function that
+        projects a batch of SNPs, unless some of them are close enough to the null SNPs to need their own null model.
+        '''
+        if self.__varcomp_test is None or not hasattr(self.__varcomp_test, "rotate"):
+            return None
+
+        def rotate(SNPsunion):
+            if self.filenull is not None:
+                pos0 = self.__SNPs0['data']['pos'] if 'data' in self.__SNPs0 else self.__SNPs0['snp_set'].pos
+                if utilx.excludeinds(pos0, SNPsunion['pos'], mindist = self.mindist,idist = self.idist).sum() > 0:
+                    return None
+            return self.__varcomp_test.rotate(SNPsunion['snps'])
+        return rotate
+
     def G_exclude(self, i_exclude):
         if "data" in self.__SNPs0:
             G_exclude = self.__SNPs0["data"]["snps"][:,i_exclude]
@@ -613,7 +635,7 @@ class FastLmmSet: # implements IDistributable
         G_exclude/=sp.sqrt(self.__SNPs0["num_snps"])
         return G_exclude
 
-    def run_test(self, SNPs1, G1, y, altset, iset, ichrm, iposrange, iperm = -1, varcomp_test=None):
+    def run_test(self, SNPs1, G1, y, altset, iset, ichrm, iposrange, iperm = -1, varcomp_test=None, rotated=None):
         '''
         This function does the main work of the class, and also reads in the SNPs for the alternative model.
         It is called (via a lambda) inside the loops found in 'generate_sequence'.
@@ -623,6 +645,7 @@ class FastLmmSet: # implements IDistributable
             iset - index to altset
             iperm - index to permutation (-1 means no permutation)
             varcomp -if not None, assume that it is the correct one for this test, and does not re-compute anything
+            rotated - if not None, G1 already projected by the cached null's 'rotate' method (used only with that cached null and unpermuted G1)
         Output:
             a list (often just one) of
                 instances of the Result class, varcomp (for caching)
@@ -675,6 +698,7 @@ class FastLmmSet: # implements IDistributable
             #need to make this caching smarter for when background kernel changes in every test (e.g. interactions)
             if (self.permute is not None) or (iperm >=0):
                 G1=G1[permutationIndex]
+                rotated = None
 
             #if result.nexclude:
             #    logging.info(" (computing needed null info anew) ")
@@ -686,6 +710,7 @@ class FastLmmSet: # implements IDistributable
                 #need to re-construct the test (can't cache)
                 #note that if result.nexclude kicked in, then this would happen in clause above anyhow                               
                 varcomp_test = self.varcomp_test_setup(y,self.__SNPs0,i_exclude)
+                rotated = None
             else: #use cached values                
                 #G0_to_use=self.__G0
                 varcomp_test=self.__varcomp_test
@@ -699,7 +724,10 @@ class FastLmmSet: # implements IDistributable
             else:
                 G_exclude = None            
          
-            result.test = varcomp_test.testG(G1,self.test, i_exclude=i_exclude,G_exclude=G_exclude)             
+            if rotated is None:
+                result.test = varcomp_test.testG(G1,self.test, i_exclude=i_exclude,G_exclude=G_exclude)             
+            else:
+                result.test = varcomp_test.testG(G1,self.test, i_exclude=i_exclude,G_exclude=G_exclude,rotated=rotated)
             logging.info("p=%.2e",result.test['pv'])                   
 
             # do the permutations here, rather than as they would normally be done with a seperate call to             
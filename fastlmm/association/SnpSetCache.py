@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+import logging
+import time
+import numpy as np
+import fastlmm.util.preprocess as util
+from fastlmm.pyplink.snpset.SnpIndexList import SnpIndexList
+
+
+class SnpSetCache(object):
+    '''
+    Materializes the SNPs of a list of SNP sets (for example, overlapping gene windows) in batches. For each batch it reads the
+    union of the SNPs the sets need once (in sorted order), standardizes them once and then hands each set a view of its
+    columns. Optionally, it also applies a column-wise (linear) 'rotate' function, such as the projection of the SNPs onto
+    the null model's eigenvectors, to the whole batch and hands each set the matching columns of the result. 'rotate' is
+    given the batch's standardized dictionary and may return None to skip the batch.
+
+    Iterating yields, in the order of the list, (iset, altset, SNPsalt, rotated) where SNPsalt is the standardized
+    dictionary that altset.read() would give (with keys 'snps', 'rs', 'pos' and 'iid') and rotated is None or a tuple
+    of arrays with one column per SNP of the set.
+
+    max_snp_count : the most distinct SNPs to read at once. A set larger than this is read as its own batch.
+    '''
+    def __init__(self, altsetlist_plusbed, max_snp_count=20000, rotate=None):
+        self.altsetlist_plusbed = altsetlist_plusbed
+        self.max_snp_count = max_snp_count
+        self.rotate = rotate
+
+    def __len__(self):
+        return len(self.altsetlist_plusbed)
+
+    def __iter__(self):
+        batch, union = [], set()
+        for iset, altset in enumerate(self.altsetlist_plusbed):
+            snp_index_list = list(altset)
+            if batch and len(union.union(snp_index_list)) > self.max_snp_count:
+                for item in self._materialize(batch, union):
+                    yield item
+                batch, union = [], set()
+            batch.append((iset, altset, snp_index_list))
+            union.update(snp_index_list)
+        if batch:
+            for item in self._materialize(batch, union):
+                yield item
+
+    def _materialize(self, batch, union):
+        t0 = time.time()
+        bed = batch[0][1].bed
+        assert all(altset.bed is bed for _, altset, _ in batch), "Expect all the sets to use the same SNP reader"
+        union = np.array(sorted(union), dtype=np.int64)
+        SNPsunion = SnpIndexList(list(union)).addbed(bed).read()
+        SNPsunion['snps'] = util.standardize(SNPsunion['snps'])
+        rotated_union = None if self.rotate is None else self.rotate(SNPsunion)
+        logging.info("read and standardized {0} SNPs for {1} sets in {2:.2f} seconds".format(len(union), len(batch), time.time() - t0))
+
+        for iset, altset, snp_index_list in batch:
+            columns = np.searchsorted(union, snp_index_list)
+            if len(columns) > 0 and np.all(np.diff(columns) == 1): #a run of consecutive SNPs, so a view will do
+                columns = slice(columns[0], columns[-1] + 1)
+            SNPsalt = {
+                'snps': SNPsunion['snps'][:, columns],
+                'rs': SNPsunion['rs'][columns],
+                'pos': SNPsunion['pos'][columns],
+                'iid': SNPsunion['iid'],
+            }
+            rotated = None if rotated_union is None else tuple(None if r is None else r[:, columns] for r in rotated_union)
+            yield iset, altset, SNPsalt, rotated
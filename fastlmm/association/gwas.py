@@ -96,19 +96,38 @@ class GWAS(object):
         if temp_dir is not None:
             if (not os.path.exists(temp_dir)) or (not os.path.isdir(temp_dir)):
                 os.makedirs(temp_dir)
-        self._generate_intervals(blocksize=blocksize, total_snps=self.snps_test.sid.shape[0])
+        total_snps = self.snps_test.sid.shape[0]
+        self._generate_intervals(blocksize=blocksize, total_snps=total_snps)
+        if temp_dir is None:
+            #fill one preallocated column buffer per phenotype instead of concatenating data frames block by block
+            buffers = {p: self._allocate_results(total_snps) for p in self.phenotype.columns}
         for stop in range(1,len(self.intervals)):
-            res = self.snps_test_block(block_start=self.intervals[stop-1],block_end=self.intervals[stop])
+            block_start, block_end = self.intervals[stop-1], self.intervals[stop]
+            res = self.snps_test_block(block_start=block_start,block_end=block_end)
             if temp_dir is not None:
                 self.save_results_block(dir_name=temp_dir, res=res, intervals=self.intervals, idx_interval=stop)
             else:
                 for p in res.keys():
-                    if p in result:
-                        result[p] = pd.concat([result[p],res[p]])
-                    else:
-                        result[p] = res[p]
+                    for name, column in buffers[p].items():
+                        column[block_start:block_end] = res[p][name].values
+        if temp_dir is None:
+            for p in self.phenotype.columns:
+                result[p] = pd.DataFrame(buffers[p])
         return result
 
+    def _allocate_results(self, snp_count):
+        return {
+            'SNP': np.empty(snp_count, dtype=self.snps_test.sid.dtype),
+            'Chr': np.empty(snp_count),
+            'GenDist': np.empty(snp_count),
+            'ChrPos': np.empty(snp_count),
+            'PValue': np.empty(snp_count),
+            'SnpWeight': np.empty(snp_count),
+            'SnpWeightSE': np.empty(snp_count),
+            'SnpFractVarExpl': np.empty(snp_count),
+            'Nullh2': np.empty(snp_count),
+            }
+
     def save_results_block(self, dir_name, res, intervals=None, idx_interval=None):
         for p in res.keys():
             mydir = dir_name + "/" + str(p) +"/"
@@ -127,12 +146,16 @@ class GWAS(object):
 
     def snps_test_block(self, block_start, block_end):
         snps = self.snps_test[:,block_start:block_end].read().standardize(self.standardizer)
+        #rotate the block once and score it against all phenotypes (set in _find_h2) in a single pass
+        Usnps,UUsnps = self.lmm.rotate(A=snps.val)
+        h2 = np.array([self.h2[p] for p in self.phenotype.columns],dtype=float)
+        res = self.lmm.nLLeval(h2=h2, dof=None, scale=1.0, penalty=0.0, Usnps=Usnps, UUsnps=UUsnps)
+        beta = res['beta']
+        chi2stats = beta*beta/res['variance_beta']
+        p_values = st.f.sf(chi2stats,1,self.lmm.U.shape[0]-(self.covariates.shape[0]+1))#note that G.shape is the number of individuals
         result = {}
         for i, p in enumerate(self.phenotype.columns):
-            h2 = self.h2[p]
-            self.lmm.setY(self.phenotype[p][:,np.newaxis])
-            res = self.lmm.nLLeval(h2=h2, dof=None, scale=1.0, penalty=0.0, snps=snps.val)
-            result[p] = self._format_gwas_results(res=res, snps=snps, h2=h2)
+            result[p] = self._format_gwas_results(res=res, snps=snps, h2=h2[i], p_values=p_values, idx_pheno=i)
         return result
 
     @property
@@ -146,8 +169,9 @@ class GWAS(object):
                 self.h2[p] = 0.0
         else:
             for i, p in enumerate(self.phenotype.columns):
-                self.lmm.setY(self.phenotype[p][:,np.newaxis])
-                self.h2[p] = self.lmm.findH2(nGridH2=self.nGridH2)['h2']
+                self.lmm.setY(self.phenotype[p].values[:,np.newaxis])
+                self.h2[p] = float(np.asarray(self.lmm.findH2(nGridH2=self.nGridH2)['h2']).reshape(-1)[0])
+        self.lmm.setY(self.phenotype.values)
 
     def _generate_intervals(self, blocksize, total_snps):
         if blocksize is None:
@@ -158,26 +182,28 @@ class GWAS(object):
             intervals.append(total_snps)
         self.intervals = intervals
 
-    def _format_gwas_results(self, res, snps, h2):
-        beta = res['beta']
-            
-        chi2stats = beta*beta/res['variance_beta']
+    def _format_gwas_results(self, res, snps, h2, p_values=None, idx_pheno=0):
+        beta = res['beta'][:,idx_pheno]
+        variance_beta = res['variance_beta'][:,idx_pheno]
 
-        #p_values = st.chi2.sf(chi2stats,1)[:,0]
-        p_values = st.f.sf(chi2stats,1,self.lmm.U.shape[0]-(self.covariates.shape[0]+1))[:,0]#note that G.shape is the number of individuals
-
-        items = [
-            ('SNP', snps.sid),
-            ('Chr', snps.pos[:,0]), 
-            ('GenDist', snps.pos[:,1]),
-            ('ChrPos', snps.pos[:,2]), 
-            ('PValue', p_values),
-            ('SnpWeight', beta[:,0]),
-            ('SnpWeightSE', np.sqrt(res['variance_beta'][:,0])),
-            ('SnpFractVarExpl', np.sqrt(res['fraction_variance_explained_beta'][:,0])),
-            ('Nullh2', np.zeros((snps.sid_count)) + h2)
-        ]
-        return pd.DataFrame.from_items(items)
+        if p_values is None:
+            chi2stats = beta*beta/variance_beta
+            #p_values = st.chi2.sf(chi2stats,1)
+            p_values = st.f.sf(chi2stats,1,self.lmm.U.shape[0]-(self.covariates.shape[0]+1))#note that G.shape is the number of individuals
+        else:
+            p_values = p_values[:,idx_pheno]
+
+        return pd.DataFrame({
+            'SNP': snps.sid,
+            'Chr': snps.pos[:,0],
+            'GenDist': snps.pos[:,1],
+            'ChrPos': snps.pos[:,2],
+            'PValue': p_values,
+            'SnpWeight': beta,
+            'SnpWeightSE': np.sqrt(variance_beta),
+            'SnpFractVarExpl': np.sqrt(res['fraction_variance_explained_beta'][:,idx_pheno]),
+            'Nullh2': np.zeros((snps.sid_count)) + h2
+            })
 
     @staticmethod
     def check_pheno_format(phenotype):
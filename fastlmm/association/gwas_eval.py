@@ -20,11 +20,14 @@ from scipy import stats
 
 from fastlmm.util.pickle_io import load
 from fastlmm.util.util import excludeinds
+from fastlmm.util.stats.pvalue_summary import PValueSummary
 
 
 
 def estimate_lambda(pv):
-    """estimate lambda form a set of PV"""
+    """estimate lambda form a set of PV, or from a fastlmm.util.stats.pvalue_summary.PValueSummary"""
+    if isinstance(pv, PValueSummary):
+        return pv.estimate_lambda()
     LOD2 = sp.median(stats.chi2.isf(pv,1))
     L = (LOD2/0.456)
     return (L)
@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import os
+import pickle
 import numpy as np
 import scipy.stats as st
 import fastlmm.util.mingrid as mingrid
@@ -7,18 +9,32 @@ from six.moves import range
 
 
 class MetaAnalysis(object):
+    """
+    Inverse-variance weighted meta-analysis of per-study effect estimates.
+
+    beta and ste are either [K] arrays (one SNP in K studies) or [S x K] arrays (S SNPs in K studies),
+    in which case every method works on all SNPs at once and returns [S] arrays. NaN entries mark
+    studies that do not report a SNP and are left out. tau is a scalar or an [S] array.
+    """
     
     def __init__(self, beta, ste, tau=0):
-        self.beta = beta
-        self.ste = ste
+        self.beta = np.asarray(beta, dtype=float)
+        self.ste = np.asarray(ste, dtype=float)
         self.tau = tau
+        self.observed = ~(np.isnan(self.beta) | np.isnan(self.ste))
     
-    def var_beta(self):
-        var = self.ste * self.ste + self.tau
+    def var_beta(self, tau=None):
+        if tau is None:
+            tau = self.tau
+        var = self.ste * self.ste + np.expand_dims(tau, -1)
         return var
 
-    def inverse_variance_weights(self):
-        return 1.0 / self.var_beta()
+    def inverse_variance_weights(self, tau=None):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.observed, 1.0 / self.var_beta(tau), 0.0)
+
+    def study_count(self):
+        return self.observed.sum(-1)
 
     def z_score(self):
         z_score = self.mean_beta() / self.ste_mean()
@@ -31,28 +47,63 @@ class MetaAnalysis(object):
 
     def mean_beta(self):
         weights = self.inverse_variance_weights()
-        mean_beta = self.beta.dot(weights) / (weights).sum()
+        mean_beta = (np.where(self.observed, self.beta, 0.0) * weights).sum(-1) / weights.sum(-1)
         return mean_beta
         
     def ste_mean(self):
-        return 1.0 / np.sqrt(self.inverse_variance_weights().sum())
+        return 1.0 / np.sqrt(self.inverse_variance_weights().sum(-1))
+
+    def cochran_q(self):
+        """
+        Cochran's Q, the weighted sum of squared deviations from the fixed-effect mean
+        """
+        weights = self.inverse_variance_weights(tau=0.0)
+        beta = np.where(self.observed, self.beta, 0.0)
+        mean_beta = (beta * weights).sum(-1) / weights.sum(-1)
+        residuals = beta - np.expand_dims(mean_beta, -1)
+        return (weights * residuals * residuals).sum(-1)
+
+    def heterogeneity_pvalue(self):
+        return st.chi2.sf(self.cochran_q(), self.study_count() - 1)
+
+    def i_squared(self):
+        """
+        I^2 = max(0, (Q - df) / Q), the fraction of variation across studies due to heterogeneity (Higgins and Thompson 2002)
+        """
+        q = self.cochran_q()
+        df = self.study_count() - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(q > 0, np.maximum(0.0, (q - df) / q), 0.0)
 
     def log_likelihood(self, tau=None, mean_beta=None, reml=False):
-        
+        """
+        log likelihood of the studies' estimates for between-study variance tau. tau may carry extra leading
+        dimensions (e.g. a grid [M x S]), which are kept in the result.
+        """
         if tau is None:
-            var = self.var_beta()
-        else:
-            var = self.ste * self.ste + tau
-
-        determinant = np.log(var).sum()
+            tau = self.tau
+        all_observed = self.observed.all()
+        if all_observed:
+            beta, ste = self.beta, self.ste
+        else: #missing studies get a unit variance and zero weight
+            beta, ste = np.where(self.observed, self.beta, 0.0), np.where(self.observed, self.ste, 1.0)
+        var = ste * ste + np.expand_dims(tau, -1)
+        weights = 1.0 / var
+        log_var = np.log(var)
+        if not all_observed:
+            weights *= self.observed
+            log_var *= self.observed
+
+        determinant = log_var.sum(-1)
         if mean_beta is None:
             # ML (equiv. REML) estimate of beta:
-            mean_beta = (self.beta / var).sum() / (1.0 / var).sum()
+            weight_sum = weights.sum(-1)
+            mean_beta = (beta * weights).sum(-1) / weight_sum
             if reml:
                 # perform REML
-                determinant += np.log((1.0 / var).sum()) - np.log(self.beta.shape)
-        residuals = (self.beta - mean_beta)
-        rss = (residuals * residuals / var).sum()
+                determinant += np.log(weight_sum) - np.log(self.study_count())
+        residuals = beta - np.expand_dims(mean_beta, -1)
+        rss = (residuals * residuals * weights).sum(-1)
         
         log_likelihood = - 0.5 * (determinant + rss)
         return log_likelihood
@@ -66,7 +117,8 @@ class FixefEffects(MetaAnalysis):
 
 class RandomEffects(MetaAnalysis):
     """
-    We use REML to 
+    We use REML (or ML) to estimate the between-study variance tau, searching [0, mean(beta^2)] for each SNP.
+    For [S x K] inputs all S searches run together with mingrid.minimize1D_batch.
 
 
     Quantifying heterogeneity in a meta-analysis
@@ -79,20 +131,179 @@ class RandomEffects(MetaAnalysis):
         MetaAnalysis.__init__(self, beta=beta, ste=ste, tau=tau)
 
     def tau_ml(self, beta, ste):
-        meta = MetaAnalysis(beta=beta, ste=ste, tau=0)
-        def f(x):
-            return -meta.log_likelihood(tau=x, mean_beta=0)
-
-        tau = mingrid.minimize1D(f, evalgrid=None, nGrid=10, minval=0.0, maxval=(beta*beta).mean(), verbose=False, brent=True,check_boundaries=True, resultgrid=None, return_grid=False)
-        return tau[0]
+        return self._search_tau(MetaAnalysis(beta=beta, ste=ste, tau=0), mean_beta=0, reml=False)
 
     def estimate_tau(self, beta, ste):
-        meta = MetaAnalysis(beta=beta, ste=ste, tau=0)
+        return self._search_tau(MetaAnalysis(beta=beta, ste=ste, tau=0), mean_beta=None, reml=self.reml)
+
+    @staticmethod
+    def _search_tau(meta, mean_beta, reml):
+        one_snp = meta.beta.ndim == 1
+        if one_snp:
+            meta = MetaAnalysis(beta=meta.beta[np.newaxis,:], ste=meta.ste[np.newaxis,:], tau=0)
+        beta = np.where(meta.observed, meta.beta, 0.0)
+        maxval = (beta * beta).sum(-1) / np.maximum(meta.study_count(), 1)
+
+        # search x in [0,1] for all SNPs on a shared grid, where tau = x * maxval
         def f(x):
-            return -meta.log_likelihood(tau=x, mean_beta=None, reml=self.reml)
+            return -meta.log_likelihood(tau=x * maxval, mean_beta=mean_beta, reml=reml)
+
+        x = mingrid.minimize1D_batch(f, evalgrid=None, nGrid=10, minval=0.0, maxval=1.0, brent=True, check_boundaries=True, resultgrid=None, return_grid=False)[0]
+        tau = x * maxval
+        return tau[0] if one_snp else tau
+
+
+def meta_analysis(beta, ste, sid=None, reml=True, chunk_size=100000):
+    """
+    Fixed-effect and random-effects meta-analysis of many SNPs, computed chunk_size SNPs at a time.
 
-        tau = mingrid.minimize1D(f, evalgrid=None, nGrid=10, minval=0.0, maxval=(beta*beta).mean(), verbose=False, brent=True,check_boundaries=True, resultgrid=None, return_grid=False)
-        return tau[0]
+    :param beta: [S x K] effect estimates of S SNPs in K studies, NaN where a study lacks a SNP
+    :param ste: [S x K] standard errors of the estimates
+    :param sid: optional [S] SNP ids, returned in the column 'SNP'
+    :param reml: use REML (default) or ML to estimate the between-study variance
+    :param chunk_size: number of SNPs analysed at a time
+
+    :rtype: pandas DataFrame with one row per SNP and columns 'StudyCount', 'FixedWeight', 'FixedWeightSE',
+        'FixedPValue', 'Tau', 'RandomWeight', 'RandomWeightSE', 'RandomPValue', 'Q', 'QPValue', 'I2'
+    """
+    import pandas as pd
+    beta = np.asarray(beta, dtype=float)
+    ste = np.asarray(ste, dtype=float)
+    assert beta.shape == ste.shape and beta.ndim == 2, "Expect beta and ste to be [SNPs x studies] arrays of the same shape"
+    snp_count = beta.shape[0]
+
+    columns = ['StudyCount', 'FixedWeight', 'FixedWeightSE', 'FixedPValue', 'Tau', 'RandomWeight', 'RandomWeightSE', 'RandomPValue', 'Q', 'QPValue', 'I2']
+    result = dict((name, np.empty(snp_count)) for name in columns)
+    for start in range(0, snp_count, chunk_size):
+        end = min(start + chunk_size, snp_count)
+        fe = FixefEffects(beta=beta[start:end], ste=ste[start:end])
+        re = RandomEffects(beta=beta[start:end], ste=ste[start:end], reml=reml)
+        result['StudyCount'][start:end] = fe.study_count()
+        result['FixedWeight'][start:end] = fe.mean_beta()
+        result['FixedWeightSE'][start:end] = fe.ste_mean()
+        result['FixedPValue'][start:end] = fe.meta_pvalue()
+        result['Tau'][start:end] = re.tau
+        result['RandomWeight'][start:end] = re.mean_beta()
+        result['RandomWeightSE'][start:end] = re.ste_mean()
+        result['RandomPValue'][start:end] = re.meta_pvalue()
+        result['Q'][start:end] = fe.cochran_q()
+        result['QPValue'][start:end] = fe.heterogeneity_pvalue()
+        result['I2'][start:end] = fe.i_squared()
+
+    frame = pd.DataFrame(result, columns=columns)
+    frame['StudyCount'] = frame['StudyCount'].astype(int)
+    if sid is not None:
+        frame.insert(0, 'SNP', sid)
+    return frame
+
+
+def meta_analysis_files(file_name_list, output_file_name=None, reml=True, chunk_size=100000, read_chunk_size=1000000,
+                        snp_column='SNP', beta_column='SnpWeight', ste_column='SnpWeightSE', sep="\t"):
+    """
+    Meta-analyse the result files of several studies (for example, single_snp outputs) with bounded memory.
+
+    The files need not be sorted. In a first pass, each file is read in pieces of read_chunk_size rows, keeping only the
+    SNP, position, weight and standard error columns, and each piece is split by a hash of the SNP id into bucket
+    files (in a temporary directory), with about read_chunk_size rows of each study per bucket. Then, one bucket at a
+    time, the studies are aligned on the SNP id and meta-analysed. So only one bucket of every study, plus the
+    results, is in memory at once. SNPs missing from a study are left out of its meta-analysis.
+
+    :param file_name_list: the result files, one per study
+    :param output_file_name: optional name of a tab-delimited file to write the results to
+    :param reml: use REML (default) or ML to estimate the between-study variance
+    :param chunk_size: number of SNPs meta-analysed at a time
+    :param read_chunk_size: number of rows read from a result file at a time (and the rows per study in a bucket)
+    :param snp_column: name of the column holding the SNP ids
+    :param beta_column: name of the column holding the effect estimates
+    :param ste_column: name of the column holding the standard errors
+
+    :rtype: pandas DataFrame with the columns of :func:`meta_analysis` plus 'SNP', 'Chr' and 'ChrPos', sorted by 'RandomPValue'
+    """
+    import pandas as pd
+    import shutil
+    import tempfile
+
+    row_count = max(_line_count(file_name) - 1 for file_name in file_name_list)
+    bucket_count = max(1, -(-row_count // read_chunk_size))
+    temp_dir = tempfile.mkdtemp(prefix="meta_analysis")
+    try:
+        has_positions = False
+        for study_index, file_name in enumerate(file_name_list):
+            header = pd.read_csv(file_name, sep=sep, nrows=0).columns
+            position_columns = [name for name in ['Chr', 'ChrPos'] if name in header]
+            has_positions |= len(position_columns) == 2
+            for piece in pd.read_csv(file_name, sep=sep, usecols=[snp_column, beta_column, ste_column] + position_columns,
+                                     dtype={snp_column: str}, chunksize=read_chunk_size):
+                bucket = pd.util.hash_pandas_object(piece[snp_column], index=False).values % bucket_count
+                for bucket_index, bucket_piece in piece.groupby(bucket):
+                    with open(_bucket_file_name(temp_dir, study_index, bucket_index), "ab") as f:
+                        pickle.dump(bucket_piece, f, pickle.HIGHEST_PROTOCOL)
+
+        frame_list = []
+        for bucket_index in range(bucket_count):
+            study_list = []
+            for study_index, file_name in enumerate(file_name_list):
+                study = pd.concat(_read_pickles(_bucket_file_name(temp_dir, study_index, bucket_index)) or
+                                  [pd.DataFrame({snp_column: pd.Series(dtype=str), beta_column: pd.Series(dtype=float), ste_column: pd.Series(dtype=float)})],
+                                  ignore_index=True).set_index(snp_column)
+                if not study.index.is_unique: #a repeated SNP always lands in one bucket
+                    raise Exception("Expect each SNP to appear only once in '{0}'".format(file_name))
+                study_list.append(study)
+            frame_list.append(_meta_analysis_aligned(study_list, beta_column, ste_column, reml, chunk_size))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    frame = pd.concat(frame_list, ignore_index=True)
+    if not has_positions:
+        del frame['Chr'], frame['ChrPos']
+    frame.sort_values(by='RandomPValue', inplace=True)
+    frame.index = np.arange(len(frame))
+
+    if output_file_name is not None:
+        frame.to_csv(output_file_name, sep="\t", index=False)
+    return frame
+
+
+def _meta_analysis_aligned(study_list, beta_column, ste_column, reml, chunk_size):
+    sid = study_list[0].index
+    for study in study_list[1:]:
+        sid = sid.union(study.index, sort=False)
+    beta = np.column_stack([study[beta_column].reindex(sid).values for study in study_list])
+    ste = np.column_stack([study[ste_column].reindex(sid).values for study in study_list])
+
+    frame = meta_analysis(beta, ste, sid=sid.values, reml=reml, chunk_size=chunk_size)
+    positions = None
+    for study in study_list:
+        if 'Chr' in study.columns and 'ChrPos' in study.columns:
+            more_positions = study[['Chr', 'ChrPos']].reindex(sid)
+            positions = more_positions if positions is None else positions.fillna(more_positions)
+    frame.insert(1, 'Chr', np.nan if positions is None else positions['Chr'].values)
+    frame.insert(2, 'ChrPos', np.nan if positions is None else positions['ChrPos'].values)
+    return frame
+
+
+def _bucket_file_name(temp_dir, study_index, bucket_index):
+    return os.path.join(temp_dir, "study{0}.bucket{1}.pickle".format(study_index, bucket_index))
+
+
+def _read_pickles(file_name):
+    result = []
+    if os.path.exists(file_name):
+        with open(file_name, "rb") as f:
+            while True:
+                try:
+                    result.append(pickle.load(f))
+                except EOFError:
+                    return result
+    return result
+
+
+def _line_count(file_name, block_size=2**24):
+    count = 0
+    with open(file_name, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            count += block.count(b"\n")
+    return count
 
 
 class HierarchicalRandomEffects(object):
@@ -43,15 +43,19 @@ class scoretest(association.varcomp_test):
     #    evalstring = 'self.pv_%s(self.squaredform,self.expectationsqform,self.varsqform,self.GPG)' % (type)
     #    return  eval(evalstring)
 
-    def testG(self,G1,type, altModel=None,i_exclude=None,G_exclude=None):
+    def testG(self,G1,type, altModel=None,i_exclude=None,G_exclude=None,rotated=None):
         """
         Params:
             G1:         SNPs to be tested
             type:       moment matching davies etc
             i_exclude:  Dummy
             G_exclude:  Dummy
+            rotated:    (optional) the output of self.rotate(G1), for example, cached for a batch of sets
         """    # this used to default to ="davies"        
-        self._score(G1=G1)
+        if rotated is None:
+            self._score(G1=G1)
+        else:
+            self._score(G1=G1,rotated=rotated)
         pv = type.pv(self.squaredform,self.expectationsqform,self.varsqform,self.GPG)
         #stat = scoretest.scoreteststat(self.squaredform,self.varsqform)
         test={
@@ -255,7 +259,18 @@ class scoretest2K(scoretest):
                   }
         return result
 
-    def _score(self, G1):
+    def rotate(self, G1):
+        '''
+        returns (resG, UG, UUG): G1 regressed on the covariates and then projected onto the eigenvectors of the
+        null model (UUG is None unless low rank). Each is linear in the columns of G1, so it can be computed once for
+        the union of many sets' SNPs and then sliced (and scaled) per set.
+        '''
+        resG, Xdagger = linreg(Y=G1, X=self.X, Xdagger=self.Xdagger)
+        UG = self.U.T.dot(resG)
+        UUG = resG-self.U.dot(UG) if self.lowrank else None
+        return resG, UG, UUG
+
+    def _score(self, G1, rotated=None):
         '''
         compute the score with a background kernel
         '''
@@ -273,12 +288,9 @@ class scoretest2K(scoretest):
         #    Px = Vi-P                                    
 
         P = self.UY.shape[1]
-        resG, Xdagger = linreg(Y=G1, X=self.X, Xdagger=self.Xdagger)
+        resG, UG, UUG = self.rotate(G1) if rotated is None else rotated
         sigma2e = (1.0-self.optparams["h2"])*self.optparams["sigma2"]
         sigma2g = self.optparams["h2"]*self.optparams["sigma2"]
-        UG = self.U.T.dot(resG)
-        if self.lowrank:
-            UUG = resG-self.U.dot(UG)
         Sd = 1.0/(self.S*sigma2g + sigma2e)
         SUG = UG * NP.lib.stride_tricks.as_strided(Sd, (Sd.size,UG.shape[1]), (Sd.itemsize,0))
         #tr(YPGGPY)
@@ -1,6 +1,9 @@
 import logging
 import os
 import time
+import hashlib
+import shutil
+import tempfile
 import warnings
 from unittest.mock import patch
 from pathlib import Path
@@ -21,6 +24,8 @@ from pysnptools.standardizer import Standardizer, Unit
 from pysnptools.util import create_directory_if_necessary
 from pysnptools.util.intrangeset import IntRangeSet
 from pysnptools.util.mapreduce1 import map_reduce
+from fastlmm.util.thread_budget import threads_per_task, limit_threads, _runner_taskcount
+from fastlmm.util.matrix.kernel_store import ChromKernelStore
 
 
 # !!!LATER add warning here (and elsewhere) K0 or K1.sid_count < test_snps.sid_count,
@@ -36,7 +41,10 @@ def single_snp(test_snps, pheno, K0=None,
                 random_threshold=None,
                 random_seed = 0,
                 xp=None,
-                count_A1=None):
+                count_A1=None,
+                num_threads=None,
+                incremental=False,
+                kernel_store=None):
     """
     Function performing single SNP GWAS using cross validation over the chromosomes and REML. Will reorder and intersect IIDs as needed.
     (For backwards compatibility, you may use 'leave_out_one_chrom=False' to skip cross validation, but that is not recommended.)
@@ -59,6 +67,9 @@ def single_snp(test_snps, pheno, K0=None,
            If you give a string, it should be the base name of a set of PLINK Bed-formatted files.
            If leave_out_one_chrom is True, can be a dictionary from chromosome number to any `KernelReader <http://fastlmm.github.io/PySnpTools/#kernelreader-kernelreader>`_
            or the name a `KernelNpz <http://fastlmm.github.io/PySnpTools/#kernelreader-kernelnpz>`_-formated file.
+           For large cohorts, :meth:`fastlmm.util.matrix.kernel_store.ChromKernelStore.loco_dict` gives such a dictionary
+           while reading each SNP only once. Given SNPs (or nothing) as K0, single_snp reads the SNPs of every other chromosome
+           once per chromosome, unless kernel_store is given.
            If leave_out_one_chrom is False, can be any `KernelReader <http://fastlmm.github.io/PySnpTools/#kernelreader-kernelreader>`_ or
            name of a `KernelNpz <http://fastlmm.github.io/PySnpTools/#kernelreader-kernelnpz>`_-formated file.
     :type K0: `SnpReader <http://fastlmm.github.io/PySnpTools/#snpreader-snpreader>`_ or a string
@@ -117,6 +128,10 @@ def single_snp(test_snps, pheno, K0=None,
     :param interact_with_snp: index of a covariate to perform an interaction test with.
             Allows for interaction testing (interact_with_snp x snp will be tested)
             default: None
+            Can also be a list of covariate indexes. Then, for each block of test SNPs, every covariate x snp term is formed
+            at once and all are scored in one likelihood evaluation against the shared null model. The result has one row
+            per SNP and covariate, with the covariate's name in an extra 'Interaction' column. This gives the same values as
+            separate runs with each index, but reads each SNP once.
 
     :param force_full_rank: Even if kernels are defined with fewer SNPs than IIDs, create an explicit iid_count x iid_count kernel. Cannot be True if force_low_rank is True.
     :type force_full_rank: Boolean
@@ -146,6 +161,15 @@ def single_snp(test_snps, pheno, K0=None,
     :type random_threshold: integer
 
     :param map_reduce_outer: If true (default), divides work by chromosome. If false, divides test_snp work into chunks.
+        With leave_out_one_chrom and a runner that runs several tasks at once (for example, LocalMultiProc), the chromosomes
+        are balanced: first, one task per chromosome finds its null model (saved as a cache file) and tests as many SNPs as
+        the smallest chromosome has; then the remaining SNPs of all chromosomes are cut into one equal-sized unit per
+        worker, each unit reusing the cached null models. Large chromosomes are so split and small ones merged. With
+        pvalue_threshold or random_threshold, each chromosome stays one task, so that PValueCount and the random values
+        don't depend on the runner. The cached null models take disk: a full-rank one holds a dense iid_count x iid_count U,
+        so chrom_count*iid_count*iid_count*8 bytes in all (about 440 GB for 50,000 iids and 22 chromosomes); a low-rank one
+        holds iid_count x (SNP count) values. So without a cache_file, chromosomes are split only when their null models are
+        low rank (and then cached in a temporary directory); give a cache_file on a disk with room to split full-rank ones.
     :type map_reduce_outer: bool
 
     :param xp: The array module to use (optional), for example, 'numpy' (normal CPU-based module)
@@ -161,6 +185,29 @@ def single_snp(test_snps, pheno, K0=None,
          alleles (the PLINK standard) or the number of A2 alleles. False is the current default, but in the future the default will change to True.
     :type count_A1: bool
 
+    :param num_threads: The number of BLAS/OpenMP and bed_reader threads each map_reduce task may use (optional).
+         By default, a runner that runs several tasks at once (for example, LocalMultiProc) divides the machine's cores among them
+         (see :func:`fastlmm.util.thread_budget.threads_per_task`), so that it doesn't oversubscribe the machine. Otherwise, the threads
+         are not limited (beyond any limits the user has set). The setting is recorded in the result's ``attrs["thread_budget"]``.
+    :type num_threads: number
+
+    :param incremental: If true and output_file_name already exists, only test the (SNP, phenotype) pairs that lack a
+         row in it (for example, a batch of newly imputed SNPs on every phenotype, or every SNP on newly added
+         phenotypes). The new rows are merged into the existing ones and output_file_name is replaced atomically. The
+         kernels default to the full test_snps, as in a full run. Give the same cache_file as the earlier run so that
+         the null model is loaded rather than refit; the cache records its kernel, so if the kernel has changed (for
+         example, because the default kernel now has the new SNPs), the null model is refit. Because a one-phenotype
+         output doesn't name its phenotype, an earlier one-phenotype run is taken to be of pheno's first phenotype.
+         Cannot be used with pvalue_threshold or random_threshold, because then missing rows are expected. Default: False.
+    :type incremental: bool
+
+    :param kernel_store: With leave_out_one_chrom and K0 (or G0 or, by default, test_snps) given as SNPs, the file name of a
+         :class:`fastlmm.util.matrix.kernel_store.ChromKernelStore` (optional). The store is written (reading each SNP once) unless
+         it already holds these SNPs, and then each chromosome's kernel is the store's total minus that chromosome, rather than
+         being rebuilt from the SNPs of every other chromosome. The store takes (chrom_count+1)*iid_count*iid_count*8 bytes of disk,
+         and its kernels are full rank. Default: None.
+    :type kernel_store: string
+
     :rtype: Pandas dataframe with one row per test SNP. Columns include "PValue"
 
     :Example:
@@ -202,6 +249,39 @@ def single_snp(test_snps, pheno, K0=None,
         assert not np.any((good_values_per_iid>0) * (good_values_per_iid<pheno.sid_count)), "With multiple phenotypes, an individual's values must either be all missing or have no missing."
         pheno = pheno[good_values_per_iid>0,:] # drop individuals with no good pheno values.
         covar = _pheno_fixup(covar, iid_if_none=pheno.iid, count_A1=count_A1)
+        num_threads_task = threads_per_task(runner, num_threads)
+
+        if incremental and output_file_name is not None and os.path.exists(output_file_name):
+            assert pvalue_threshold is None and random_threshold is None, "incremental runs can't be used with pvalue_threshold or random_threshold"
+            old_frame = pd.read_csv(output_file_name, delimiter="\t", dtype={'SNP': str, 'Pheno': str, 'Interaction': str})
+            interact_names = None if interact_with_snp is None or np.isscalar(interact_with_snp) else covar.sid[list(interact_with_snp)]
+            unit_list = _missing_units(old_frame, test_snps.sid, pheno.sid, interact_names)
+            logging.info(f"incremental: {sum(len(sid_index)*len(pheno_index) for sid_index, pheno_index in unit_list)} of {test_snps.sid_count*pheno.sid_count} (SNP, phenotype) pairs need testing")
+            if len(unit_list) == 0:
+                return old_frame
+            full_sid_index = np.arange(test_snps.sid_count)
+            if leave_out_one_chrom: # sid_index counts from each chromosome's first SNP
+                for chrom in set(test_snps.pos[:, 0]):
+                    is_chrom = test_snps.pos[:, 0]==chrom
+                    full_sid_index[is_chrom] = np.arange(is_chrom.sum())
+            new_frame_list = []
+            for sid_index, pheno_index in unit_list:
+                new_frame = single_snp(test_snps[:, sid_index], pheno[:, pheno_index], K0=K0, K1=K1, mixing=mixing,
+                                       covar=covar, covar_by_chrom=covar_by_chrom, leave_out_one_chrom=leave_out_one_chrom,
+                                       output_file_name=None, h2=h2, log_delta=log_delta,
+                                       cache_file=cache_file, GB_goal=GB_goal, interact_with_snp=interact_with_snp,
+                                       force_full_rank=force_full_rank, force_low_rank=force_low_rank,
+                                       G0=G0 if (K0 is not None or G0 is not None) else test_snps, G1=G1, # the kernel is of all test_snps, as in a full run
+                                       runner=runner, map_reduce_outer=map_reduce_outer, xp=xp, count_A1=count_A1,
+                                       num_threads=num_threads, kernel_store=kernel_store)
+                new_frame['sid_index'] = full_sid_index[test_snps.sid_to_index(new_frame['SNP'].values)]
+                if pheno.sid_count > 1: # label the rows as a run of all the phenotypes would
+                    new_frame['Pheno'] = new_frame['Pheno'] if 'Pheno' in new_frame.columns else pheno.sid[pheno_index[0]]
+                    new_frame['PhenoCount'] = pheno.sid_count
+                new_frame_list.append(new_frame)
+            new_frame = pd.concat(new_frame_list)
+            new_frame.attrs = new_frame_list[-1].attrs
+            return _merge_into_output(old_frame, new_frame, pheno.sid, interact_names, output_file_name)
 
         if not leave_out_one_chrom:
             assert covar_by_chrom is None, "When 'leave_out_one_chrom' is False, 'covar_by_chrom' must be None"  # !!!LATER document covar_by_chrom
@@ -228,6 +308,7 @@ def single_snp(test_snps, pheno, K0=None,
                                         random_threshold=random_threshold,
                                         random_seed = random_seed,
                                         xp=xp, 
+                                        num_threads=num_threads_task,
                                         )
             if pvalue_threshold is None and random_threshold is None:
                 sid_index_range = IntRangeSet(frame['sid_index'])
@@ -242,6 +323,8 @@ def single_snp(test_snps, pheno, K0=None,
 
             chrom_list = list(set(test_snps.pos[:, 0]))  # find the set of all chroms mentioned in test_snps, the main testing data
             assert not np.isnan(chrom_list).any(), "chrom list should not contain NaN"
+            if kernel_store is not None:
+                K0, G0 = _loco_kernel_dict(K0 or G0 or test_snps, kernel_store, chrom_list, test_snps.iid, count_A1, runner), None
             input_files = [test_snps, pheno, covar] + ([] if covar_by_chrom is None else list(covar_by_chrom.values()))
             for Ki in [K0, G0, K1, G1]:
                 if isinstance(Ki, dict):
@@ -249,12 +332,14 @@ def single_snp(test_snps, pheno, K0=None,
                 else:
                     input_files.append(Ki)
 
-            def nested_closure(chrom):
-                logging.info(f"working on chrom {chrom}")
+            def nested_closure(chrom, start=None, stop=None, cache_base=cache_file):
+                logging.info(f"working on chrom {chrom}" + ("" if start is None else f", SNPs {start} to {stop}"))
                 xp = pstutil.array_module()
                 test_snps_chrom = test_snps[:, test_snps.pos[:, 0]==chrom]
+                if start is not None:
+                    test_snps_chrom = test_snps_chrom[:, start:stop]
                 covar_chrom = _create_covar_chrom(covar, covar_by_chrom, chrom)
-                cache_file_chrom = None if cache_file is None else f"{cache_file}.{chrom}.npz"
+                cache_file_chrom = None if cache_base is None else f"{cache_base}.{chrom}.npz"
 
                 K0_chrom = _K_per_chrom(K0 or G0 or test_snps, chrom, test_snps.iid)
                 K1_chrom = _K_per_chrom(K1 or G1, chrom, test_snps.iid)
@@ -272,7 +357,10 @@ def single_snp(test_snps, pheno, K0=None,
                                             pvalue_threshold=pvalue_threshold,
                                             random_threshold=random_threshold,
                                             random_seed=random_seed,
-                                            xp=xp)
+                                            xp=xp,
+                                            num_threads=None if runner_inner is None else num_threads_task)
+                if start is not None:
+                    distributable['sid_index'] += start # sid_index counts from the chromosome's first SNP
                 return distributable
 
             def reducer_closure(frame_sequence):
@@ -288,13 +376,49 @@ def single_snp(test_snps, pheno, K0=None,
 
                 return frame
 
-            frame = map_reduce(chrom_list,
-                       mapper=nested_closure,
-                       reducer=reducer_closure,
-                       input_files=input_files,
-                       output_files=[output_file_name],
-                       name="single_snp (leave_out_one_chrom), out='{0}'".format(output_file_name),
-                       runner = runner_outer)
+            # The thresholds' PValueCount and random values are per chromosome (and per SNP block), so then don't split chromosomes.
+            # Nor without a cache_file when the null models are full rank, because caching them would take chrom_count x iid_count^2 doubles of temp disk.
+            if (runner_outer is None or _runner_taskcount(runner_outer) == 1 or pvalue_threshold is not None or random_threshold is not None
+                or (cache_file is None and not _loco_null_is_low_rank(K0 or G0 or test_snps, K1 or G1, mixing, test_snps.iid, force_full_rank, force_low_rank, count_A1))):
+                frame = map_reduce(chrom_list,
+                        mapper=limit_threads(nested_closure, None if runner_outer is None else num_threads_task),
+                        reducer=reducer_closure,
+                        input_files=input_files,
+                        output_files=[output_file_name],
+                        name="single_snp (leave_out_one_chrom), out='{0}'".format(output_file_name),
+                        runner = runner_outer)
+            else:
+                sid_count_by_chrom = {chrom: int((test_snps.pos[:, 0]==chrom).sum()) for chrom in chrom_list}
+                first_unit_list, rest_unit_list = _loco_schedule(sid_count_by_chrom, _runner_taskcount(runner_outer))
+                cache_dir = None if cache_file is not None else tempfile.mkdtemp(prefix="single_snp_loco")
+                cache_base = cache_file if cache_file is not None else os.path.join(cache_dir, "null")
+
+                def unit_closure(unit):
+                    return pd.concat([nested_closure(chrom, start, stop, cache_base) for chrom, start, stop in unit])
+
+                try:
+                    # The first units find (and cache) each chromosome's null model, so they must finish before the rest start.
+                    frame_list = map_reduce(first_unit_list,
+                                    mapper=limit_threads(unit_closure, num_threads_task),
+                                    input_files=input_files,
+                                    name="single_snp (leave_out_one_chrom, null models)",
+                                    runner = runner_outer)
+                    if len(rest_unit_list) == 0: # every chromosome has the same number of SNPs
+                        frame = reducer_closure(frame_list)
+                    else:
+                        frame = map_reduce(rest_unit_list,
+                                mapper=limit_threads(unit_closure, num_threads_task),
+                                reducer=lambda frame_sequence: reducer_closure(list(frame_list) + list(frame_sequence)),
+                                input_files=input_files,
+                                output_files=[output_file_name],
+                                name="single_snp (leave_out_one_chrom, balanced), out='{0}'".format(output_file_name),
+                                runner = runner_outer)
+                finally:
+                    if cache_dir is not None:
+                        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        frame.attrs["thread_budget"] = {"num_threads": num_threads_task, "task_count": _runner_taskcount(runner)}
+        logging.info("thread budget: {0}".format(frame.attrs["thread_budget"]))
 
     return frame
 
@@ -339,6 +463,23 @@ def single_snp_leave_out_one_chrom(*args, **kwargs):
     warnings.warn("'single_snp_leave_out_one_chrom' is deprecated. Use 'single_snp(...) instead.", DeprecationWarning)
     return single_snp(*args, **kwargs)
 
+def _loco_kernel_dict(K0, kernel_store, chrom_list, iid, count_A1, runner):
+    '''
+    A dictionary from each chromosome to its leave-out-one-chromosome kernel, from the ChromKernelStore named kernel_store.
+    The store is written from K0's SNPs unless it already holds them.
+    '''
+    if isinstance(K0, dict):
+        return K0 # already per chromosome
+    K0_all = _kernel_fixup(K0, iid_if_none=iid, standardizer=Unit(), count_A1=count_A1)
+    if not isinstance(K0_all, SnpKernel):
+        raise Exception("kernel_store needs K0 (or G0) to be SNPs, not '{0}'".format(K0_all))
+    store = ChromKernelStore(kernel_store) if os.path.exists(ChromKernelStore._metadata_filename(kernel_store)) else None
+    if store is None or not store.matches(K0_all.snpreader):
+        store = ChromKernelStore.write(kernel_store, K0_all.snpreader, standardizer=K0_all.standardizer, runner=runner)
+    else:
+        logging.info(f"reusing kernel store '{kernel_store}'")
+    return store.loco_dict(chrom_list)
+
 def _K_per_chrom(K, chrom, iid,count_A1=None):
     if K is None:
         return KernelIdentity(iid)
@@ -621,7 +762,8 @@ def _internal_single(K0, test_snps, pheno, covar, K1,
                  pvalue_threshold,
                  random_threshold,
                  random_seed,
-                 xp):
+                 xp,
+                 num_threads=None):
 
     assert K0 is not None, "real assert"
     assert K1 is not None, "real assert"
@@ -640,7 +782,17 @@ def _internal_single(K0, test_snps, pheno, covar, K1,
     covar_val = xp.asarray(covar.read(view_ok=True,order='A').val)
     covar_val = xp.c_[covar_val,xp.ones((test_snps.iid_count, 1))]  #view_ok because np.c_ will allocation new memory
 
-    if interact_with_snp is not None:
+    interact_names = None
+    if interact_with_snp is not None and not np.isscalar(interact_with_snp):
+        interact_with_snp = [int(index) for index in interact_with_snp]
+        logging.info("interaction with {0}".format(interact_with_snp))
+        assert len(interact_with_snp) > 0 and all(0 <= index < covar_val.shape[1]-1 for index in interact_with_snp), "interact_with_snp is out of range"
+        interact = covar_val[:,interact_with_snp].copy()
+        interact -= interact.mean(axis=0)
+        interact /= interact.std(axis=0)
+        interact_names = covar.sid[interact_with_snp]
+        block_size = max(1, block_size // len(interact_with_snp)) #Each SNP becomes len(interact_with_snp) columns
+    elif interact_with_snp is not None:
         logging.info("interaction with %i" % interact_with_snp)
         assert 0 <= interact_with_snp < covar_val.shape[1]-1, "interact_with_snp is out of range"
         interact = covar_val[:,interact_with_snp].copy()
@@ -651,16 +803,16 @@ def _internal_single(K0, test_snps, pheno, covar, K1,
 
 
     lmm, h2, mixing = _find_h2_s_u(mixing, h2, pheno, covar_val, xp,
-                force_full_rank, force_low_rank, K0, K1, cache_file, runner)
+                force_full_rank, force_low_rank, K0, K1, cache_file, runner, num_threads=num_threads)
     assert lmm.Y.shape == pheno.shape, "expect pheno and lmm.Y to have the same shape"
 
-    frame = _snp_tester(test_snps, interact, pheno, lmm, block_size, output_file_name, runner, h2, mixing, pvalue_threshold, random_threshold, random_seed)
+    frame = _snp_tester(test_snps, interact, pheno, lmm, block_size, output_file_name, runner, h2, mixing, pvalue_threshold, random_threshold, random_seed, num_threads=num_threads, interact_names=interact_names)
 
     return frame
 
 cache_version = 3
 
-def save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp):
+def save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp, kernel_id=None, pheno_sid_0=None):
     pstutil.create_directory_if_necessary(cache_file)
     assert lmm_0.U is not None and lmm_0.S is not None, "Expect S and U have been computed"
     xp.savez(cache_file,
@@ -670,11 +822,40 @@ def save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp):
              UY=lmm_0.UY,
              UUY=lmm_0.UUY if lmm_0.UUY is not None else [False],
              h2_0=h2_0,
-             mixing_0=mixing_0
+             mixing_0=mixing_0,
+             kernel_id=np.array("" if kernel_id is None else kernel_id),
+             pheno_sid_0=np.array("" if pheno_sid_0 is None else str(pheno_sid_0))
              )
     if os.path.exists(cache_file_extra):
         os.unlink(cache_file_extra)
 
+def _kernel_id(K0, K1):
+    '''
+    A hash of the kernels a null model's S and U come from: their iids and, where known, their SNPs (or in-memory values).
+    '''
+    hasher = hashlib.sha256()
+    for K in [K0, K1]:
+        hasher.update(repr(K).encode())
+        hasher.update("\t".join(np.array(K.iid, dtype=str).reshape(-1)).encode())
+        inner = K
+        while not isinstance(inner, (SnpKernel, KernelData)) and hasattr(inner, "_internal"): # look inside subsets
+            inner = inner._internal
+        if isinstance(inner, SnpKernel):
+            hasher.update("\t".join(np.array(inner.snpreader.sid, dtype=str)).encode())
+        elif isinstance(inner, KernelData):
+            hasher.update(np.ascontiguousarray(inner.val).tobytes())
+    return hasher.hexdigest()
+
+def _cache_matches(cache_file, kernel_id):
+    # A cache is for one kernel. (Older caches don't record theirs, so they are trusted.)
+    with np.load(cache_file) as data:
+        return "kernel_id" not in data or str(data["kernel_id"]) in ["", kernel_id]
+
+def _cache_pheno_matches(cache_file, pheno_sid_0):
+    # A cache's UY and h2_0 are of one (first) phenotype. (Older caches don't record it, so they are trusted.)
+    with np.load(cache_file) as data:
+        return "pheno_sid_0" not in data or str(data["pheno_sid_0"]) in ["", str(pheno_sid_0)]
+
 def load_cache(covar_val, y_0, cache_file, xp):
     lmm_0 = lmm_cov(X=covar_val, Y=y_0, G=None, K=None, xp=xp)
     with xp.load(cache_file) as data: #!! similar code in epistasis
@@ -692,7 +873,7 @@ def load_cache(covar_val, y_0, cache_file, xp):
 
     return lmm_0, h2_0, mixing_0
 
-def save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp):
+def save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp, pheno_sid=None):
         pstutil.create_directory_if_necessary(cache_file_extra)
         assert lmm_multi.UY is not None and lmm_multi.S is not None, "Expect UY have been computed"
         xp.savez(cache_file_extra,
@@ -700,9 +881,17 @@ def save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp):
                  UY=lmm_multi.UY,
                  UUY=lmm_multi.UUY if lmm_multi.UUY is not None else [False],
                  h2=multi_h2,
-                 mixing=multi_mixing
+                 mixing=multi_mixing,
+                 pheno_sid=np.array([] if pheno_sid is None else pheno_sid, dtype=str)
                  )
 
+def _cache_extra_matches(cache_file_extra, pheno_sid):
+    # An extra cache is for one list of phenotypes. (Older caches don't record theirs, so only their count is checked.)
+    with np.load(cache_file_extra) as data:
+        if "pheno_sid" not in data or len(data["pheno_sid"]) == 0:
+            return data["UY"].shape[1] == len(pheno_sid)
+        return list(data["pheno_sid"]) == [str(sid) for sid in pheno_sid]
+
 def load_cache_extra(lmm_multi, multi_y, cache_file_extra, xp):
     with xp.load(cache_file_extra) as data: #!! similar code in epistasis
         version = data['version']
@@ -718,7 +907,7 @@ def load_cache_extra(lmm_multi, multi_y, cache_file_extra, xp):
 
 
 def _find_h2_s_u(mixing, h2, multi_pheno, covar_val, xp,
-                force_full_rank, force_low_rank, K0, K1, cache_file, runner):
+                force_full_rank, force_low_rank, K0, K1, cache_file, runner, num_threads=None):
 
     assert multi_pheno.sid_count >= 1, "Expect at least one phenotype"
     assert isinstance(K1,KernelIdentity) or multi_pheno.sid_count == 1, "When a 2nd kernel is given, only one phenotype is allowed."
@@ -730,9 +919,20 @@ def _find_h2_s_u(mixing, h2, multi_pheno, covar_val, xp,
     cache_file_extra = f"{cache_file}.extra.npz" if cache_file is not None else None
 
     logging.info("Finding SU and then h2 for first phenotype")
-    if cache_file is not None and os.path.exists(cache_file):
+    kernel_id = None if cache_file is None else _kernel_id(K0, K1)
+    if cache_file is not None and os.path.exists(cache_file) and _cache_matches(cache_file, kernel_id):
         lmm_0, h2_0, mixing_0 = load_cache(covar_val, y_0, cache_file, xp)
+        if not _cache_pheno_matches(cache_file, multi_pheno.sid[0]):
+            logging.info(f"cache_file '{cache_file}' is of another first phenotype, so using only its S and U")
+            lmm_0, h2_0, mixing_0 = _find_h2_s_u_for_one_pheno(None, None,
+                                                    covar_val, True, None,
+                                                    y_0,
+                                                    mixing_0, h2, force_full_rank, force_low_rank,
+                                                    None,lmm_0.S,lmm_0.U,
+                                                    xp)
     else:
+        if cache_file is not None and os.path.exists(cache_file):
+            logging.info(f"cache_file '{cache_file}' is of another kernel, so finding S and U again")
         lmm_0, h2_0, mixing_0 = _find_h2_s_u_for_one_pheno(K0, K1, 
                                                     covar_val, True, None,
                                                     y_0,
@@ -741,19 +941,19 @@ def _find_h2_s_u(mixing, h2, multi_pheno, covar_val, xp,
                                                     xp)
 
         if cache_file is not None:
-            save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp)
+            save_cache(lmm_0, h2_0, mixing_0, cache_file, cache_file_extra, xp, kernel_id=kernel_id, pheno_sid_0=multi_pheno.sid[0])
 
     if multi_pheno.sid_count == 1:
         return lmm_0, h2_0, mixing_0
-    elif cache_file_extra is not None and os.path.exists(cache_file_extra):
+    elif cache_file_extra is not None and os.path.exists(cache_file_extra) and _cache_extra_matches(cache_file_extra, multi_pheno.sid):
         return load_cache_extra(lmm_0, multi_y, cache_file_extra, xp)
     else:
-        lmm_multi, multi_h2, multi_mixing = compute_extra(lmm_0, h2, h2_0, mixing_0, multi_y, multi_pheno, cache_file_extra, force_full_rank, force_low_rank, runner, xp)
+        lmm_multi, multi_h2, multi_mixing = compute_extra(lmm_0, h2, h2_0, mixing_0, multi_y, multi_pheno, cache_file_extra, force_full_rank, force_low_rank, runner, xp, num_threads=num_threads)
         if cache_file_extra is not None:
-            save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp)
+            save_cache_extra(lmm_multi, multi_h2, multi_mixing, cache_file_extra, xp, pheno_sid=multi_pheno.sid)
         return lmm_multi, multi_h2, multi_mixing
 
-def compute_extra(lmm_0, h2, h2_0, mixing_0, multi_y, multi_pheno, cache_file_extra, force_full_rank, force_low_rank, runner, xp):
+def compute_extra(lmm_0, h2, h2_0, mixing_0, multi_y, multi_pheno, cache_file_extra, force_full_rank, force_low_rank, runner, xp, num_threads=None):
     uy_list=[lmm_0.UY[:,0]]
     if lmm_0.UUY is not None:
         uuy_list=[lmm_0.UUY[:,0]]
@@ -770,7 +970,7 @@ def compute_extra(lmm_0, h2, h2_0, mixing_0, multi_y, multi_pheno, cache_file_ex
                                 K=lmm_0.K,S=lmm_0.S,U=lmm_0.U,
                                 xp=xp)
 
-    result_list = map_reduce(range(1, multi_pheno.col_count),mapper=mapper,runner=runner)
+    result_list = map_reduce(range(1, multi_pheno.col_count),mapper=limit_threads(mapper, num_threads),runner=runner)
     #could do this with runner
     for lmm_p, h2_p, mixing_p in result_list:
         uy_list.append(lmm_p.UY[:,0])
@@ -815,10 +1015,11 @@ def _find_h2_s_u_for_one_pheno(K0, K1, covar_val, regressX, linreg, y, mixing, h
 
     return lmm, h2, mixing
 
-def _snp_tester(test_snps, interact, pheno, lmm, block_size, output_file_name, runner, h2, mixing, pvalue_threshold, random_threshold, random_seed):
+def _snp_tester(test_snps, interact, pheno, lmm, block_size, output_file_name, runner, h2, mixing, pvalue_threshold, random_threshold, random_seed, num_threads=None, interact_names=None):
         
     work_count = -(test_snps.sid_count // -block_size) #Find the work count based on batch size (rounding up)
-    pvalue_count = test_snps.sid_count * pheno.sid_count
+    interact_count = 1 if interact_names is None else len(interact_names)
+    pvalue_count = test_snps.sid_count * pheno.sid_count * interact_count
 
     Sd, denom, h2 = lmm.get_Sd_etc(Sd=None, denom=None, h2=h2, logdelta=None, delta=None, scale=1, weightW=None)
 
@@ -843,7 +1044,9 @@ def _snp_tester(test_snps, interact, pheno, lmm, block_size, output_file_name, r
             statsx = xp.empty([val.shape[1],2],dtype=val.dtype,order="F" if val.flags["F_CONTIGUOUS"] else "C")
             Standardizer._standardize_unit_python(val,apply_in_place=True,use_stats=False,stats=statsx)
 
-        if interact is not None:
+        if interact_names is not None: # every snp x covariate term, snp-major, in one broadcast
+            variables_to_test = (val[:,:,xp.newaxis] * interact[:,xp.newaxis,:]).reshape(val.shape[0],-1)
+        elif interact is not None:
             variables_to_test = val * interact[:,xp.newaxis]
         else:
             variables_to_test = val
@@ -851,7 +1054,7 @@ def _snp_tester(test_snps, interact, pheno, lmm, block_size, output_file_name, r
         res = lmm.nLLeval(h2=h2, dof=None, scale=1.0, penalty=0.0, snps=variables_to_test, Sd=Sd, denom=denom)
 
         assert test_snps.iid_count == lmm.U.shape[0]
-        assert res['beta'].size==(end-start)*pheno.sid_count, "Expect multi_beta to be (end-start)x phenos"
+        assert res['beta'].size==(end-start)*interact_count*pheno.sid_count, "Expect multi_beta to be (end-start)x phenos"
 
         df = _multi_compute_stats(
             res['beta'],
@@ -868,7 +1071,8 @@ def _snp_tester(test_snps, interact, pheno, lmm, block_size, output_file_name, r
             random_threshold=random_threshold,
             random_seed=random_seed,
             pvalue_count=pvalue_count,
-            xp=xp
+            xp=xp,
+            interact_names=interact_names
             )
 
         logging.info("time={0}".format(time.time()-do_work_time))
@@ -888,16 +1092,115 @@ def _snp_tester(test_snps, interact, pheno, lmm, block_size, output_file_name, r
         return frame
 
     frame = map_reduce(range(work_count),
-                        mapper=mapper_closure,reducer=reducer_closure,
+                        mapper=limit_threads(mapper_closure, num_threads),reducer=reducer_closure,
                         input_files=[test_snps],output_files=[output_file_name],
                         name="single_snp(output_file={0})".format(output_file_name),
                         runner=runner)
     return frame
 
+def _frame_keys(frame, pheno_sid, interact_names):
+    # The (SNP, Pheno[, Interaction]) of each row of a single_snp output. A one-phenotype output has no 'Pheno' column.
+    key_list = [frame['SNP'].astype(str), frame['Pheno'].astype(str) if 'Pheno' in frame.columns else np.repeat(str(pheno_sid[0]), len(frame))]
+    if interact_names is not None:
+        key_list.append(frame['Interaction'].astype(str))
+    return pd.MultiIndex.from_arrays(key_list)
+
+def _missing_units(frame, sid, pheno_sid, interact_names):
+    '''
+    The (SNP, phenotype) pairs that lack rows in frame (a single_snp output), as a list of (sid indexes, pheno indexes).
+    Phenotypes that lack the same SNPs share a unit, so a new SNP is tested on every phenotype and a new phenotype on every SNP,
+    but a pair already in frame is not tested again.
+    '''
+    expected = pd.MultiIndex.from_product([np.array(sid,dtype=str), np.array(pheno_sid,dtype=str)] + ([] if interact_names is None else [np.array(interact_names,dtype=str)]))
+    is_missing = ~expected.isin(_frame_keys(frame, pheno_sid, interact_names))
+    is_missing = is_missing.reshape(len(sid), len(pheno_sid), -1).any(axis=2) #sid x pheno
+    unit_dict = {}
+    for pheno_index in range(len(pheno_sid)):
+        if is_missing[:, pheno_index].any():
+            unit_dict.setdefault(is_missing[:, pheno_index].tobytes(), []).append(pheno_index)
+    return [(np.flatnonzero(is_missing[:, pheno_index_list[0]]), np.array(pheno_index_list)) for pheno_index_list in unit_dict.values()]
+
+def _merge_into_output(old_frame, new_frame, pheno_sid, interact_names, output_file_name):
+    '''
+    Add the rows of new_frame not already in old_frame, sort by PValue and replace output_file_name atomically.
+    '''
+    new_frame = new_frame[~_frame_keys(new_frame, pheno_sid, interact_names).isin(_frame_keys(old_frame, pheno_sid, interact_names))]
+    if ('Pheno' in old_frame.columns) != ('Pheno' in new_frame.columns): # one of them is a one-phenotype run
+        old_frame, new_frame = old_frame.copy(), new_frame.copy()
+        for one_frame in [old_frame, new_frame]:
+            if 'Pheno' not in one_frame.columns:
+                one_frame['Pheno'] = pheno_sid[0]
+                one_frame['PhenoCount'] = 1
+
+    frame = pd.concat([old_frame, new_frame])
+    if 'Pheno' in frame.columns:
+        frame['PhenoCount'] = frame['Pheno'].nunique()
+    frame.sort_values(by="PValue", inplace=True)
+    frame.index = np.arange(len(frame))
+    frame.attrs = new_frame.attrs
+
+    temp_file_name = output_file_name + ".tmp"
+    frame.to_csv(temp_file_name, sep="\t", index=False)
+    os.replace(temp_file_name, output_file_name)
+    return frame
+
+def _loco_null_is_low_rank(K0, K1, mixing, iid, force_full_rank, force_low_rank, count_A1):
+    '''
+    Whether every chromosome's null model (and so its cache) will be low rank, that is, have an iid_count x (SNP count) U
+    rather than a dense iid_count x iid_count one. When unsure, says False.
+    '''
+    if force_full_rank:
+        return False
+    if force_low_rank:
+        return True
+    if (K1 is not None and mixing != 0.0) or isinstance(K0, dict):
+        return False
+    K0_all = _kernel_fixup(K0, iid_if_none=iid, standardizer=Unit(), count_A1=count_A1)
+    return isinstance(K0_all, SnpKernel) and K0_all.snpreader.sid_count < len(iid)
+
+def _loco_schedule(sid_count_by_chrom, task_count):
+    '''
+    Divide the test SNPs of each chromosome into units of work, each a list of (chrom, start, stop).
+
+    The cost of a unit is modeled as its SNP count (plus one null model per chromosome), because every chromosome's
+    null model and per-SNP test cost depend on the same individuals and (nearly) the same kernel. The first list has one
+    unit per chromosome: its null model and its first min(SNP count) SNPs, so these units cost the same. The second list
+    cuts the remaining SNPs, in chromosome order, into task_count units of (nearly) equal SNP count. A unit may so span
+    several (small) chromosomes.
+
+    >>> first_unit_list, rest_unit_list = _loco_schedule({1: 100, 2: 10, 3: 40}, 3)
+    >>> first_unit_list
+    [[(1, 0, 10)], [(2, 0, 10)], [(3, 0, 10)]]
+    >>> rest_unit_list
+    [[(1, 10, 50)], [(1, 50, 90)], [(1, 90, 100), (3, 10, 40)]]
+    '''
+    first_count = min(sid_count_by_chrom.values())
+    first_unit_list = [[(chrom, 0, first_count)] for chrom in sid_count_by_chrom]
+
+    rest_list = [(chrom, first_count, sid_count) for chrom, sid_count in sid_count_by_chrom.items() if sid_count > first_count]
+    rest_count = sum(stop - start for _, start, stop in rest_list)
+    unit_count = min(task_count, rest_count)
+    rest_unit_list = []
+    for unit_index in range(unit_count):
+        goal = rest_count * (unit_index + 1) // unit_count - rest_count * unit_index // unit_count
+        unit = []
+        while goal > 0:
+            chrom, start, stop = rest_list.pop(0)
+            take = min(goal, stop - start)
+            unit.append((chrom, start, start + take))
+            if start + take < stop:
+                rest_list.insert(0, (chrom, start + take, stop))
+            goal -= take
+        rest_unit_list.append(unit)
+    return first_unit_list, rest_unit_list
+
 def _multi_compute_stats(multi_beta,multi_variance_beta,multi_fraction_variance_explained_beta,
                   start,end,snps_read,pheno_sid,
-                  mixing, h2, lmm, pvalue_threshold, random_threshold, random_seed, pvalue_count, xp):
-    assert len(multi_beta.reshape(-1))==(end-start)*len(pheno_sid), "Expect multi_beta to be (end-start)x phenos"
+                  mixing, h2, lmm, pvalue_threshold, random_threshold, random_seed, pvalue_count, xp, interact_names=None):
+    # With interact_names, multi_beta has a row for each snp x interaction (snp-major)
+    interact_count = 1 if interact_names is None else len(interact_names)
+    row_count = snps_read.sid_count * interact_count
+    assert len(multi_beta.reshape(-1))==(end-start)*interact_count*len(pheno_sid), "Expect multi_beta to be (end-start)x phenos"
     assert multi_variance_beta.shape == multi_beta.shape and multi_beta.shape==multi_fraction_variance_explained_beta.shape, "expect beta, variance_beta, and fraction_variance_explained_beta to agree on shape"
 
     chi2stats = pstutil.asnumpy(multi_beta*multi_beta/multi_variance_beta)
@@ -914,7 +1217,7 @@ def _multi_compute_stats(multi_beta,multi_variance_beta,multi_fraction_variance_
     dataframe = _create_dataframe(keep_index.sum())
 
     if len(pheno_sid) > 1:
-        dataframe['Pheno'] = np.repeat(pheno_sid, snps_read.sid_count)[keep_index]
+        dataframe['Pheno'] = np.repeat(pheno_sid, row_count)[keep_index]
         dataframe['PhenoCount'] = len(pheno_sid)
     if pvalue_threshold is not None:
         dataframe['PValueThreshold'] = pvalue_threshold
@@ -925,18 +1228,20 @@ def _multi_compute_stats(multi_beta,multi_variance_beta,multi_fraction_variance_
     if pvalue_threshold is not None or random_threshold is not None:
         dataframe['PValueCount'] = pvalue_count
 
-    dataframe['sid_index'] = np.tile(np.arange(start,end), len(pheno_sid))[keep_index]
-    dataframe['SNP'] = np.tile(snps_read.sid, len(pheno_sid))[keep_index]
-    dataframe['Chr'] = np.tile(snps_read.pos[:,0], len(pheno_sid))[keep_index]
-    dataframe['GenDist'] = np.tile(snps_read.pos[:,1], len(pheno_sid))[keep_index]
-    dataframe['ChrPos'] = np.tile(snps_read.pos[:,2], len(pheno_sid))[keep_index]
+    dataframe['sid_index'] = np.tile(np.repeat(np.arange(start,end), interact_count), len(pheno_sid))[keep_index]
+    dataframe['SNP'] = np.tile(np.repeat(snps_read.sid, interact_count), len(pheno_sid))[keep_index]
+    dataframe['Chr'] = np.tile(np.repeat(snps_read.pos[:,0], interact_count), len(pheno_sid))[keep_index]
+    dataframe['GenDist'] = np.tile(np.repeat(snps_read.pos[:,1], interact_count), len(pheno_sid))[keep_index]
+    dataframe['ChrPos'] = np.tile(np.repeat(snps_read.pos[:,2], interact_count), len(pheno_sid))[keep_index]
+    if interact_names is not None:
+        dataframe['Interaction'] = np.tile(interact_names, snps_read.sid_count * len(pheno_sid))[keep_index]
 
     dataframe['PValue'] = p_values[keep_index]
     dataframe['SnpWeight'] = pstutil.asnumpy(multi_beta.T.reshape(-1))[keep_index]
     dataframe['SnpWeightSE'] = pstutil.asnumpy(xp.sqrt(multi_variance_beta.T.reshape(-1)))[keep_index]
     dataframe['SnpFractVarExpl'] = pstutil.asnumpy(xp.sqrt(multi_fraction_variance_explained_beta.T.reshape(-1)))[keep_index]
-    dataframe['Mixing'] = np.repeat(mixing, snps_read.sid_count)[keep_index]
-    dataframe['Nullh2'] = np.repeat(h2, snps_read.sid_count)[keep_index]
+    dataframe['Mixing'] = np.repeat(mixing, row_count)[keep_index]
+    dataframe['Nullh2'] = np.repeat(h2, row_count)[keep_index]
 
     return dataframe
 
@@ -1,6 +1,6 @@
 import os
 import logging
-import collections
+import collections.abc
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
@@ -1221,7 +1221,7 @@ def _clear_cache_dict_internal(start_stage,cache_dict,chrom_num_list,log_writer)
 
 def _cache_dict_fixup(cache_dict,chrom_list):
     #If a dictionary, then fix up the values. Else, fix up the value and create a dictionary.
-    if isinstance(cache_dict, collections.Mapping):
+    if isinstance(cache_dict, collections.abc.Mapping):
         return {k:FileCache._fixup(v,default_subfolder='single_snp_scale') for k,v in cache_dict.items()}
     else:
         cache_value = FileCache._fixup(cache_dict,default_subfolder='single_snp_scale')
@@ -4,6 +4,7 @@ import numpy as np
 import logging
 from sklearn.model_selection import KFold
 import pandas as pd
+import scipy.stats as stats
 import os
 import time
 from unittest.mock import patch
@@ -34,6 +35,107 @@ def _fixup(test_snps, G, pheno, covar,count_A1=None):
     G, test_snps, pheno, covar  = pstutil.intersect_apply([G, test_snps, pheno, covar])
     return test_snps, G, pheno, covar
 
+def _top_snps_for_each_fold(G, pheno, covar, kfold_list, max_output_len, GB_goal=None, runner=None):
+    '''
+    For each (fold_index, (train_idx, test_idx)) in kfold_list, rank the SNPs of G by their :meth:`.single_snp_linreg` PValue
+    on the training iids and return a list with the top max_output_len sids of each fold.
+
+    G is read once. For each block of SNPs, the linear-regression sums of every training set are the all-iid sums minus the sums
+    over the iids left out of it (for cross-validation folds, the test iids). As the F-test is invariant to shifting and scaling
+    a SNP, the SNPs need not be standardized, but, as with standardization, missing values are filled in with the training mean.
+    '''
+    y = pheno.read(view_ok=True,order='A').val[:,0]
+    C = np.c_[covar.read(view_ok=True,order='A').val,np.ones((G.iid_count, 1))]
+    Z = np.c_[C,y] #sums with the covariates and y are computed together
+    c_count = C.shape[1]
+
+    fold_list = []
+    for fold_index, (train_idx, test_idx) in kfold_list:
+        train_idx = np.asarray(train_idx,dtype=int)
+        left_out = np.setdiff1d(np.arange(G.iid_count),train_idx)
+        ZtZ = Z[train_idx].T.dot(Z[train_idx])
+        fold_list.append((left_out, len(train_idx), ZtZ))
+
+    if GB_goal is not None:
+        bytes_per_sid = G.iid_count * 8
+        block_size = max(1,int(1024.0**3*GB_goal/bytes_per_sid+.5))
+    else:
+        block_size = G.sid_count
+
+    def mapper(start):
+        logging.info("ranking SNPs for {0} folds, start={1},block_size={2}".format(len(fold_list),start,block_size))
+        x = G[:,start:start+block_size].read(view_ok=True,order='A').val
+        observed = x==x
+        x = np.where(observed,x-np.nanmean(x,axis=0),0.0) #centering helps with the accuracy of the sums
+        observed = observed.astype(np.float64)
+        total = _linreg_sums(x,observed,Z)
+
+        result = []
+        for left_out, train_count, ZtZ in fold_list:
+            if len(left_out) > 0:
+                sums = [t-l for t,l in zip(total,_linreg_sums(x[left_out],observed[left_out],Z[left_out]))]
+            else:
+                sums = total
+            pval = _linreg_pvalues(sums,train_count,ZtZ,c_count)
+            sort_index = np.argsort(pval)[:max_output_len]
+            result.append((pval[sort_index],start+sort_index))
+        return result
+
+    def reducer(result_sequence):
+        fold_to_list = [[] for _ in fold_list]
+        for result in result_sequence:
+            for fold_position, pval_and_index in enumerate(result):
+                fold_to_list[fold_position].append(pval_and_index)
+        top_snps_list = []
+        for pval_and_index_list in fold_to_list:
+            pval = np.concatenate([pval for pval,_ in pval_and_index_list])
+            index = np.concatenate([index for _,index in pval_and_index_list])
+            sort_index = np.argsort(pval)[:max_output_len]
+            top_snps_list.append(list(np.array(G.sid[index[sort_index]],dtype='str')))
+        return top_snps_list
+
+    return map_reduce(range(0,G.sid_count,block_size),
+                      mapper=mapper,
+                      reducer=reducer,
+                      input_files=[G,pheno,covar],
+                      name="top_snps_for_each_fold",
+                      runner=runner)
+
+def _linreg_sums(x, observed, Z):
+    '''
+    Per-SNP sums for linear regression with missing values filled in later: x.T.dot(Z), (x*x).sum(0) and observed.T.dot(Z),
+    where x has zeros at the missing values.
+    '''
+    return x.T.dot(Z), (x*x).sum(0), observed.T.dot(Z)
+
+def _linreg_pvalues(sums, train_count, ZtZ, c_count):
+    '''
+    The PValues of lin_reg.f_regression_cov_alt from the sums of one training set, with each SNP's missing values set to its training mean.
+    '''
+    xZ, xx, oZ = sums
+    observed_count = oZ[:,c_count-1] #the last covariate is the bias
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mean = xZ[:,c_count-1] / observed_count
+    mean[observed_count==0] = 0.0
+    missing_Z = ZtZ[c_count-1] - oZ #the sums of the covariates and y over the missing values
+    xZ = xZ + mean[:,np.newaxis] * missing_Z
+    xx = xx + mean * mean * (train_count - observed_count)
+
+    CtC_pinv = np.linalg.pinv(ZtZ[:c_count,:c_count])
+    Cty = ZtZ[:c_count,c_count]
+    xC = xZ[:,:c_count]
+    xy = xZ[:,c_count] - xC.dot(CtC_pinv.dot(Cty))
+    xx_residual = xx - (xC.dot(CtC_pinv) * xC).sum(1)
+    yy = ZtZ[c_count,c_count] - Cty.dot(CtC_pinv.dot(Cty))
+
+    xy2 = xy * xy
+    with np.errstate(divide='ignore',invalid='ignore'):
+        F = xy2 / (xx_residual * yy - xy2)
+    F[xx_residual <= 1e-10 * xx] = np.nan #SNPs that are constant (or a combination of the covariates) in the training iids
+    dof = train_count - 1 - c_count
+    F *= dof
+    return stats.f.sf(F, 1, dof)
+
 def single_snp_select(test_snps, pheno, G=None, covar=None,
                  k_list = None,
                  n_folds=10, #1 is special and means test on train
@@ -135,23 +237,10 @@ def single_snp_select(test_snps, pheno, G=None, covar=None,
 
         k_list_in = [0] + [int(k) for k in k_list if 0 < k <= G.sid_count]
 
-        def top_snps_for_each_fold_nested(kfold_item):
-            fold_index, (train_idx, test_idx) = kfold_item
-            _, G_in, pheno_in, covar_in = _fixup(test_snps, G, pheno, covar,count_A1=count_A1)
-            nested = single_snp_linreg(G_in[train_idx,:],pheno_in[train_idx,:],covar_in[train_idx,:],GB_goal=GB_goal,max_output_len=max(k_list_in),count_A1=count_A1)
-            return nested
-        def top_snps_for_each_fold_reducer(dataframe_list):
-            result = [list(dataframe['SNP']) for dataframe in dataframe_list]
-            return result
-
-
-        #Find top snps for each fold        
-        fold_index_to_top_snps = map_reduce(_kfold(G.iid_count, n_folds, seed, end_with_all=True,iid_to_index=G.iid_to_index),
-                                             nested=top_snps_for_each_fold_nested,
-                                             reducer=top_snps_for_each_fold_reducer,
-                                             name = "top_snps_for_each_fold",
-                                             input_files = common_input_files,
-                                             runner=runner)
+        #Find top snps for each fold (with one pass over G)
+        fold_index_to_top_snps = _top_snps_for_each_fold(G, pheno, covar,
+                                                         _kfold(G.iid_count, n_folds, seed, end_with_all=True,iid_to_index=G.iid_to_index),
+                                                         max_output_len=max(k_list_in), GB_goal=GB_goal, runner=runner)
 
         #=================================================
         # Start of definition of inner functions
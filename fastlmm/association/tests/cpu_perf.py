@@ -0,0 +1,280 @@
+'''
+CPU performance regression suite.
+
+Times the main entry points (single_snp, single_snp_linreg, single_snp_scale, epistasis, snp_set and FastLMM.fit/predict)
+on a synthetic cohort (see fastlmm.util.gensnp.simulate_cohort), writes the timings as JSON together with machine metadata
+and flags statistically significant slowdowns against a stored baseline. For example,
+
+    python -m fastlmm.association.tests.cpu_perf --size small --output perf.json --baseline baseline.json
+
+exits with status 1 if any benchmark is slower than in baseline.json. Unlike test_gpu_perf.py, it needs no GPU and no
+machine-specific paths. (It is not named test_*, so that test runners don't pick up the benchmarks; only
+:class:`TestCompare` runs with the unit tests.)
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+SIZES = {
+    "tiny": dict(iid_count=200, sid_count=1000),
+    "small": dict(iid_count=1000, sid_count=5000),
+    "medium": dict(iid_count=5000, sid_count=20000),
+}
+
+
+def machine_metadata():
+    '''
+    a dictionary describing the machine and the software versions, stored with the timings
+    '''
+    def version(package):
+        try:
+            try:
+                from importlib.metadata import version as package_version #Python 3.8 and later
+            except ImportError:
+                from pkg_resources import get_distribution
+                package_version = lambda name: get_distribution(name).version
+            return package_version(package)
+        except Exception: #not installed
+            return "<unknown>"
+
+    metadata = {
+        "computer_name": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    for package in ["numpy", "scipy", "pandas", "pysnptools", "fastlmm"]:
+        metadata[package] = version(package)
+    try:
+        from threadpoolctl import threadpool_info
+
+        metadata["blas"] = [
+            {key: info.get(key) for key in ["internal_api", "version", "num_threads"]}
+            for info in threadpool_info()
+        ]
+    except ImportError:
+        metadata["blas"] = "<threadpoolctl not installed>"
+    return metadata
+
+
+def cohort(size, cache_dir=None, seed=1):
+    '''
+    simulate (or reuse) the cohort for a size and return a dictionary of its readers and file names
+    '''
+    from pysnptools.snpreader import Bed, Pheno
+    from fastlmm.util.gensnp import simulate_cohort
+
+    cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "fastlmm_cpu_perf")
+    os.makedirs(cache_dir, exist_ok=True)
+    iid_count, sid_count = SIZES[size]["iid_count"], SIZES[size]["sid_count"]
+    basefilename = os.path.join(cache_dir, "cohort_{0}_{1}_{2}".format(iid_count, sid_count, seed))
+    if not os.path.exists(basefilename + ".cov"): #written last
+        logging.info("simulating {0}".format(basefilename))
+        simulate_cohort(basefilename, iid_count, sid_count, chrom_count=5, pop_count=2, family_size=4,
+                        causal_fraction=0.01, covar_count=2, seed=seed)
+
+    set_list = basefilename + ".sets.txt"
+    if not os.path.exists(set_list):
+        sid = Bed(basefilename, count_A1=False).sid
+        pd.DataFrame({"snp": sid[:200], "group": ["set{0}".format(i // 20) for i in range(min(200, len(sid)))]}).to_csv(set_list, sep="\t", index=False)
+
+    return {
+        "basefilename": basefilename,
+        "test_snps": Bed(basefilename, count_A1=False),
+        "pheno": Pheno(basefilename + ".phe"),
+        "pheno_file": basefilename + ".phe",
+        "covar": Pheno(basefilename + ".cov"),
+        "covar_file": basefilename + ".cov",
+        "set_list": set_list,
+        "output_dir": cache_dir,
+    }
+
+
+def _single_snp(data):
+    from fastlmm.association import single_snp
+
+    single_snp(data["test_snps"], data["pheno"], covar=data["covar"], leave_out_one_chrom=True, count_A1=False)
+
+
+def _single_snp_low_rank(data):
+    from fastlmm.association import single_snp
+
+    test_snps = data["test_snps"]
+    K0 = test_snps[:, :: max(1, 5 * test_snps.sid_count // test_snps.iid_count)]
+    single_snp(test_snps, data["pheno"], K0=K0, covar=data["covar"], leave_out_one_chrom=False, count_A1=False)
+
+
+def _single_snp_linreg(data):
+    from fastlmm.association import single_snp_linreg
+
+    single_snp_linreg(data["test_snps"], data["pheno"], covar=data["covar"], count_A1=False)
+
+
+def _single_snp_scale(data):
+    from fastlmm.association import single_snp_scale
+
+    single_snp_scale(data["test_snps"], data["pheno"], covar=data["covar"], count_A1=False)
+
+
+def _epistasis(data):
+    from fastlmm.association import epistasis
+
+    test_snps = data["test_snps"]
+    epistasis(test_snps[:, :40], data["pheno_file"], G0=test_snps, covar=data["covar_file"], count_A1=False)
+
+
+def _snp_set(data):
+    from fastlmm.association import snp_set
+
+    snp_set(data["basefilename"], data["set_list"], data["pheno_file"], nperm=0)
+
+
+def _fastlmm_fit_predict(data):
+    from fastlmm.inference import FastLMM
+
+    test_snps = data["test_snps"]
+    train = np.arange(test_snps.iid_count) % 5 != 0
+    K0 = test_snps[:, ::10]
+    model = FastLMM(GB_goal=2).fit(X=data["covar"][train, :], y=data["pheno"][train, :], K0_train=K0[train, :], count_A1=False)
+    model.predict(X=data["covar"][~train, :], K0_whole_test=K0[~train, :], count_A1=False)
+
+
+BENCHMARKS = {
+    "single_snp": _single_snp,
+    "single_snp_low_rank": _single_snp_low_rank,
+    "single_snp_linreg": _single_snp_linreg,
+    "single_snp_scale": _single_snp_scale,
+    "epistasis": _epistasis,
+    "snp_set": _snp_set,
+    "fastlmm_fit_predict": _fastlmm_fit_predict,
+}
+
+
+def run_suite(size="small", benchmarks=None, repeat=3, warmup=1, cache_dir=None, seed=1):
+    '''
+    time each benchmark repeat times (after warmup untimed runs) and return a JSON-serializable dictionary
+    with the machine metadata, the settings and, for each benchmark, the list of times in seconds
+    '''
+    data = cohort(size, cache_dir=cache_dir, seed=seed)
+    benchmarks = benchmarks or list(BENCHMARKS)
+    result = {
+        "metadata": machine_metadata(),
+        "size": dict(SIZES[size], name=size, seed=seed),
+        "repeat": repeat,
+        "benchmarks": {},
+    }
+    for name in benchmarks:
+        for _ in range(warmup):
+            BENCHMARKS[name](data)
+        times = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            BENCHMARKS[name](data)
+            times.append(time.perf_counter() - start_time)
+        logging.info("{0}: median {1:.3f}s".format(name, np.median(times)))
+        result["benchmarks"][name] = {"times": times, "median": float(np.median(times))}
+    return result
+
+
+def compare(result, baseline, alpha=0.01, threshold=1.10):
+    '''
+    compare the timings of result to those of baseline. A benchmark regressed if its median time grew by more than the
+    threshold factor and a one-sided Welch t-test on the log times gives a P-value below alpha.
+    Returns a DataFrame with one row per benchmark present in both.
+    '''
+    import scipy.stats as st
+
+    if result["size"] != baseline["size"]:
+        logging.warning("comparing different sizes: {0} vs baseline {1}".format(result["size"], baseline["size"]))
+    rows = []
+    for name, timing in result["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        times, baseline_times = np.log(timing["times"]), np.log(baseline["benchmarks"][name]["times"])
+        ratio = np.exp(np.median(times) - np.median(baseline_times))
+        if len(times) > 1 and len(baseline_times) > 1 and (times.std() > 0 or baseline_times.std() > 0):
+            pvalue = st.ttest_ind(times, baseline_times, equal_var=False, alternative="greater").pvalue
+        else:
+            pvalue = 0.0 if ratio > 1 else 1.0
+        rows.append({
+            "benchmark": name,
+            "baseline (s)": float(np.exp(np.median(baseline_times))),
+            "time (s)": float(np.exp(np.median(times))),
+            "ratio": ratio,
+            "PValue": pvalue,
+            "regressed": bool(ratio > threshold and pvalue < alpha),
+        })
+    return pd.DataFrame(rows, columns=["benchmark", "baseline (s)", "time (s)", "ratio", "PValue", "regressed"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FaST-LMM CPU performance regression suite")
+    parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    parser.add_argument("--benchmarks", nargs="*", choices=sorted(BENCHMARKS), help="default: all")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--output", help="JSON file to write the timings to")
+    parser.add_argument("--baseline", help="JSON file written by an earlier run to compare against")
+    parser.add_argument("--alpha", type=float, default=0.01, help="significance level of the slowdown test")
+    parser.add_argument("--threshold", type=float, default=1.10, help="smallest slowdown factor that counts")
+    parser.add_argument("--cache_dir", help="where to keep the synthetic cohorts")
+    args = parser.parse_args(argv)
+
+    result = run_suite(size=args.size, benchmarks=args.benchmarks, repeat=args.repeat, warmup=args.warmup, cache_dir=args.cache_dir)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    print(pd.DataFrame([{"benchmark": name, "time (s)": timing["median"]} for name, timing in result["benchmarks"].items()]))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        comparison = compare(result, baseline, alpha=args.alpha, threshold=args.threshold)
+        print(comparison)
+        if comparison["regressed"].any():
+            print("performance regression in: " + ", ".join(comparison["benchmark"][comparison["regressed"]]))
+            return 1
+    return 0
+
+
+class TestCompare(unittest.TestCase):
+
+    def test_compare(self):
+        result = {
+            "size": dict(SIZES["tiny"], name="tiny", seed=1),
+            "benchmarks": {"fast": {"times": [1.0, 1.1, 0.9]}, "slow": {"times": [3.0, 3.3, 2.7]}, "new": {"times": [1.0]}},
+        }
+        baseline = json.loads(json.dumps(result))
+        assert not compare(result, baseline)["regressed"].any()
+
+        baseline["benchmarks"]["slow"]["times"] = [t / 3.0 for t in baseline["benchmarks"]["slow"]["times"]] #three times faster
+        del baseline["benchmarks"]["new"]
+        comparison = compare(result, baseline, alpha=0.05).set_index("benchmark")
+        assert list(comparison.index) == ["fast", "slow"]
+        assert comparison.loc["slow", "regressed"] and abs(comparison.loc["slow", "ratio"] - 3.0) < 1e-10
+        assert not comparison.loc["fast", "regressed"]
+
+    def test_machine_metadata(self):
+        metadata = json.loads(json.dumps(machine_metadata()))
+        assert metadata["cpu_count"] >= 1 and metadata["numpy"] == np.__version__
+
+
+def getTestSuite():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestCompare)
+    return unittest.TestSuite([suite1])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
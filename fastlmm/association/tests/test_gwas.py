@@ -45,6 +45,34 @@ class TestGwas(unittest.TestCase):
             assert (expect[i][1] == test_idx).all()
     
 
+    def test_windowing_matches_single_snp_exclusion(self):
+        """
+        the batched windowing scan should match excluding one SNP at a time with LMM.nLLeval
+        """
+        from fastlmm.association.windowing_gwas import WindowingGwas
+
+        randomstate = np.random.RandomState(5)
+        for N, S in [(120, 50), (80, 200)]: #low rank and full rank
+            G = randomstate.randn(N, S)
+            y = G[:,0:3].sum(1) * 0.3 + randomstate.randn(N)
+            cov = np.hstack((np.ones((N, 1)), randomstate.randn(N, 1)))
+            for REML in [False, True]:
+                gwas = WindowingGwas(G, y, delta=1.0, cov=cov, REML=REML)
+                gwas.train_null()
+                gwas.train_windowing(blocksize=17)
+                p_values = gwas.compute_p_values()
+
+                lmm = gwas.lmm
+                for idx in [0, 7, S-1]:
+                    lmm.set_exclude_idx([idx])
+                    gwas.set_null_UX()
+                    nLL_null = lmm.nLLeval(delta=gwas.delta, REML=REML)['nLL']
+                    gwas.set_current_UX(idx)
+                    nLL_alt = lmm.nLLeval(delta=gwas.delta, REML=REML)['nLL']
+                    self.assertAlmostEqual(gwas.ll_null[idx], -nLL_null, places=8)
+                    self.assertAlmostEqual(gwas.ll_alt[idx], -nLL_alt, places=8)
+                    self.assertAlmostEqual(p_values[idx], stats.chi2.sf(2.0 * (nLL_null - nLL_alt), 1), places=8)
+
     #def xtest_results_identical_with_fastlmmcX(self):
     #    """
     #    make sure gwas yields same results as fastlmmC
@@ -0,0 +1,123 @@
+import logging
+import os.path
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from fastlmm.association.meta_analysis import FixefEffects, MetaAnalysis, RandomEffects, meta_analysis, meta_analysis_files
+
+
+class TestMetaAnalysis(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pysnptools.util import create_directory_if_necessary
+        create_directory_if_necessary(self.tempout_dir, isfile=False)
+        randomstate = np.random.RandomState(2)
+        self.snp_count, self.study_count = 60, 7
+        self.ste = np.sqrt(randomstate.uniform(0.1, 1.0, (self.snp_count, self.study_count)))
+        tau = randomstate.uniform(0.0, 0.5, self.snp_count)
+        self.beta = randomstate.randn(self.snp_count, self.study_count) * np.sqrt(self.ste**2 + tau[:,np.newaxis]) + randomstate.randn(self.snp_count, 1) * 0.3
+
+    tempout_dir = "tempout/meta_analysis"
+
+    def file_name(self,testcase_name):
+        temp_fn = os.path.join(self.tempout_dir,testcase_name)
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        return temp_fn
+
+    def test_matches_one_snp_at_a_time(self):
+        fe = FixefEffects(beta=self.beta, ste=self.ste)
+        re = RandomEffects(beta=self.beta, ste=self.ste)
+        for snp_index in [0, 17, self.snp_count-1]:
+            fe_one = FixefEffects(beta=self.beta[snp_index], ste=self.ste[snp_index])
+            re_one = RandomEffects(beta=self.beta[snp_index], ste=self.ste[snp_index])
+            self.assertAlmostEqual(fe.meta_pvalue()[snp_index], fe_one.meta_pvalue())
+            self.assertAlmostEqual(re.tau[snp_index], re_one.tau, places=4)
+            self.assertAlmostEqual(re.meta_pvalue()[snp_index], re_one.meta_pvalue(), places=4)
+
+    def test_tau_is_optimal(self):
+        re = RandomEffects(beta=self.beta, ste=self.ste)
+        meta = MetaAnalysis(beta=self.beta, ste=self.ste)
+        maxval = (self.beta * self.beta).mean(-1)
+        grid = np.linspace(0, 1, 201)[:,np.newaxis] * maxval
+        best_on_grid = meta.log_likelihood(tau=grid, reml=True).max(0)
+        assert (meta.log_likelihood(tau=re.tau, reml=True) >= best_on_grid - 1e-6).all()
+
+    def test_heterogeneity(self):
+        fe = FixefEffects(beta=self.beta, ste=self.ste)
+        weights = 1.0 / self.ste**2
+        mean_beta = (weights * self.beta).sum(1) / weights.sum(1)
+        q = (weights * (self.beta - mean_beta[:,np.newaxis])**2).sum(1)
+        np.testing.assert_array_almost_equal(fe.cochran_q(), q)
+        np.testing.assert_array_almost_equal(fe.i_squared(), np.maximum(0, (q - (self.study_count-1)) / q))
+
+    def test_missing_studies(self):
+        beta, ste = self.beta.copy(), self.ste.copy()
+        beta[3,0:2] = np.nan
+        ste[5,4] = np.nan
+        frame = meta_analysis(beta, ste, chunk_size=16)
+        assert frame['StudyCount'][3] == self.study_count - 2
+        assert frame['StudyCount'][5] == self.study_count - 1
+        subset = [0, 1, 2, 3, 5, 6]
+        re_five = RandomEffects(beta=self.beta[5,subset], ste=self.ste[5,subset])
+        self.assertAlmostEqual(frame['Tau'][5], re_five.tau, places=6)
+        self.assertAlmostEqual(frame['RandomPValue'][5], re_five.meta_pvalue(), places=6)
+
+    def test_files(self):
+        sid = np.array(['snp{0}'.format(i) for i in range(self.snp_count)])
+        file_name_list = []
+        for study_index in range(self.study_count):
+            keep = np.arange(self.snp_count) != study_index #each study lacks one SNP
+            study = pd.DataFrame({'SNP': sid[keep], 'Chr': 1, 'ChrPos': np.arange(self.snp_count)[keep],
+                                  'PValue': 0.5, 'SnpWeight': self.beta[keep, study_index], 'SnpWeightSE': self.ste[keep, study_index]})
+            file_name = self.file_name("study{0}.txt".format(study_index))
+            study.iloc[::-1].to_csv(file_name, sep="\t", index=False)
+            file_name_list.append(file_name)
+
+        output_file_name = self.file_name("meta.txt")
+        frame = meta_analysis_files(file_name_list, output_file_name=output_file_name, read_chunk_size=13)
+        assert len(frame) == self.snp_count
+        assert (frame['RandomPValue'].values[:-1] <= frame['RandomPValue'].values[1:]).all()
+        row = frame.set_index('SNP').loc['snp20']
+        assert row['StudyCount'] == self.study_count
+        self.assertAlmostEqual(row['FixedPValue'], FixefEffects(beta=self.beta[20], ste=self.ste[20]).meta_pvalue())
+        self.assertAlmostEqual(row['ChrPos'], 20)
+        assert len(pd.read_csv(output_file_name, sep="\t")) == self.snp_count
+
+    def test_files_match_in_memory(self):
+        randomstate = np.random.RandomState(5)
+        sid = np.array(['snp{0}'.format(i) for i in range(self.snp_count)])
+        beta, ste = self.beta.copy(), self.ste.copy()
+        file_name_list = []
+        for study_index in range(self.study_count):
+            keep = randomstate.rand(self.snp_count) < 0.8 #each study lacks some SNPs
+            beta[~keep, study_index] = np.nan
+            ste[~keep, study_index] = np.nan
+            study = pd.DataFrame({'SNP': sid[keep], 'Chr': 1, 'ChrPos': np.arange(self.snp_count)[keep],
+                                  'SnpWeight': self.beta[keep, study_index], 'SnpWeightSE': self.ste[keep, study_index]})
+            file_name = self.file_name("shuffled_study{0}.txt".format(study_index))
+            study.sample(frac=1, random_state=study_index).to_csv(file_name, sep="\t", index=False)
+            file_name_list.append(file_name)
+
+        expected = meta_analysis(beta, ste, sid=sid).set_index('SNP')
+        for read_chunk_size in [7, 1000]: #many pieces and buckets, one of each
+            frame = meta_analysis_files(file_name_list, read_chunk_size=read_chunk_size, chunk_size=9).set_index('SNP').loc[sid]
+            np.testing.assert_array_equal(frame['ChrPos'].values, np.arange(self.snp_count))
+            for column in expected.columns:
+                np.testing.assert_allclose(frame[column].values, expected[column].values, rtol=1e-7, atol=1e-12, err_msg=column) #tau's batched search depends a little on the chunk
+
+
+def getTestSuite():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestMetaAnalysis)
+    return unittest.TestSuite([suite1])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    suites = getTestSuite()
+    r = unittest.TextTestRunner(failfast=False)
+    ret = r.run(suites)
+    assert ret.wasSuccessful()
@@ -12,7 +12,7 @@ from fastlmm.association import single_snp
 from fastlmm.association import single_snp_linreg
 import pysnptools.util.pheno as pstpheno
 from fastlmm.feature_selection.test import TestFeatureSelection
-from pysnptools.util.mapreduce1.runner import Local, LocalMultiProc
+from pysnptools.util.mapreduce1.runner import Local, LocalMultiProc, LocalMultiThread
 from pysnptools.kernelreader import  Identity as KernelIdentity
 from pysnptools.standardizer import Unit
 from pysnptools.snpreader import Bed, Pheno, SnpData
@@ -313,6 +313,63 @@ class TestSingleSnp(unittest.TestCase):
 
         self.compare_files(frame,"interact")
 
+    def test_interact_list(self):
+        logging.info("TestSingleSnp test_interact_list")
+        test_snps = Bed(self.bedbase, count_A1=False)[:,:10]
+        covar = Pheno(self.cov_fn)
+        covar = SnpData(iid=covar.iid, sid=["cov0","cov1","cov2"], val=np.c_[covar.read().val, np.sin(np.arange(covar.iid_count))])
+
+        frame = single_snp(test_snps=test_snps, pheno=self.phen_fn, mixing=0, leave_out_one_chrom=False,
+                           G0=test_snps, covar=covar, interact_with_snp=[2,0,1], count_A1=False)
+        assert len(frame) == 30 and set(frame['Interaction']) == {"cov0","cov1","cov2"}
+
+        for interact_with_snp in [0,1,2]:
+            single_frame = single_snp(test_snps=test_snps, pheno=self.phen_fn, mixing=0, leave_out_one_chrom=False,
+                                      G0=test_snps, covar=covar, interact_with_snp=interact_with_snp, count_A1=False)
+            list_frame = frame[frame['Interaction']==covar.sid[interact_with_snp]].set_index('SNP').loc[single_frame.SNP]
+            for column in ['PValue','SnpWeight','SnpWeightSE','Nullh2']:
+                np.testing.assert_allclose(list_frame[column].values, single_frame[column].values, rtol=1e-10)
+
+    def test_incremental(self):
+        logging.info("TestSingleSnp test_incremental")
+        single_snp_module = sys.modules[single_snp.__module__]
+        snpdata = Bed(self.bedbase, count_A1=False)[:,:10].read()
+        test_snps = SnpData(iid=snpdata.iid, sid=["{0:03d}".format(i) for i in range(10)], val=snpdata.val, pos=snpdata.pos) #SNP names that look like numbers
+        pheno = Pheno(self.phen_fn).read()
+        pheno2 = SnpData(iid=pheno.iid, sid=["pheno1","pheno2"], val=np.c_[pheno.val, pheno.val[::-1]])
+        output_file = self.file_name("incremental")
+        cache_file = os.path.join(self.tempout_dir, "incremental_cache.npz")
+        for file in [cache_file, cache_file+".extra.npz"]:
+            if os.path.exists(file):
+                os.remove(file)
+
+        single_snp(test_snps=test_snps[:,:7], pheno=pheno2[:,:1], G0=test_snps, covar=self.cov_fn, mixing=0, leave_out_one_chrom=False,
+                   output_file_name=output_file, cache_file=cache_file, count_A1=False)
+        for pheno_incremental, tested in [(pheno2[:,:1], [(3, ["pheno1"])]), (pheno2, [(10, ["pheno2"])]), (pheno2, [])]: # add SNPs, then a phenotype, then nothing
+            with patch.object(single_snp_module, "_internal_single", wraps=single_snp_module._internal_single) as internal_single:
+                frame = single_snp(test_snps=test_snps, pheno=pheno_incremental, covar=self.cov_fn, mixing=0, leave_out_one_chrom=False,
+                                   output_file_name=output_file, cache_file=cache_file, count_A1=False, incremental=True)
+            assert [(call[1]['test_snps'].sid_count, list(call[1]['pheno'].sid)) for call in internal_single.call_args_list] == tested
+        frame_full = single_snp(test_snps=test_snps, pheno=pheno2, covar=self.cov_fn, mixing=0, leave_out_one_chrom=False, count_A1=False)
+
+        frame_file = pd.read_csv(output_file, delimiter="\t", dtype={'SNP': str}).set_index(['Pheno','SNP']).sort_index()
+        frame_full = frame_full.set_index(['Pheno','SNP']).sort_index()
+        assert len(frame) == 20 and (frame_file.index == frame_full.index).all()
+        assert (frame_file['sid_index'] == frame_full['sid_index']).all() and (frame_file['PhenoCount'] == 2).all()
+        np.testing.assert_allclose(frame_file['PValue'].values, frame_full['PValue'].values, rtol=1e-7)
+
+        # A cache of the earlier run's (smaller) default kernel isn't used for the new SNPs
+        os.remove(output_file)
+        os.remove(cache_file)
+        single_snp(test_snps=test_snps[:,:7], pheno=pheno2[:,:1], covar=self.cov_fn, mixing=0, leave_out_one_chrom=False,
+                   output_file_name=output_file, cache_file=cache_file, count_A1=False)
+        frame = single_snp(test_snps=test_snps, pheno=pheno2[:,:1], covar=self.cov_fn, mixing=0, leave_out_one_chrom=False,
+                           output_file_name=output_file, cache_file=cache_file, count_A1=False, incremental=True)
+        frame_new = frame[frame['SNP'].isin(test_snps.sid[7:])].set_index('SNP').sort_index()
+        frame_full = single_snp(test_snps=test_snps, pheno=pheno2[:,:1], covar=self.cov_fn, mixing=0, leave_out_one_chrom=False, count_A1=False)
+        frame_full = frame_full[frame_full['SNP'].isin(test_snps.sid[7:])].set_index('SNP').sort_index()
+        np.testing.assert_allclose(frame_new['PValue'].values, frame_full['PValue'].values, rtol=1e-7)
+
     def test_preload_files(self):
         logging.info("TestSingleSnp test_preload_files")
         test_snps = self.bedbase
@@ -581,7 +638,58 @@ class TestSingleSnpLeaveOutOneChrom(unittest.TestCase):
 
             self.compare_files(frame,"one_looc")
 
+    def test_runner_balanced(self):
+        logging.info("TestRunner balanced")
+        single_snp_module = sys.modules[single_snp.__module__]
+        test_snps = Bed(self.bedbase, count_A1=False)
+        pheno = self.phen_fn
+        covar = self.cov_fn
+        cache_file = os.path.join(self.tempout_dir, "runner_balanced_cache")
+        for chrom in set(test_snps.pos[:,0]):
+            if os.path.exists(f"{cache_file}.{chrom}.npz"):
+                os.remove(f"{cache_file}.{chrom}.npz")
 
+        with patch.object(single_snp_module, "_loco_schedule", wraps=single_snp_module._loco_schedule) as loco_schedule:
+            frame = single_snp(test_snps, pheno,
+                                      covar=covar, mixing=0,
+                                      count_A1=False, cache_file=cache_file,
+                                      runner=LocalMultiThread(3)
+                                      )
+        assert loco_schedule.call_count == 1
+
+        self.compare_files(frame,"one_looc")
+        frame_local = single_snp(test_snps, pheno, covar=covar, mixing=0, count_A1=False)
+        assert (frame['sid_index'].sort_index() == frame_local.set_index('SNP')['sid_index'].sort_index()).all() #compare_files indexed frame by SNP
+
+        # Without a cache_file, full-rank null models aren't cached to temp disk, so chromosomes aren't split, but low-rank ones are
+        for test_snps_case, split in [(test_snps, False), (test_snps[:,::40], True)]:
+            with patch.object(single_snp_module, "_loco_schedule", wraps=single_snp_module._loco_schedule) as loco_schedule:
+                frame = single_snp(test_snps_case, pheno, covar=covar, mixing=0, count_A1=False, runner=LocalMultiThread(3))
+            assert loco_schedule.call_count == int(split)
+            frame_local = single_snp(test_snps_case, pheno, covar=covar, mixing=0, count_A1=False)
+            pd.testing.assert_frame_equal(frame.sort_values("SNP").reset_index(drop=True), frame_local.sort_values("SNP").reset_index(drop=True))
+
+        # With thresholds, the kept rows (and PValueCount) don't depend on the runner
+        frame = single_snp(test_snps, pheno, covar=covar, mixing=0, count_A1=False, random_threshold=.1, random_seed=5, runner=LocalMultiThread(3))
+        frame_local = single_snp(test_snps, pheno, covar=covar, mixing=0, count_A1=False, random_threshold=.1, random_seed=5)
+        pd.testing.assert_frame_equal(frame.sort_values("SNP").reset_index(drop=True), frame_local.sort_values("SNP").reset_index(drop=True))
+
+
+
+    def test_kernel_store(self):
+        logging.info("TestSingleSnpLeaveOutOneChrom test_kernel_store")
+        from fastlmm.util.matrix.kernel_store import ChromKernelStore
+        test_snps = Bed(self.bedbase, count_A1=False)[:,::4]
+        kernel_store = os.path.join(self.tempout_dir, "kernel_store.kernels")
+        if os.path.exists(kernel_store + ".npz"):
+            ChromKernelStore(kernel_store).remove()
+
+        frame_default = single_snp(test_snps, self.phen_fn, covar=self.cov_fn, mixing=0, count_A1=False)
+        for written in [True, False]: # the second run reuses the store
+            with patch.object(ChromKernelStore, "write", wraps=ChromKernelStore.write) as write:
+                frame = single_snp(test_snps, self.phen_fn, covar=self.cov_fn, mixing=0, count_A1=False, kernel_store=kernel_store)
+            assert write.call_count == int(written)
+            pd.testing.assert_series_equal(frame.set_index('SNP')['PValue'].sort_index(), frame_default.set_index('SNP')['PValue'].sort_index(), rtol=1e-6)
 
     def test_multipheno(self):
         logging.info("TestSingleSnpLeaveOutOneChrom test_multipheno")
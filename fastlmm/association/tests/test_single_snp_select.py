@@ -158,6 +158,28 @@ class TestSingleSnpSelect(unittest.TestCase):
             pvalue = frame[frame['SNP'] == sid].iloc[0].PValue
             assert abs(row.PValue - pvalue) < 1e-5, "pair {0} differs too much from file '{1}'".format(sid,reffile)
 
+    def test_top_snps_for_each_fold(self):
+        from fastlmm.association import single_snp_linreg
+        from fastlmm.association.single_snp_select import _top_snps_for_each_fold
+        from fastlmm.association.single_snp_all_plus_select import _kfold
+
+        randomstate = np.random.RandomState(1)
+        iid_count, sid_count = 200, 150
+        val = randomstate.randint(0,3,(iid_count,sid_count)).astype(float)
+        val[randomstate.rand(iid_count,sid_count)<.1] = np.nan
+        val[:,7] = 1.0 #constant SNP
+        iid = np.array([['f',str(i)] for i in range(iid_count)])
+        G = SnpData(iid=iid,sid=['s{0}'.format(i) for i in range(sid_count)],val=val,pos=np.c_[np.ones(sid_count),np.arange(sid_count),np.arange(sid_count)])
+        pheno = SnpData(iid=iid,sid=['y'],val=(np.nan_to_num(val[:,3],nan=1.0)+randomstate.randn(iid_count))[:,np.newaxis])
+        covar = SnpData(iid=iid,sid=['c1','c2'],val=randomstate.randn(iid_count,2))
+
+        kfold_list = list(_kfold(iid_count, 4, 0, end_with_all=True, iid_to_index=G.iid_to_index))
+        top_snps_list = _top_snps_for_each_fold(G, pheno, covar, kfold_list, max_output_len=40, GB_goal=iid_count*8*30/1024.**3) #blocks of 30 SNPs
+        assert len(top_snps_list) == len(kfold_list)
+        for (_, (train_idx, _)), top_snps in zip(kfold_list, top_snps_list):
+            frame = single_snp_linreg(G[train_idx,:],pheno[train_idx,:],covar[train_idx,:],max_output_len=40)
+            assert list(frame['SNP']) == top_snps
+
     def test_doctest(self):
         old_dir = os.getcwd()
         os.chdir(os.path.dirname(os.path.realpath(__file__))+"/..")
@@ -117,6 +117,61 @@ class TestSnpSet(unittest.TestCase):
         out,msg=ut.compare_files(tmpOutfile, referenceOutfile, tolerance)                
         self.assertTrue(out, "msg='{0}', ref='{1}', tmp='{2}'".format(msg, referenceOutfile, tmpOutfile))
 
+    def test_set_cache(self):
+        from fastlmm.association.SnpSetCache import SnpSetCache
+        from fastlmm.pyplink.snpreader.Bed import Bed
+        from fastlmm.pyplink.altset_list import SnpAndSetNameCollection
+        import fastlmm.util.preprocess as util
+
+        bed = Bed(self.currentFolder+'/../../../tests/datasets/all_chr.maf0.001.N300')
+        altsetlist_plusbed = SnpAndSetNameCollection(self.currentFolder+'/../../../tests/datasets/set_input.small.txt').addbed(bed)
+        rotate = lambda SNPs: (SNPs['snps'][:10,:]*2.0, None) #any column-wise function
+        item_list = list(SnpSetCache(altsetlist_plusbed, max_snp_count=25, rotate=rotate))
+        assert [iset for iset, _, _, _ in item_list] == list(range(len(altsetlist_plusbed)))
+        for iset, altset, SNPsalt, rotated in item_list:
+            expected = altset.read()
+            expected['snps'] = util.standardize(expected['snps'])
+            np.testing.assert_array_almost_equal(SNPsalt['snps'], expected['snps'])
+            assert list(SNPsalt['rs']) == list(expected['rs'])
+            np.testing.assert_array_equal(SNPsalt['iid'], expected['iid'])
+            np.testing.assert_array_almost_equal(rotated[0], expected['snps'][:10,:]*2.0)
+            assert rotated[1] is None
+
+    def test_set_cache_rotated(self):
+        from unittest.mock import patch
+        from fastlmm.association.FastLmmSet import FastLmmSet
+        from fastlmm.association.score import scoretest2K
+
+        datasets = self.currentFolder+'/../../../tests/datasets/'
+        sid = pd.read_csv(datasets+'all_chr.maf0.001.N300.bim',delimiter=r'\s+',header=None)[1]
+        sid = [s for s in sid if s.startswith('1_')][:60]
+        set_file = self.file_name("set_cache_rotated_sets.txt")
+        with open(set_file,"w") as fp: #overlapping windows of 20 SNPs
+            fp.write("snp\tgroup\n")
+            for iset, start in enumerate(range(0,50,10)):
+                for s in sid[start:start+20]:
+                    fp.write("{0}\tset{1}\n".format(s,iset))
+
+        def run_sc_mom(fn):
+            output_file_name = self.file_name(fn)
+            fast_lmm_set = FastLmmSet(outfile=output_file_name, phenofile=datasets+'phenSynthFrom22.23.N300.txt',
+                                      alt_snpreader=datasets+'all_chr.maf0.001.N300', altset_list=set_file, covarfile=None,
+                                      filenull=datasets+'all_chr.maf0.001.chr22.23.N300.bed', nperm=0, mindist=0, idist=1,
+                                      mpheno=1, nullfit="qq", qmax=0.1, test="sc_mom", autoselect=False,
+                                      nullModel={'effect':'mixed', 'link':'linear'}, altModel={'effect':'mixed', 'link':'linear'})
+            Local().run(fast_lmm_set)
+            return pd.read_csv(output_file_name,delimiter='\t',comment=None)
+
+        with patch.object(scoretest2K, 'rotate', autospec=True, side_effect=scoretest2K.rotate) as rotate:
+            batched = run_sc_mom("set_cache_rotated_batched.txt")
+            assert rotate.call_count == 1 #the whole batch is projected once
+        with patch.object(FastLmmSet, 'rotate_closure', return_value=None), patch.object(scoretest2K, 'rotate', autospec=True, side_effect=scoretest2K.rotate) as rotate:
+            unbatched = run_sc_mom("set_cache_rotated_unbatched.txt")
+            assert rotate.call_count == len(unbatched) #each set is projected by itself
+        assert len(batched) > 1
+        assert list(batched['SetId']) == list(unbatched['SetId'])
+        np.testing.assert_allclose(batched['P-value'], unbatched['P-value'], rtol=1e-12, atol=1e-14)
+
     def test_doctest(self):
         result = doctest.testmod(sys.modules['fastlmm.association.snp_set'])
         assert result.failed == 0, "failed doc test: " + __file__
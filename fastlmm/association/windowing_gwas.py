@@ -52,10 +52,10 @@ class WindowingGwas(object):
        
         self.lmm = None
         self.res_null = None
-        self.res_alt = []
 
         self.ll_null = np.zeros(self.n_test)
         self.ll_alt = np.zeros(self.n_test)
+        self.beta_alt = np.zeros(self.n_test)
         self.p_values = np.zeros(self.n_test)
         self.sorted_p_values = np.zeros(self.n_test)
 
@@ -103,8 +103,8 @@ class WindowingGwas(object):
         #self.delta = np.exp(result['log_delta'])
 
         if self.delta is None:
-            result = self.lmm.find_log_delta_chris()
-            self.delta = result['delta']
+            result = self.lmm.find_log_delta(sid_count=1, REML=self.REML)
+            self.delta = np.exp(result['log_delta'])
 
 
 
@@ -131,33 +131,132 @@ class WindowingGwas(object):
             self.lmm.UUX = self.UUX[:,0:self.n_cov]
     
 
-    def train_windowing(self):
+    def train_windowing(self, blocksize=1000):
         """
         train null and alternative model
+
+        For each test SNP the null model (covariates only) and the alternative model (covariates and the SNP) are
+        evaluated with that SNP excluded from the kernel. The exclusion is a rank-one downdate (Supplement Note 2 of
+        Lippert et al. 2011), so it is applied to blocksize SNPs at a time with array operations on the precomputed UX.
         """ 
    
         assert self.lmm != None
         self.precompute_UX(self.X)
 
-        for idx in range(self.n_test):
-
-            #TODO: this can be generalized to bigger window
-            self.lmm.set_exclude_idx([idx])
-
-            # null model
-            self.set_null_UX()
-            res = self.lmm.nLLeval(delta=self.delta, REML=self.REML)
-            self.ll_null[idx] = -res["nLL"]
-
-            # alternative model
-            self.set_current_UX(idx)
-            res = self.lmm.nLLeval(delta=self.delta, REML=self.REML)
-
-            self.res_alt.append(res)
-            self.ll_alt[idx] = -res["nLL"]
-
-            if idx % 1000 == 0:
-                logging.warning("processing snp {0}".format(idx))
+        n_cov = self.n_cov
+        low_rank = self.k < self.N
+        Sd = self.lmm.S + self.delta
+        denom = self.delta
+        UC = self.UX[:,0:n_cov]
+        UCS = UC / Sd[:,np.newaxis]
+        UyS = self.lmm.Uy / Sd
+        CKC = UCS.T.dot(UC)
+        CKy = UCS.T.dot(self.lmm.Uy)
+        yKy = UyS.dot(self.lmm.Uy)
+        logdetK = np.log(Sd).sum()
+        if low_rank:
+            UUC = self.UUX[:,0:n_cov]
+            CKC += UUC.T.dot(UUC) / denom
+            CKy += UUC.T.dot(self.lmm.UUy) / denom
+            yKy += self.lmm.UUy.dot(self.lmm.UUy) / denom
+            logdetK += (self.N - self.k) * np.log(denom)
+        CC = self.cov.T.dot(self.cov)
+        # without a second kernel the excluded SNPs are the test SNPs, whose rotations are already in UX
+        exclude_is_test = self.lmm.G is self.test_snps
+
+        for start in range(0, self.n_test, blocksize):
+            end = min(start + blocksize, self.n_test)
+            logging.info("processing snps {0} to {1}".format(start, end))
+
+            # rotate the excluded kernel SNPs and find their squared forms with covariates, test SNPs and phenotype
+            Ux = self.UX[:,n_cov+start:n_cov+end]
+            if exclude_is_test:
+                UW = Ux
+            else:
+                G_exclude = self.lmm.G[:,start:end]
+                UW = self.lmm.U.T.dot(G_exclude)
+            UWS = UW / Sd[:,np.newaxis]
+            UxS = Ux / Sd[:,np.newaxis]
+            WW = 1.0 - (UWS * UW).sum(0)
+            WC = UWS.T.dot(UC)
+            Wy = UWS.T.dot(self.lmm.Uy)
+            Wx = (UWS * Ux).sum(0)
+            CKx = UCS.T.dot(Ux)
+            xKx = (UxS * Ux).sum(0)
+            xKy = UxS.T.dot(self.lmm.Uy)
+            if low_rank:
+                UUx = self.UUX[:,n_cov+start:n_cov+end]
+                UUW = UUx if exclude_is_test else G_exclude - self.lmm.U.dot(UW)
+                WW += (UUW * UUW).sum(0) / denom
+                WC += UUW.T.dot(UUC) / denom
+                Wy += UUW.T.dot(self.lmm.UUy) / denom
+                Wx += (UUW * UUx).sum(0) / denom
+                CKx += UUC.T.dot(UUx) / denom
+                xKx += (UUx * UUx).sum(0) / denom
+                xKy += UUx.T.dot(self.lmm.UUy) / denom
+
+            # alternative design [covariates, snp], the null model uses its leading n_cov rows and columns
+            WX = np.hstack((WC, Wx[:,np.newaxis]))
+            XKX = np.empty((end-start, n_cov+1, n_cov+1))
+            XKX[:,0:n_cov,0:n_cov] = CKC
+            XKX[:,0:n_cov,n_cov] = CKx.T
+            XKX[:,n_cov,0:n_cov] = CKx.T
+            XKX[:,n_cov,n_cov] = xKx
+            XKy = np.hstack((np.tile(CKy, (end-start, 1)), xKy[:,np.newaxis]))
+
+            # rank-one downdate for excluding the SNP from the kernel
+            XKX += WX[:,:,np.newaxis] * WX[:,np.newaxis,:] / WW[:,np.newaxis,np.newaxis]
+            XKy += WX * (Wy / WW)[:,np.newaxis]
+            yKy_block = yKy + Wy * Wy / WW
+            logdetK_block = logdetK + np.log(WW)
+
+            if self.REML:
+                X_snps = self.X[:,n_cov+start:n_cov+end]
+                XX = np.empty((end-start, n_cov+1, n_cov+1))
+                XX[:,0:n_cov,0:n_cov] = CC
+                Cx = self.cov.T.dot(X_snps)
+                XX[:,0:n_cov,n_cov] = Cx.T
+                XX[:,n_cov,0:n_cov] = Cx.T
+                XX[:,n_cov,n_cov] = (X_snps * X_snps).sum(0)
+            else:
+                XX = None
+
+            nLL_null, _ = self._nLL_batch(XKX[:,0:n_cov,0:n_cov], XKy[:,0:n_cov], yKy_block, logdetK_block, None if XX is None else XX[:,0:n_cov,0:n_cov])
+            nLL_alt, beta_alt = self._nLL_batch(XKX, XKy, yKy_block, logdetK_block, XX)
+            self.ll_null[start:end] = -nLL_null
+            self.ll_alt[start:end] = -nLL_alt
+            self.beta_alt[start:end] = beta_alt[:,n_cov]
+
+
+    def _nLL_batch(self, XKX, XKy, yKy, logdetK, XX=None):
+        """
+        negative log-likelihoods for a batch of models, as in LMM.nLLeval (Gaussian, delta parameterization)
+        --------------------------------------------------------------------------
+        Input:
+        XKX     : [B*D*D] array of X^T K^-1 X
+        XKy     : [B*D] array of X^T K^-1 y
+        yKy     : [B] array of y^T K^-1 y
+        logdetK : [B] array of log-determinants of K
+        XX      : [B*D*D] array of X^T X (only needed for REML)
+        --------------------------------------------------------------------------
+        """
+        N = self.N
+        D = XKX.shape[1]
+        SxKx, UxKx = np.linalg.eigh(XKX)
+        i_pos = SxKx > 1E-10
+        UxKxy = np.einsum('bij,bi->bj', UxKx, XKy)
+        scaled = np.where(i_pos, UxKxy / np.where(i_pos, SxKx, 1.0), 0.0)
+        beta = np.einsum('bij,bj->bi', UxKx, scaled)
+        r2 = yKy - (XKy * beta).sum(1)
+        if self.REML:
+            logdetXX = np.log(np.linalg.eigvalsh(XX)).sum(1)
+            logdetXKX = np.log(SxKx).sum(1)
+            sigma2 = r2 / (N - D)
+            nLL = 0.5 * (logdetK + logdetXKX - logdetXX + (N - D) * (np.log(2.0 * np.pi * sigma2) + 1))
+        else:
+            sigma2 = r2 / N
+            nLL = 0.5 * (logdetK + N * (np.log(2.0 * np.pi * sigma2) + 1))
+        return nLL, beta
 
 
     def compute_p_values(self):
@@ -167,11 +266,8 @@ class WindowingGwas(object):
 
         degrees_of_freedom = 1
 
-        assert len(self.res_alt) == self.n_test
-
-        for idx in range(self.n_test):
-            test_statistic = self.ll_alt[idx] - self.ll_null[idx]
-            self.p_values[idx] = stats.chi2.sf(2.0 * test_statistic, degrees_of_freedom)
+        test_statistic = self.ll_alt - self.ll_null
+        self.p_values = stats.chi2.sf(2.0 * test_statistic, degrees_of_freedom)
 
         self.p_idx = np.argsort(self.p_values)
         self.sorted_p_values = self.p_values[self.p_idx]
@@ -188,8 +284,7 @@ class WindowingGwas(object):
         pylab.semilogy(self.p_values)
         pylab.show()
 
-        dummy = [self.res_alt[idx]["nLL"] for idx in range(self.n_test)]
-        pylab.hist(dummy, bins=100)
+        pylab.hist(-self.ll_alt, bins=100)
         pylab.title("neg likelihood")
         pylab.show()
 
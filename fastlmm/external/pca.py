@@ -319,6 +319,89 @@ class PCA(BaseEstimator, TransformerMixin):
 
         return U, S, V, self.mean_
 
+    def _fit_truncated(self, X, max_components, S=None, V=None, mean=None, total_variance=None):
+        """ Fit the model on X using only the leading max_components of its spectrum
+        Parameters
+        ----------
+        X: array-like, shape (n_samples, n_features)
+            Training vector, where n_samples in the number of samples and
+            n_features is the number of features.
+
+        max_components: int
+            The number of leading singular values/vectors to compute. Must
+            be at least self.n_components.
+
+        S, V, mean, total_variance:
+            The values returned by a previous call on the same X. When given,
+            no decomposition is done, so fits for every n_components up to
+            max_components can share a single decomposition.
+
+        Returns
+        -------
+        S, V, mean, total_variance : ndarrays and float
+            The leading singular values and right singular vectors of the
+            centered data, its column means and its total variance.
+
+        The noise variance only needs the sum of the trailing spectrum, which is
+        the total variance minus the leading part, so the result matches _fit.
+        """
+        n_samples, n_features = X.shape
+        if S is None and V is None:
+            X = as_float_array(check_array(X), copy=self.copy)
+            # Center data
+            self.mean_ = np.mean(X, axis=0)
+            X -= self.mean_
+            # eigen-decompose the smaller of the two Gram matrices
+            if n_features <= n_samples:
+                gram = X.T.dot(X)
+            else:
+                gram = X.dot(X.T)
+            total_variance = np.trace(gram) / n_samples
+            if max_components > 0:
+                eigval, eigvec = linalg.eigh(gram, subset_by_index=[gram.shape[0] - max_components, gram.shape[0] - 1])
+                S = np.sqrt(np.maximum(eigval[::-1], 0.))
+                eigvec = eigvec[:, ::-1]
+                if n_features <= n_samples:
+                    V = eigvec.T
+                else:
+                    V = eigvec.T.dot(X) / np.where(S > 0, S, 1.)[:, np.newaxis]
+            else:
+                S = np.zeros(0)
+                V = np.zeros((0, n_features))
+            mean = self.mean_
+        else:
+            assert S is not None and V is not None and total_variance is not None
+            self.mean_ = mean
+
+        n_components = self.n_components
+        assert 0 <= n_components <= len(S), "n_components must be between 0 and max_components"
+
+        explained_variance_ = (S ** 2) / n_samples
+        explained_variance_ratio_ = explained_variance_ / total_variance
+
+        if self.whiten:
+            components_ = V / (S[:, np.newaxis] / sqrt(n_samples))
+        else:
+            components_ = V
+
+        rank = min(n_samples, n_features)
+        if n_components < n_features:
+            if n_components < rank:
+                self.noise_variance_ = (total_variance - explained_variance_[:n_components].sum()) / (rank - n_components)
+            else:
+                self.noise_variance_ = np.nan
+        else:
+            self.noise_variance_ = 0.
+
+        self.n_samples_ = n_samples
+
+        self.components_ = components_[:n_components]
+        self.explained_variance_ = explained_variance_[:n_components]
+        self.explained_variance_ratio_ = explained_variance_ratio_[:n_components]
+        self.n_components_ = n_components
+
+        return S, V, self.mean_, total_variance
+
     def get_covariance(self):
         """Compute data covariance with the generative model.
 
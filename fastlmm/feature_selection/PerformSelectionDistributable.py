@@ -28,6 +28,7 @@ from sklearn.decomposition import PCA
 
 # project
 import fastlmm.pyplink.plink as plink
+from fastlmm.util.matrix.kernel_store import syrk_update, symmetrize_upper
 import pysnptools.util as pstutil
 import fastlmm.util.util as util 
 import fastlmm.util.preprocess as up
@@ -217,7 +218,18 @@ class PerformSelectionDistributable(object) : #implements IDistributable
             raise NotImplementedError("not implemented")
         
         logging.info("reporter:counter:PerformSelectionDistributable,foldcount,1")
-        for k_idx, k in enumerate(self.k_values):
+
+        # The top-k SNP sets are nested, so visit k in increasing order and grow the kernels (or the SVD of G)
+        # from the previous k instead of rebuilding them from scratch.
+        sid_count = self.feature_selection_strategy.snpreader.sid_count
+        n_train = len(fold_data["train_idx"])
+        model_lowrank, k_lowrank = None, 0 # model whose G holds the top k_lowrank cached SNPs
+        K_train_cached, Kstar_cached, k_cached = None, None, 0 # train and test-vs-train kernels from the top k_cached cached SNPs
+        K_disk, k_disk = None, 0 # kernel from the top k_disk SNPs read from file
+        G_train_val, G_test_val = None, None
+
+        for k_idx in np.argsort(self.k_values, kind="mergesort"):
+            k = self.k_values[k_idx]
             logging.info("processing fold={0}, k={1}".format(fold_idx,k))
             logging.info("reporter:status:processing fold={0}, k={1}".format(fold_idx,k))
             logging.info("reporter:counter:PerformSelectionDistributable,k,1")
@@ -225,17 +237,21 @@ class PerformSelectionDistributable(object) : #implements IDistributable
             model = fastlmm.getLMM()
 
             # compute kernel externally
-            if k == self.feature_selection_strategy.snpreader.sid_count or k >= self.feature_selection_strategy.num_snps_in_memory:
-                if k == self.feature_selection_strategy.snpreader.sid_count:
+            if k == sid_count or k >= self.feature_selection_strategy.num_snps_in_memory:
+                if k == sid_count:
                     # use precomputed kernel
                     logging.info("using precomputed kernel on all snps")
                     K = self.feature_selection_strategy.K
                 else:
-                    # build kernel in blocks from snpreader (from file)
+                    # build kernel in blocks from snpreader (from file), reading only the SNPs not in the previous k
                     logging.info("building kernel in blocks")
-                    top_k_feat_idx = fold_data["feat_idx"][0:int(k)]
-                    subset = self.feature_selection_strategy.snpreader[:,top_k_feat_idx]
-                    K = subset.kernel(self.feature_selection_strategy.standardizer,blocksize=self.feature_selection_strategy.blocksize)
+                    if k > k_disk:
+                        new_feat_idx = fold_data["feat_idx"][k_disk:int(k)]
+                        subset = self.feature_selection_strategy.snpreader[:,new_feat_idx]
+                        K_new = subset.kernel(self.feature_selection_strategy.standardizer,blocksize=self.feature_selection_strategy.blocksize)
+                        K_disk = K_new if K_disk is None else K_disk + K_new
+                        k_disk = int(k)
+                    K = K_disk
 
                 train_idx = fold_data["train_idx"]
                 test_idx = fold_data["test_idx"]
@@ -254,10 +270,33 @@ class PerformSelectionDistributable(object) : #implements IDistributable
             # use precomputed features as before
             else:
                 logging.info("using cached data to build kernel")
-                outer_G_train = fold_data["G_train"][:,0:k]
-                outer_G_test = fold_data["G_test"][:,0:k]
-                model.setG(outer_G_train.val)
-                model.setTestData(Xstar=fold_data["X_test"], G0star=outer_G_test.val)
+                if G_train_val is None:
+                    G_train_val = fold_data["G_train"].val
+                    G_test_val = fold_data["G_test"].val
+                outer_G_train = G_train_val[:,0:k]
+                outer_G_test = G_test_val[:,0:k]
+                if k < n_train:
+                    # low rank: update the SVD of G with the new SNPs
+                    if model_lowrank is None:
+                        model_lowrank = model
+                        model_lowrank.setG(outer_G_train)
+                    elif k > k_lowrank:
+                        model_lowrank.appendG(G_train_val[:,k_lowrank:k])
+                    k_lowrank = k
+                    model = model_lowrank
+                    model.setTestData(Xstar=fold_data["X_test"], G0star=outer_G_test)
+                else:
+                    # full rank: add the new SNPs' contribution to the kernels
+                    if K_train_cached is None:
+                        K_train_cached = np.zeros((n_train, n_train))
+                        Kstar_cached = np.zeros((G_test_val.shape[0], n_train))
+                    if k > k_cached:
+                        G_train_new = G_train_val[:,k_cached:k]
+                        K_train_cached += G_train_new.dot(G_train_new.T)
+                        Kstar_cached += G_test_val[:,k_cached:k].dot(G_train_new.T)
+                        k_cached = k
+                    model.setG(outer_G_train, K0=K_train_cached)
+                    model.setTestData(Xstar=fold_data["X_test"], K0star=Kstar_cached, G0star=outer_G_test)
                 K_test_test = None
 
 
@@ -340,7 +379,7 @@ def build_kernel_blocked(snpreader, snp_idx=None, blocksize=10000,alt_snpreader=
     
     t0 = time.time()
 
-    K = sp.zeros([N,N])
+    K = np.zeros([N,N],order='F')
     num_snps = alt_snpreader.snp_count
 
     if snp_idx != None:
@@ -368,7 +407,7 @@ def build_kernel_blocked(snpreader, snp_idx=None, blocksize=10000,alt_snpreader=
         snps = up.standardize(snps)
 
         #logging.info("start = {0}".format(start))
-        K += snps.dot(snps.T)
+        syrk_update(K, snps) #upper triangle only
 
         if ct % blocksize==0:
             logging.info("read %s SNPs in %.2f seconds" % (ct, time.time()-ts))
@@ -378,6 +417,7 @@ def build_kernel_blocked(snpreader, snp_idx=None, blocksize=10000,alt_snpreader=
     #K = K/sp.sqrt(alt_snpreader.snp_count)
 
     #K = K + 1e-5*sp.eye(N,N)     
+    K = symmetrize_upper(K, out=K)
     t1 = time.time()
     logging.info("%.2f seconds elapsed" % (t1-t0))
 
@@ -9,6 +9,8 @@ from fastlmm.external.util.math import stl, stu
 from sklearn.base import BaseEstimator
 from fastlmm import Pr
 import sys
+import copy
+from concurrent.futures import ThreadPoolExecutor
 from six.moves import range
 
 '''
@@ -317,14 +319,22 @@ class GLMM(object):
     def _updateApproximation(self):
         pass
 
-    def optimize(self, optSig02=True, optSig12=True, optSign2=True, optBeta=True):
+    def optimize(self, optSig02=True, optSig12=True, optSign2=True, optBeta=True, num_threads=1, seed=None):
         '''
         Minimize the cost, which is the negative of marginal loglikelihood plus the
         penalty, by adjusting the hyperparameters.
+        After a first optimization from fixed initial values, the optimization is restarted from random
+        initial values until niterNoImprov consecutive restarts do not improve the cost.
         --------------------------------------------------------------------------
         Input:
         optSig02, optSig12, optSign2, and optSigBeta can be True or False and
         are used to choose which hyperparameters are going to be optimized.
+        num_threads : number of restarts optimized concurrently, each on a shallow copy of the model
+                      that shares the kernels. Every restart warm-starts the posterior approximation from the
+                      mode found by the first optimization, so the restarts do not depend on each other and
+                      the result is the same for any num_threads. (default 1)
+        seed        : seed of the random initial values, so that the result is reproducible. If None, the values
+                      are drawn from the global numpy random generator, as NP.random.seed sets it. (default None)
         --------------------------------------------------------------------------
         '''
         self._updateConstants()
@@ -347,35 +357,64 @@ class GLMM(object):
         
         bestCost = self._optimize(lowerBound, optSig02, optSig12, optSign2, optBeta)
         bestSolution = self._wrap_hyp(True, True, True, True)
+        bestMode = self._approximation_mode()
+        initialMode = bestMode
 
-        i = 0
-        ntries = 0
-        while i < niterNoImprov:
+        randomstate = NP.random if seed is None else NP.random.RandomState(seed)
+        def draw_start():
             if optSig02:
-                self.sig02 = max(NP.random.chisquare(1), lowerBound)
+                self.sig02 = max(randomstate.chisquare(1), lowerBound)
             if optSig12:
-                self.sig12 = max(NP.random.chisquare(1), lowerBound)
+                self.sig12 = max(randomstate.chisquare(1), lowerBound)
             if optSign2:
-                self.sign2 = max(NP.random.chisquare(1), lowerBound)
+                self.sign2 = max(randomstate.chisquare(1), lowerBound)
             if optBeta:
-                self.beta = NP.random.normal(scale=betaScale, size=self._D)
-
-            cost = self._optimize(lowerBound, optSig02, optSig12, optSign2, optBeta)
-            if cost < bestCost:
-                bestCost = cost
-                bestSolution = self._wrap_hyp(True, True, True, True)
-                if abs(cost-bestCost) > tol:
-                    i = 0
+                self.beta = randomstate.normal(scale=betaScale, size=self._D)
+            return self._wrap_hyp(True, True, True, True)
+
+        def restart(start, mode):
+            model = copy.copy(self)
+            model._debugUACalls = []
+            model._unwrap_hyp(start, True, True, True, True)
+            model._set_approximation_mode(mode)
+            cost = model._optimize(lowerBound, optSig02, optSig12, optSign2, optBeta)
+            return cost, model._wrap_hyp(True, True, True, True), model._approximation_mode()
+
+        executor = ThreadPoolExecutor(num_threads) if num_threads > 1 else None
+        try:
+            i = 0
+            ntries = 0
+            while i < niterNoImprov:
+                start_list = [draw_start() for _ in range(num_threads)]
+                if executor is None:
+                    result_list = [restart(start_list[0], initialMode)]
                 else:
-                    i += 1
-            else:
-                i += 1
-            ntries += 1
+                    result_list = list(executor.map(restart, start_list, [initialMode]*num_threads))
+
+                # The results are used in the order the initial values were drawn, so the stopping rule is the same as without threads
+                for cost, solution, mode in result_list:
+                    if cost < bestCost:
+                        if abs(cost-bestCost) > tol:
+                            i = 0
+                        else:
+                            i += 1
+                        bestCost = cost
+                        bestSolution = solution
+                        bestMode = mode
+                    else:
+                        i += 1
+                    ntries += 1
+                    if i >= niterNoImprov:
+                        break
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
         #if self._verbose:
         #    Pr.prin('Number of tries: {}.'.format(ntries))
 
         self._unwrap_hyp(bestSolution, True, True, True, True)
+        self._set_approximation_mode(bestMode)
 
         # If K0 is null, marginal likelihood is independent on
         # self._sig02. Thus, let it be 0.0 by default.
@@ -388,6 +427,13 @@ class GLMM(object):
             self.sig12 = 0.0
 
         self._check_sigmas_at_zero(lowerBound, optSig02, optSig12, optSign2, optBeta)
+
+    # The state the posterior approximation starts its iterations from (None if it always starts cold).
+    def _approximation_mode(self):
+        return None
+
+    def _set_approximation_mode(self, mode):
+        pass
         
     def _optimize(self, lowerBound, optSig02=True, optSig12=True, optSign2=True, optBeta=True):
         def func(x):
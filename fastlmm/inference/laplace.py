@@ -57,6 +57,12 @@ class LaplaceGLMM(object):
         f = self._rdotK(a) + m
         return (f, a, obj)
 
+    def _approximation_mode(self):
+        return self._lasta
+
+    def _set_approximation_mode(self, mode):
+        self._lasta = mode
+
     def _calculateUAGrad(self, f, a):
         grad = self._likelihood.gradient_log(f, self._y) - a
         return grad
@@ -229,6 +235,12 @@ class LaplaceGLMM_N1K3(GLMM_N1K3, LaplaceGLMM):
     def _updateApproximation(self):
         LaplaceGLMM._updateApproximation(self)
 
+    def _approximation_mode(self):
+        return LaplaceGLMM._approximation_mode(self)
+
+    def _set_approximation_mode(self, mode):
+        LaplaceGLMM._set_approximation_mode(self, mode)
+
     def _regular_marginal_loglikelihood(self):
         self._updateConstants()
         self._updateApproximation()
@@ -478,6 +490,12 @@ class LaplaceGLMM_N3K1(GLMM_N3K1, LaplaceGLMM):
     def _updateApproximation(self):
         LaplaceGLMM._updateApproximation(self)
 
+    def _approximation_mode(self):
+        return LaplaceGLMM._approximation_mode(self)
+
+    def _set_approximation_mode(self, mode):
+        LaplaceGLMM._set_approximation_mode(self, mode)
+
     def _predict(self, meanstar, kstar, kstarstar, prob):
         return LaplaceGLMM._predict(self, meanstar, kstar, kstarstar, prob)
 
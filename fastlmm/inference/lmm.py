@@ -184,6 +184,49 @@ class LMM(object):
             self.S = SP.zeros((0))
             self.U = SP.zeros_like(self.G)
 
+    def appendG(self, G_new):
+        '''
+        append columns to the random effects G0 that were set with setG() (single kernel only).
+        While the total number of columns stays below N, the SVD of G is updated from the
+        previous one (Brand's incremental SVD) instead of being recomputed, otherwise this is setG().
+        This is useful when searching over nested sets of SNPs, e.g. the top-k SNPs for growing k.
+        The data has to be set again with setX() and sety() afterwards.
+        --------------------------------------------------------------------------
+        Input:
+        G_new           : [N*k_new] array of random effects to append to G0
+        --------------------------------------------------------------------------
+        '''
+        assert self.G1 is None, "appendG only supports a single kernel"
+        if self.G0 is None:
+            self.setG(G0=G_new)
+            return
+        G = NP.hstack((self.G0, G_new))
+        N = G.shape[0]
+        k_old = self.G0.shape[1]
+        if self.forcefullrank or G.shape[1] >= N or k_old == 0 or self.S is None or self.S.shape[0] != k_old:
+            self.setG(G0=G)
+            return
+
+        # G = [U,Q] * [[diag(s), U^T*G_new],[0, R]] * blockdiag(V^T,I), so only the small middle matrix needs an SVD
+        s = NP.sqrt(NP.maximum(self.S, 0.0))
+        UG_new = self.U.T.dot(G_new)
+        resid = G_new - self.U.dot(UG_new)
+        UResid = self.U.T.dot(resid) # one reorthogonalization step keeps Q orthogonal to U
+        resid -= self.U.dot(UResid)
+        UG_new += UResid
+        Q, R = LA.qr(resid, mode='economic')
+        k_new = G_new.shape[1]
+        M = NP.zeros((k_old + k_new, k_old + k_new))
+        M[:k_old, :k_old] = NP.diag(s)
+        M[:k_old, k_old:] = UG_new
+        M[k_old:, k_old:] = R
+        [U_M, S_M, V_M] = LA.svd(M, full_matrices=False)
+        self.U = NP.hstack((self.U, Q)).dot(U_M)
+        self.S = S_M * S_M
+        self.G0 = G
+        self.G = G
+        self.a2 = 0.0
+
 
     def setK(self, K0, K1=None, a2=0.0):
         '''
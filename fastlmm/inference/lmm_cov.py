@@ -406,7 +406,7 @@ class LMM(object):
         res['log_delta'] = ln_external_delta
         return res
 
-    def findH2(self, nGridH2=10, minH2=0.0, maxH2=0.99999, estimate_Bayes=False, **kwargs):
+    def findH2(self, nGridH2=10, minH2=0.0, maxH2=0.99999, estimate_Bayes=False, vectorized=False, **kwargs):
         '''
         Find the optimal h2 for a given K. Note that this is the single kernel case. So there is no a2.
         (default maxH2 value is set to a value smaller than 1 to avoid loss of positive definiteness of the final model covariance)
@@ -415,11 +415,18 @@ class LMM(object):
             minH2   : minimum value for h2 optimization (default: 0.0)
             maxH2   : maximum value for h2 optimization (default: 0.99999)
             estimate_Bayes: implement me!   (default: False)
+            vectorized: evaluate the whole h2 grid with one call to nLLeval_batch and refine every phenotype's h2
+                        with a batched Brent search (see mingrid.minimize1D_batch). Only the dof and scale keyword
+                        arguments are supported. With several phenotypes, each phenotype gets its own refined h2
+                        instead of its best grid point. (default: False)
 
         Returns:
             dictionary containing the model parameters at the optimal h2
         '''
         #f = lambda x : (self.nLLeval(h2=x,**kwargs)['nLL'])
+        if vectorized:
+            assert estimate_Bayes == False, "not implemented"
+            return self._findH2_vectorized(nGridH2=nGridH2, minH2=minH2, maxH2=maxH2, **kwargs)
         resmin = [None for i in range(self.Y.shape[1])]
         #logging.info("starting H2 search")
         assert estimate_Bayes == False, "not implemented"
@@ -457,19 +464,98 @@ class LMM(object):
             min = minimize1D(f=f, nGrid=nGridH2, minval=minH2, maxval=maxH2)
             return resmin[0]
 
-    def posterior_h2(self, nGridH2=1000, minH2=0.0, maxH2=0.99999, **kwargs):
+    def _findH2_vectorized(self, nGridH2=10, minH2=0.0, maxH2=0.99999, **kwargs):
+        assert set(kwargs.keys()) <= set(['dof','scale']), "the vectorized h2 search only supports the dof and scale arguments"
+        P = self.Y.shape[1]
+        def f(x):
+            return self.nLLeval_batch(h2=x, **kwargs)
+        h2opt, _ = minimize1D_batch(f=f, nGrid=nGridH2, minval=minH2, maxval=maxH2)
+        if P == 1:
+            return self.nLLeval(h2=h2opt[0], **kwargs)
+        resmin = []
+        for i in range(P):
+            res = self.nLLeval(h2=h2opt[i], idx_pheno=[i], **kwargs)
+            res['nLL'] = res['nLL'][0]
+            resmin.append(res)
+        return resmin
+
+    def nLLeval_batch(self, h2, dof=None, scale=1.0, idx_pheno=None):
         '''
-        Find the optimal h2 for a given K. Note that this is the single kernel case. So there is no a2.
-        (default maxH2 value is set to a value smaller than 1 to avoid loss of positive definiteness of the final model covariance)
+        evaluate the negative log-likelihood for many values of h2 at once (single kernel, no SNPs, h2 parameterization).
+        The likelihood of every h2 and phenotype comes from one broadcast over the spectrum S, so a whole h2 grid
+        costs about as much as a single call to nLLeval.
+
         Args:
-            nGridH2 : number of h2-grid points to evaluate the negative log-likelihood at. Number of columns in design matrix for kernel for normalization (default: 10)
+            h2      : [M x P] np.array of mixture weights between K and Identity, one column per phenotype,
+                      or [M x 1] (or [M]) to use the same M values for every phenotype
+            dof     : Degrees of freedom of the Multivariate Student-t
+                        (default None uses multivariate Normal likelihood)
+            scale   : Scale parameter that multiplies the shape matrix in the Student's multivariate t (default 1.0, corresponding to a Gaussian)
+            idx_pheno: index of the phenotype(s) to be used
+
+        Returns:
+            [M x P] np.array of negative log-likelihoods (3E20 where h2 is out of range, as in nLLeval)
+        '''
+        S,U = self.getSU()
+        UY,UUY = self.getUY(idx_pheno = idx_pheno)
+        N = self.Y.shape[0] - self.linreg.D
+        k = S.shape[0]
+        P = UY.shape[1]
+
+        h2 = np.asarray(h2, dtype=float)
+        if h2.ndim < 2:
+            h2 = h2.reshape(-1,1)
+        assert h2.shape[1] in (1,P), "h2 should have one column or one column per phenotype"
+        out_of_range = (h2 < 0.0) | (h2 >= 1.0)
+        h2 = np.where(out_of_range, 0.5, h2)
+        denom = (1.0 - h2) * scale      # determine normalization factor
+
+        UY2 = UY * UY
+        if h2.shape[1] == 1:
+            Sd = (h2 * S.reshape(1,-1) + (1.0 - h2)) * scale         # [M x k]
+            YKY = (1.0 / Sd).dot(UY2)
+            logdetK = np.log(Sd).sum(1).reshape(-1,1)
+        else:
+            Sd = (h2[:,np.newaxis,:] * S.reshape(1,-1,1) + (1.0 - h2[:,np.newaxis,:])) * scale     # [M x k x P]
+            YKY = (UY2[np.newaxis,:,:] / Sd).sum(1)
+            logdetK = np.log(Sd).sum(1)
+
+        if UUY is not None:#low rank part
+            YKY = YKY + (UUY * UUY).sum(0).reshape(1,-1) / denom
+            logdetK = logdetK + (N - k) * np.log(denom)
+
+        r2 = YKY
+        if dof is None:#Use the Multivariate Gaussian
+            sigma2 = r2 / N
+            nLL = 0.5 * (logdetK + N * (np.log(2.0 * np.pi * sigma2) + 1))
+        else:#Use multivariate student-t
+            nLL = 0.5 * (logdetK + (dof + N) * np.log(1.0 + r2 / dof))
+            nLL +=  0.5 * N * np.log(dof * np.pi) + ss.gammaln(0.5 * dof) - ss.gammaln(0.5 * (dof + N))
+        return np.where(out_of_range, 3E20, nLL)
+
+    def posterior_h2(self, nGridH2=1000, minH2=0.0, maxH2=0.99999, blocksize=1000, **kwargs):
+        '''
+        Evaluate the negative log-likelihood on a grid of h2 values, e.g. to compute the posterior over h2 (see posterior_h2_summary).
+        If only the dof and scale keyword arguments are given, the grid is evaluated for all phenotypes at once with nLLeval_batch.
+        Otherwise each grid point is evaluated separately with nLLeval, which only works for a single phenotype.
+        Args:
+            nGridH2 : number of h2-grid points to evaluate the negative log-likelihood at. (default: 1000)
             minH2   : minimum value for h2 optimization (default: 0.0)
             maxH2   : maximum value for h2 optimization (default: 0.99999)
-            estimate_Bayes: implement me!   (default: False)
+            blocksize: number of grid points evaluated with one call to nLLeval_batch, which bounds the memory to blocksize*N (default: 1000)
 
         Returns:
-            dictionary containing the model parameters at the optimal h2
+            dictionary with the [P] arrays 'nLL' and 'h2' at the best grid point of each phenotype, the [nGrid] h2 grid
+            and the [nGrid x P] negative log-likelihoods
         '''
+        if set(kwargs.keys()) <= set(['dof','scale']):
+            def f(x):
+                return np.vstack([self.nLLeval_batch(h2=x[start:start+blocksize], **kwargs) for start in range(0, x.shape[0], blocksize)])
+            (evalgrid,resultgrid) = evalgrid1D_batch(f, evalgrid = None, nGrid=nGridH2, minval=minH2, maxval = maxH2)
+            i_min = resultgrid.argmin(0)
+            resmin = {'nLL':resultgrid[i_min,np.arange(resultgrid.shape[1])],'h2':evalgrid[i_min]}
+            return resmin, evalgrid, resultgrid
+
         #f = lambda x : (self.nLLeval(h2=x,**kwargs)['nLL'])
         resmin = [None]
         #logging.info("starting H2 search")
@@ -490,6 +576,37 @@ class LMM(object):
         #import ipdb;ipdb.set_trace()
         return resmin[0], evalgrid, resultgrid
 
+    def posterior_h2_summary(self, nGridH2=1000, minH2=0.0, maxH2=0.99999, credible_level=0.95, **kwargs):
+        '''
+        Summarize the posterior over h2 of every phenotype, using a flat prior on the grid of posterior_h2
+        (Furlotte et al., 2014).
+        Args:
+            nGridH2 : number of h2-grid points (default: 1000)
+            minH2   : minimum value of the h2 grid (default: 0.0)
+            maxH2   : maximum value of the h2 grid (default: 0.99999)
+            credible_level: probability mass of the equal-tailed credible interval (default: 0.95)
+
+        Returns:
+            dictionary containing
+            'h2'        : [P] grid h2 with the highest likelihood
+            'mean'      : [P] posterior mean of h2
+            'var'       : [P] posterior variance of h2
+            'lower'     : [P] lower end of the credible interval
+            'upper'     : [P] upper end of the credible interval
+            'grid'      : [nGrid] h2 values
+            'posterior' : [nGrid x P] posterior probability of each grid point (sums to one for each phenotype)
+        '''
+        resmin, grid, nLL = self.posterior_h2(nGridH2=nGridH2, minH2=minH2, maxH2=maxH2, **kwargs)
+        lik = np.exp(-(nLL - nLL.min(0)))
+        posterior = lik / lik.sum(0)
+        mean = grid.dot(posterior)
+        var = ((grid[:,np.newaxis] - mean)**2 * posterior).sum(0)
+        cdf = np.cumsum(posterior, 0)
+        alpha = 0.5 * (1.0 - credible_level)
+        lower = grid[(cdf < alpha).sum(0)]
+        upper = grid[np.minimum((cdf < 1.0 - alpha).sum(0), grid.shape[0] - 1)]
+        return {'h2':resmin['h2'], 'mean':mean, 'var':var, 'lower':lower, 'upper':upper, 'grid':grid, 'posterior':posterior}
+
     def nLLeval_2K(self, h2=0.0, h2_1=0.0, dof=None, scale=1.0, penalty=0.0, snps=None, UW=None, UUW=None, i_up=None, i_G1=None, subset=False):
         '''
         TODO: rename to nLLeval
@@ -726,12 +843,15 @@ class LMM(object):
         UY,UUY = self.getUY(idx_pheno = idx_pheno)
         P = UY.shape[1] #number of phenotypes used
 
-        YKY = np.full(P,np.nan)
-        for pheno_index in range(P):
-            YKY[pheno_index] = self.computeAKA(Sd=Sd[:,pheno_index:pheno_index+1],
-                                                denom=denom[pheno_index],
-                                                UA=UY[:,pheno_index:pheno_index+1],
-                                                UUA=None if UUY is None else UUY[:,pheno_index:pheno_index+1])
+        if P > 1: #every phenotype has its own Sd column, so evaluate all of them in one pass
+            YKY = self.computeAKA_pheno(Sd=Sd, denom=denom, UA=UY, UUA=UUY)
+        else:
+            YKY = np.full(P,np.nan)
+            for pheno_index in range(P):
+                YKY[pheno_index] = self.computeAKA(Sd=Sd[:,pheno_index:pheno_index+1],
+                                                    denom=denom[pheno_index],
+                                                    UA=UY[:,pheno_index:pheno_index+1],
+                                                    UUA=None if UUY is None else UUY[:,pheno_index:pheno_index+1])
 
 
         logdetK = np.log(Sd).sum(0)
@@ -739,7 +859,10 @@ class LMM(object):
         if (UUY is not None):#low rank part
             logdetK+=(N - k) * np.log(denom)
         
-        if Usnps is not None:
+        if Usnps is not None and P > 1: #the rotated SNPs are shared by all phenotypes
+            snpsKsnps = self.computeAKA_snps_pheno(Sd=Sd, denom=denom, UA=Usnps, UUA=UUsnps)
+            snpsKY = self.computeAKB_pheno(Sd=Sd, denom=denom, UA=Usnps, UB=UY, UUA=UUsnps, UUB=UUY)
+        elif Usnps is not None:
             snpsKsnps = np.full((Usnps.shape[1],P),np.nan)
             snpsKY = np.full((Usnps.shape[1],P),np.nan)
             for pheno_index in range(P):
@@ -874,6 +997,39 @@ class LMM(object):
             AKB += UUA.T.dot(UUB) / denom
         return AKB
 
+    def computeAKA_pheno(self, Sd, denom, UA, UUA=None):
+        """
+        compute the symmetric squared forms a_p.T.dot( f(K_p) ).dot(a_p) of every column a_p of A with
+        its own phenotype's scaling (column p of Sd and entry p of denom)
+        """
+        AKA = (UA * UA / Sd).sum(0)
+        if UUA is not None:
+            AKA += (UUA * UUA).sum(0) / denom
+        return AKA
+
+    def computeAKA_snps_pheno(self, Sd, denom, UA, UUA=None):
+        """
+        compute symmetric squared form
+
+        A.T.dot( f(K_p) ).dot(A) for all phenotypes p (one column of Sd each) at once. Returns [S x P]
+        """
+        AKA = (UA * UA).T.dot(1.0 / Sd)
+        if UUA is not None:
+            AKA += (UUA * UUA).sum(0).reshape(-1,1) / denom.reshape(1,-1)
+        return AKA
+
+    def computeAKB_pheno(self, Sd, denom, UA, UB, UUA=None, UUB=None):
+        """
+        compute asymmetric squared form
+
+        A.T.dot( f(K_p) ).dot(b_p) for all phenotypes p (one column of Sd and of B each) at once. Returns [S x P]
+        """
+        assert (UUA is None) == (UUB is None), "Expect UUA and UUB to either both be given or both not"
+        AKB = UA.T.dot(UB / Sd)
+        if UUA is not None:
+            AKB += UUA.T.dot(UUB) / denom.reshape(1,-1)
+        return AKB
+
     def computeAKA(self, Sd, denom, UA, UUA=None):
         """
         compute symmetric squared form
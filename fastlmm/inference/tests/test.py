@@ -126,6 +126,34 @@ class TestLmmKernel(unittest.TestCase):
             NP.testing.assert_array_almost_equal(result[key], target_result[key])
             #self.assertAlmostEqual(result[key], target_result[key])
 
+    def test_appendG(self):
+        """
+        growing G a few columns at a time should match setG on all the columns
+        """
+        G = SP.concatenate((self._G0, self._G1),1)
+
+        model = getLMM()
+        model.setG(G0=G[:,:3])
+        for k in [5,6,self._k0+self._k1]:
+            model.appendG(G[:,model.G.shape[1]:k])
+        model.setX(self._X)
+        model.sety(self._y)
+        model.setTestData(Xstar=self._Xstar,G0star=SP.concatenate((self._G0star, self._G1star),1))
+        result = model.nLLeval(REML=True, delta=1.0)
+        ystar = model.predictMean(result['beta'],delta=1.0)
+
+        model_all = getLMM()
+        model_all.setG(G0=G)
+        model_all.setX(self._X)
+        model_all.sety(self._y)
+        model_all.setTestData(Xstar=self._Xstar,G0star=SP.concatenate((self._G0star, self._G1star),1))
+        result_all = model_all.nLLeval(REML=True, delta=1.0)
+        ystar_all = model_all.predictMean(result_all['beta'],delta=1.0)
+
+        for key in result.keys():
+            NP.testing.assert_array_almost_equal(result[key], result_all[key])
+        NP.testing.assert_array_almost_equal(ystar, ystar_all)
+
 
 class TestProximalContamination(unittest.TestCase):
 
@@ -358,6 +386,167 @@ class TestProximalContamination(unittest.TestCase):
             NP.testing.assert_array_almost_equal(ret_cut[key], ret_nocut[key])
             #self.assertAlmostEqual(ret_cut[key], ret_nocut[key])
 
+class TestLmmCovVectorized(unittest.TestCase):
+    """
+    the vectorized h2 search in lmm_cov should match the scalar one
+    """
+    @classmethod
+    def setUpClass(self):
+        from numpy.random import RandomState
+        randomstate = RandomState(621360)
+        self._N = 500
+        self._G = randomstate.randn(self._N,1000) / NP.sqrt(1000)
+        self._X = NP.ones((self._N,1))
+        self._Y = self._G.dot(randomstate.randn(1000,4)) + randomstate.randn(self._N,4)
+
+    def test_nLLeval_batch(self):
+        from fastlmm.inference.lmm_cov import LMM
+        for G in [self._G, self._G[:,:100]]: #full and low rank
+            model = LMM(X=self._X, Y=self._Y, G=G)
+            h2grid = NP.linspace(0.0, 0.99, 5)
+            nLL = model.nLLeval_batch(h2grid)
+            for i_h2, h2 in enumerate(h2grid):
+                NP.testing.assert_array_almost_equal(nLL[i_h2], model.nLLeval(h2=NP.repeat(h2,self._Y.shape[1]))['nLL'])
+            nLL_t = model.nLLeval_batch(h2grid[[1]], dof=5.0, scale=1.5, idx_pheno=[2])
+            NP.testing.assert_array_almost_equal(nLL_t[0], model.nLLeval(h2=h2grid[1], dof=5.0, scale=1.5, idx_pheno=[2])['nLL'])
+
+    def test_findH2_vectorized(self):
+        import time
+        from fastlmm.inference.lmm_cov import LMM
+        model = LMM(X=self._X, Y=self._Y, G=self._G)
+        model.getUY()
+
+        t0 = time.time()
+        result_list = model.findH2(vectorized=True)
+        t_vectorized = time.time() - t0
+
+        t0 = time.time()
+        for i_pheno, result in enumerate(result_list):
+            model_one = LMM(X=self._X, Y=self._Y[:,i_pheno:i_pheno+1], S=model.S, U=model.U)
+            result_one = model_one.findH2()
+            self.assertAlmostEqual(result['nLL'], result_one['nLL'][0], places=5)
+            self.assertAlmostEqual(result['h2'][0], result_one['h2'][0], places=3)
+        t_scalar = time.time() - t0
+        logging.info("findH2 on {0} phenotypes: {1:.4f}s one at a time, {2:.4f}s vectorized".format(self._Y.shape[1], t_scalar, t_vectorized))
+
+    def test_nLLeval_snps_all_phenotypes(self):
+        from fastlmm.inference.lmm_cov import LMM
+        snps = self._G[:,:20] * NP.sqrt(1000)
+        h2 = NP.array([0.1, 0.3, 0.5, 0.7])
+        for G in [self._G, self._G[:,:100]]: #full and low rank
+            model = LMM(X=self._X, Y=self._Y, G=G)
+            Usnps, UUsnps = model.rotate(A=snps)
+            result = model.nLLeval(h2=h2, Usnps=Usnps, UUsnps=UUsnps)
+            for i_pheno in range(self._Y.shape[1]):
+                model_one = LMM(X=self._X, Y=self._Y[:,i_pheno:i_pheno+1], G=G)
+                result_one = model_one.nLLeval(h2=h2[i_pheno], snps=snps)
+                for key in ['nLL', 'beta', 'variance_beta']:
+                    NP.testing.assert_array_almost_equal(result[key][:,i_pheno], result_one[key][:,0])
+
+    def test_posterior_h2_all_phenotypes(self):
+        from fastlmm.inference.lmm_cov import LMM
+        model = LMM(X=self._X, Y=self._Y, G=self._G)
+        summary = model.posterior_h2_summary(nGridH2=200, credible_level=0.9)
+        for i_pheno in range(self._Y.shape[1]):
+            model_one = LMM(X=self._X, Y=self._Y[:,i_pheno:i_pheno+1], S=model.getSU()[0], U=model.getSU()[1])
+            resmin, grid, nLL = model_one.posterior_h2(nGridH2=200, penalty=0.0) #penalty forces the grid point at a time path
+            NP.testing.assert_array_almost_equal(grid, summary['grid'])
+            lik = NP.exp(-(nLL[:,0] - nLL[:,0].min()))
+            posterior = lik / lik.sum()
+            NP.testing.assert_array_almost_equal(posterior, summary['posterior'][:,i_pheno])
+            self.assertAlmostEqual(summary['mean'][i_pheno], (grid * posterior).sum())
+            self.assertAlmostEqual(summary['var'][i_pheno], ((grid - summary['mean'][i_pheno])**2 * posterior).sum())
+            self.assertAlmostEqual(summary['h2'][i_pheno], resmin['h2'][0])
+            assert posterior[grid < summary['lower'][i_pheno]].sum() < 0.05 <= posterior[grid <= summary['lower'][i_pheno]].sum()
+            assert posterior[grid < summary['upper'][i_pheno]].sum() < 0.95 <= posterior[grid <= summary['upper'][i_pheno]].sum()
+
+
+class TestLmm2k(unittest.TestCase):
+    """
+    the two variance component model should match a direct dense computation
+    """
+    @classmethod
+    def setUpClass(self):
+        from numpy.random import RandomState
+        randomstate = RandomState(5)
+        self._N = 80
+        self._G0 = randomstate.randn(self._N,30) / NP.sqrt(30)
+        self._G1 = randomstate.randn(self._N,12) / NP.sqrt(12)
+        self._X = NP.c_[NP.ones(self._N), randomstate.randn(self._N)]
+        self._y = self._G0.dot(randomstate.randn(30)) + 1.5 * self._G1.dot(randomstate.randn(12)) + randomstate.randn(self._N) + self._X[:,1]
+
+    def dense_nLL(self, gamma0, gamma1, REML, G0):
+        N, D = self._X.shape
+        V = gamma0 * G0.dot(G0.T) + gamma1 * self._G1.dot(self._G1.T) + NP.eye(N)
+        Vinv = LA.inv(V)
+        XKX = self._X.T.dot(Vinv).dot(self._X)
+        beta = LA.solve(XKX, self._X.T.dot(Vinv).dot(self._y))
+        r = self._y - self._X.dot(beta)
+        r2 = r.dot(Vinv).dot(r)
+        logdetV = NP.linalg.slogdet(V)[1]
+        if REML:
+            sigma2 = r2 / (N-D)
+            return 0.5 * (logdetV + NP.linalg.slogdet(XKX)[1] - NP.linalg.slogdet(self._X.T.dot(self._X))[1] + (N-D) * (NP.log(2.0*NP.pi*sigma2) + 1))
+        sigma2 = r2 / N
+        return 0.5 * (logdetV + N * (NP.log(2.0*NP.pi*sigma2) + 1))
+
+    def model(self, kind, exclude_idx=[]):
+        from fastlmm.inference.lmm2k import lmm2k
+        model = lmm2k(forcefullrank=(kind=='full'))
+        if kind == 'K':
+            model.setK0(self._G0.dot(self._G0.T))
+            model.setK1(self._G1.dot(self._G1.T))
+        else:
+            model.setG0(self._G0)
+            model.setG1(self._G1)
+        model.setX(self._X)
+        model.setY(self._y)
+        model.set_exclude_idx(exclude_idx)
+        return model
+
+    def test_nLLeval(self):
+        for kind in ['low', 'full', 'K']:
+            model = self.model(kind)
+            for REML in [True, False]:
+                gamma1 = NP.array([0.0, 0.01, 2.0])
+                nLL = model.nLLeval_batch(gamma1=gamma1, gamma0=0.5, REML=REML)['nLL']
+                for i, g1 in enumerate(gamma1):
+                    self.assertAlmostEqual(nLL[i], self.dense_nLL(0.5, g1, REML, self._G0))
+                    self.assertAlmostEqual(nLL[i], model.nLLeval(gamma0=0.5, gamma1=g1, REML=REML)['nLL'])
+
+    def test_collinear_covariates(self):
+        for kind in ['low', 'full']:
+            model = self.model(kind)
+            collinear = self.model(kind)
+            collinear.setX(NP.c_[self._X, self._X[:,:1]])
+            for gamma0, gamma1 in [(0.5, 2.0), (3.0, 0.01)]:
+                res = model.nLLeval(gamma0=gamma0, gamma1=gamma1)
+                res_collinear = collinear.nLLeval(gamma0=gamma0, gamma1=gamma1)
+                self.assertAlmostEqual(res['nLL'], res_collinear['nLL'])
+                self.assertAlmostEqual(res['sigma2'], res_collinear['sigma2'])
+
+    def test_proximal_contamination(self):
+        exclude_idx = [1, 5, 7, 20]
+        G0_small = NP.delete(self._G0, exclude_idx, axis=1)
+        for kind in ['low', 'full']:
+            model = self.model(kind, exclude_idx=exclude_idx)
+            for gamma0, gamma1 in [(0.5, 2.0), (3.0, 0.01)]:
+                self.assertAlmostEqual(model.nLLeval(gamma0=gamma0, gamma1=gamma1)['nLL'], self.dense_nLL(gamma0, gamma1, True, G0_small))
+
+    def test_findGammas(self):
+        from scipy.optimize import minimize
+        for kind in ['low', 'full']:
+            model = self.model(kind)
+            result, grid0, grid1, nLL_grid = model.findGammas(nGridGamma0=8, nGridGamma1=8, return_grid=True)
+            assert nLL_grid.shape == (8, 8)
+            self.assertAlmostEqual(nLL_grid[2,5], model.nLLeval(gamma0=10**grid0[2], gamma1=10**grid1[5])['nLL'])
+            assert result['nLL'] <= nLL_grid.min()
+            assert (model.gamma0, model.gamma1) == (result['gamma0'], result['gamma1'])
+            start = NP.log10([result['gamma0'], result['gamma1']])
+            polished = minimize(lambda x: self.dense_nLL(10**x[0], 10**x[1], True, self._G0), start, method='Nelder-Mead')
+            self.assertAlmostEqual(result['nLL'], polished.fun, places=5)
+
+
 def generate_random_data(N, d, s_c):
     """
     small helper to generate a random data set
@@ -493,6 +682,30 @@ class TestBin2Kernel(unittest.TestCase):
 
         self.assertAlmostEqual(-6.7545709287754718, model._regular_marginal_loglikelihood())
 
+    def test_optimize_threads_and_seed(self):
+        for model_class, link in [(LaplaceGLMM_N3K1, 'logistic'), (EPGLMM_N3K1, 'erf')]:
+            results = []
+            for num_threads, seed in [(1, 5), (4, 5), (1, 5)]:
+                model = model_class(link)
+                model.setG(self._G0, self._G1)
+                model.setX(self._X)
+                model.sety(self._y)
+                model.optimize(num_threads=num_threads, seed=seed)
+                results.append((model._regular_marginal_loglikelihood(), model.sig02, model.sig12, model.sign2))
+            self.assertEqual(results[0], results[2]) #reproducible
+            self.assertEqual(results[0], results[1]) #the restarts are independent, so threads give the same result
+
+            results = []
+            for _ in range(2):
+                NP.random.seed(5) #by default the initial values come from the global generator
+                model = model_class(link)
+                model.setG(self._G0, self._G1)
+                model.setX(self._X)
+                model.sety(self._y)
+                model.optimize()
+                results.append((model._regular_marginal_loglikelihood(), model.sig02, model.sig12, model.sign2, NP.random.rand()))
+            self.assertEqual(results[0], results[1])
+
     def test_setK_rmargll_after_optimization(self):
         model = LaplaceGLMM_N3K1('logistic')
         model.setK(NP.dot(self._G0, self._G0.T), NP.dot(self._G1, self._G1.T))
@@ -725,8 +938,10 @@ def getTestSuite():
     suite1 = unittest.TestLoader().loadTestsFromTestCase(TestBin2Kernel)
     suite2 = unittest.TestLoader().loadTestsFromTestCase(TestProximalContamination)
     suite3 = unittest.TestLoader().loadTestsFromTestCase(TestLmmKernel)
+    suite4 = unittest.TestLoader().loadTestsFromTestCase(TestLmmCovVectorized)
+    suite5 = unittest.TestLoader().loadTestsFromTestCase(TestLmm2k)
 
-    return unittest.TestSuite([suite1, suite2, suite3])
+    return unittest.TestSuite([suite1, suite2, suite3, suite4, suite5])
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
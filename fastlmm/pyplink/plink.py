@@ -6,18 +6,21 @@ from .snpset import *
 import logging
 from six.moves import range
 
-def readPED(basefilename, delimiter = ' ',missing = '0',standardize = True, pheno = None):
+def readPED(basefilename, delimiter = ' ',missing = '0',standardize = True, pheno = None, chunk_size = 1000, bed_basefilename = None):
     '''
     read [basefilename].ped and [basefilename].map
     optionally standardize the SNPs and mean impute missing SNPs
     --------------------------------------------------------------------------
     Input:
     basefilename    : string of the basename of [basename].ped and [basename].map
-    delimiter       : string (default ' ' space)
+    delimiter       : string (default ' ', any whitespace)
     missing         : string indicating a missing genotype (default '0')
     standardize     : boolean
                         True    : mean impute, zero-mean and unit variance the data
                         False   : output the data in 0,1,2 with NaN values
+    chunk_size      : number of individuals parsed at a time (default 1000)
+    bed_basefilename: if given, also write the genotypes to [bed_basefilename].bed/.bim/.fam
+                        (allele 1 is the allele that is counted in 'snps')
     --------------------------------------------------------------------------
     Output dictionary:
     'rs'     : [S] array rs-numbers,
@@ -25,32 +28,41 @@ def readPED(basefilename, delimiter = ' ',missing = '0',standardize = True, phen
     'snps'   : [N*S] array of snps-data,
     'iid'    : [N*2] array of family IDs and individual IDs
     --------------------------------------------------------------------------
+    The allele that is counted for a SNP is the first allele of the first individual with a non-missing genotype.
     '''
     pedfile = basefilename+".ped"
     mapfile = basefilename+".map"
-    map = SP.loadtxt(mapfile,dtype = 'str',comments=None)
+    rs, pos = _read_map(mapfile)
 
-    rs = map[:,1]
-    pos = SP.array(map[:,(0,2,3)],dtype = 'float')
-    map = None
+    iid_list, snps_list = [], []
+    missing = missing.encode()
+    counted = None #the allele counted for each SNP, 'missing' until known
+    other = None
+    for iid_chunk, alleles in _read_ped_chunks(pedfile, delimiter, chunk_size, len(rs)):
+        iid_list.append(iid_chunk)
+        allele1 = alleles[:,0::2]
+        allele2 = alleles[:,1::2]
+        if counted is None:
+            counted = SP.full(allele1.shape[1], missing, dtype=allele1.dtype)
+            other = SP.full(allele1.shape[1], missing, dtype=allele1.dtype)
+        elif counted.dtype.itemsize < allele1.dtype.itemsize:
+            counted, other = counted.astype(allele1.dtype), other.astype(allele1.dtype)
+        inan = allele1 == missing
+        _fill_first(counted, allele1, ~inan & (counted == missing))
+        _fill_first(other, allele1, ~inan & (allele1 != counted) & (other == missing))
+        _fill_first(other, allele2, ~inan & (allele2 != counted) & (other == missing))
+        snps = (allele1 == counted).astype(SP.float64) + (allele2 == counted)
+        snps[inan] = SP.nan
+        snps_list.append(snps)
+    iid = SP.concatenate(iid_list).astype(str)
+    snps = SP.concatenate(snps_list)
+    if snps.shape[1] != len(rs):
+        raise Exception("Expect the number of SNPs in the ped file to match the map file")
 
-    ped = SP.loadtxt(pedfile,dtype = 'str',comments=None)
-    iid = ped[:,0:2]
-    snpsstr = ped[:,6::]
-    inan=snpsstr==missing
-    snps = SP.zeros((snpsstr.shape[0],snpsstr.shape[1]//2))
+    if bed_basefilename is not None:
+        _write_bed(bed_basefilename, snps, iid, rs, pos, counted.astype(str), other.astype(str))
     if standardize:
-        for i in range(snpsstr.shape[1]//2):
-            snps[inan[:,2*i],i]=0
-            vals=snpsstr[~inan[:,2*i],2*i:2*(i+1)]
-            snps[~inan[:,2*i],i]+=(vals==vals[0,0]).sum(1)
-            snps[~inan[:,2*i],i]-=snps[~inan[:,2*i],i].mean()
-            snps[~inan[:,2*i],i]/=snps[~inan[:,2*i],i].std()
-    else:
-        for i in range(snpsstr.shape[1]/2):
-            snps[inan[:,2*i],i]=SP.nan
-            vals=snpsstr[~inan[:,2*i],2*i:2*(i+1)]
-            snps[~inan[:,2*i],i]+=(vals==vals[0,0]).sum(1)
+        _standardize_inplace(snps)
     if pheno is not None:
         #TODO: sort and filter SNPs according to pheno
         pass
@@ -62,50 +74,62 @@ def readPED(basefilename, delimiter = ' ',missing = '0',standardize = True, phen
            }
     return ret
 
-def readRAW(basefilename, delimiter = ' ',missing = '0',standardize = True, pheno = None):
+def readRAW(basefilename, delimiter = ' ',missing = 'NA',standardize = True, pheno = None, chunk_size = 1000, bed_basefilename = None):
     '''
-    read [basefilename].raw
+    read [basefilename].raw (PLINK --recodeA format: a header line, then FID IID PAT MAT SEX PHENOTYPE and one
+    additive allele count per SNP) and, if present, [basefilename].map for the positions
     optionally standardize the SNPs and mean impute missing SNPs
     --------------------------------------------------------------------------
     Input:
-    basefilename    : string of the basename of [basename].ped and [basename].map
-    delimiter       : string (default ' ' space)
-    missing         : string indicating a missing genotype (default '0')
+    basefilename    : string of the basename of [basename].raw and [basename].map
+    delimiter       : string (default ' ', any whitespace)
+    missing         : string indicating a missing genotype (default 'NA')
     standardize     : boolean
                         True    : mean impute, zero-mean and unit variance the data
                         False   : output the data in 0,1,2 with NaN values
+    chunk_size      : number of individuals parsed at a time (default 1000)
+    bed_basefilename: if given, also write the genotypes to [bed_basefilename].bed/.bim/.fam
     --------------------------------------------------------------------------
     Output dictionary:
     'rs'     : [S] array rs-numbers,
-    'pos'    : [S*3] array of positions [chromosome, genetic dist, basepair dist],
+    'pos'    : [S*3] array of positions [chromosome, genetic dist, basepair dist] (NaN without a map file),
     'snps'   : [N*S] array of snps-data,
     'iid'    : [N*2] array of family IDs and individual IDs
     --------------------------------------------------------------------------
     '''
     rawfile = basefilename+".raw"
-    #mapfile = basefilename+".map"
-    #map = SP.loadtxt(mapfile,dtype = 'str',comments=None)
-
-    #rs = map[:,1]
-    #pos = SP.array(map[:,(0,2,3)],dtype = 'float')
-    #map = None
-    raw = SP.loadtxt(rawfile,dtype = 'str',comments=None)
-    iid = raw[:,0:2]
-    snpsstr = raw[:,6::]
-    inan=snpsstr==missing
-    snps = SP.zeros((snpsstr.shape[0],snpsstr.shape[1]/2))
-    if standardize:
-        for i in range(snpsstr.shape[1]/2):
-            raw[inan[:,2*i],i]=0
-            vals=snpsstr[~inan[:,2*i],2*i:2*(i+1)]
-            snps[~inan[:,2*i],i]+=(vals==vals[0,0]).sum(1)
-            snps[~inan[:,2*i],i]-=snps[~inan[:,2*i],i].mean()
-            snps[~inan[:,2*i],i]/=snps[~inan[:,2*i],i].std()
+    mapfile = basefilename+".map"
+
+    iid_list, snps_list = [], []
+    with open(rawfile, 'rb') as raw_filepointer:
+        header = SP.array(raw_filepointer.readline().split(None if delimiter is None or delimiter.isspace() else delimiter.encode())[6:]).astype(str)
+        for raw in _read_chunks(raw_filepointer, delimiter, chunk_size):
+            iid_list.append(raw[:,0:2])
+            counts = raw[:,6:]
+            inan = counts == missing.encode()
+            counts[inan] = b'0'
+            counts = counts.astype(SP.float64)
+            counts[inan] = SP.nan
+            snps_list.append(counts)
+    iid = SP.concatenate(iid_list).astype(str)
+    snps = SP.concatenate(snps_list)
+
+    #header entries look like rs1_A, where A is the counted allele
+    split = SP.char.rpartition(header, '_')
+    has_allele = split[:,1] == '_'
+    rs = SP.where(has_allele, split[:,0], header)
+    counted = SP.where(has_allele, split[:,2], '0')
+    if os.path.exists(mapfile):
+        rs_map, pos = _read_map(mapfile)
+        if not SP.array_equal(rs_map, rs):
+            raise Exception("Expect the SNPs in the raw file to match the map file")
     else:
-        for i in range(snpsstr.shape[1]/2):
-            snps[inan[:,2*i],i]=SP.nan
-            vals=snpsstr[~inan[:,2*i],2*i:2*(i+1)]
-            snps[~inan[:,2*i],i]+=(vals==vals[0,0]).sum(1)
+        pos = SP.full((len(rs),3), SP.nan)
+
+    if bed_basefilename is not None:
+        _write_bed(bed_basefilename, snps, iid, rs, pos, counted, SP.full(len(rs), '0'))
+    if standardize:
+        _standardize_inplace(snps)
     if pheno is not None:
         #TODO: sort and filter SNPs according to pheno
         pass
@@ -117,6 +141,107 @@ def readRAW(basefilename, delimiter = ' ',missing = '0',standardize = True, phen
            }
     return ret
 
+def _read_map(mapfile):
+    map = SP.loadtxt(mapfile,dtype = 'str',comments=None,ndmin=2)
+    rs = map[:,1]
+    pos = SP.array(map[:,(0,2,3)],dtype = 'float')
+    return rs, pos
+
+def _read_chunks(file, delimiter, chunk_size):
+    '''
+    yield the rows of a whitespace- (or delimiter-) separated text file (a file name or a binary file object) as
+    [rows x fields] bytes arrays, chunk_size rows at a time. Each chunk is tokenized with a single split.
+    '''
+    import itertools
+    if isinstance(file, str):
+        with open(file, 'rb') as filepointer:
+            for chunk in _read_chunks(filepointer, delimiter, chunk_size):
+                yield chunk
+        return
+    separator = None if delimiter is None or delimiter.isspace() else delimiter.encode()
+    while True:
+        lines = [line for line in itertools.islice(file, chunk_size) if line.strip()]
+        if not lines:
+            return
+        if separator is None:
+            tokens = b' '.join(lines).split()
+        else:
+            tokens = separator.join(line.rstrip(b'\r\n') for line in lines).split(separator)
+        if len(tokens) % len(lines) != 0:
+            raise Exception("Expect every row of '{0}' to have the same number of fields".format(getattr(file,'name',file)))
+        yield SP.array(tokens).reshape(len(lines), -1)
+
+def _read_ped_chunks(pedfile, delimiter, chunk_size, snp_count):
+    '''
+    yield ([rows x 2] iids, [rows x 2*snp_count] alleles) as bytes arrays, chunk_size rows at a time.
+    When every allele is a single character (the usual case), the genotype part of each line is turned into
+    an array without tokenizing it.
+    '''
+    import itertools
+    if delimiter is not None and not delimiter.isspace():
+        for ped in _read_chunks(pedfile, delimiter, chunk_size):
+            yield ped[:,0:2], ped[:,6:]
+        return
+    with open(pedfile, 'rb') as ped_filepointer:
+        while True:
+            lines = [line for line in itertools.islice(ped_filepointer, chunk_size) if line.strip()]
+            if not lines:
+                return
+            fields_list = [line.split(None, 6) for line in lines]
+            genotype_list = [fields[6].translate(None, b' \t\r\n') if len(fields) == 7 else b'' for fields in fields_list]
+            if all(len(genotype) == 2 * snp_count for genotype in genotype_list):
+                alleles = SP.frombuffer(b''.join(genotype_list), dtype='S1').reshape(len(lines), 2 * snp_count)
+                yield SP.array([fields[0:2] for fields in fields_list]), alleles
+            else: #multi-character alleles (or a malformed line), tokenize everything
+                ped = SP.array(b' '.join(lines).split())
+                if ped.size != len(lines) * (6 + 2 * snp_count):
+                    raise Exception("Expect every row of '{0}' to have 6 fields plus two alleles for each of the {1} SNPs in the map file".format(pedfile, snp_count))
+                ped = ped.reshape(len(lines), -1)
+                yield ped[:,0:2], ped[:,6:]
+
+def _fill_first(target, values, mask):
+    '''
+    for each column with any True in mask, set target to the value of the first row where mask is True
+    '''
+    has_any = mask.any(axis=0)
+    if has_any.any():
+        first_row = mask.argmax(axis=0)
+        columns = SP.flatnonzero(has_any)
+        target[columns] = values[first_row[columns], columns]
+
+def _standardize_inplace(snps):
+    '''
+    mean impute, zero-mean and unit variance each column of snps using its non-missing values
+    '''
+    inan = SP.isnan(snps)
+    snps -= SP.nanmean(snps, axis=0)
+    snps[inan] = 0
+    snps /= SP.sqrt((snps*snps).sum(0) / (~inan).sum(0))
+
+def _write_bed(bed_basefilename, snps, iid, rs, pos, allele1, allele2):
+    '''
+    write [N*S] counts of allele1 (NaN for missing) as a SNP-major BED file set
+    '''
+    from .vcfpy import BED_MAGIC, pack_bed
+    codes = SP.ones(snps.shape, dtype=SP.uint8) #missing
+    codes[snps == 2] = 0
+    codes[snps == 1] = 2
+    codes[snps == 0] = 3
+    with open(bed_basefilename + ".bed", 'wb') as bed_file:
+        bed_file.write(BED_MAGIC)
+        bed_file.write(pack_bed(codes.T).tobytes())
+    with open(bed_basefilename + ".bim", 'w') as bim_file:
+        for i in range(len(rs)):
+            bim_file.write("{0}\t{1}\t{2}\t{3}\t{4}\t{5}\n".format(_format_number(pos[i,0]), rs[i], _format_number(pos[i,1]), _format_number(pos[i,2]), allele1[i], allele2[i]))
+    with open(bed_basefilename + ".fam", 'w') as fam_file:
+        for famid, indid in iid:
+            fam_file.write("{0} {1} 0 0 0 -9\n".format(famid, indid))
+
+def _format_number(value):
+    if SP.isnan(value):
+        return '0'
+    return str(int(value)) if value == int(value) else str(value)
+
 
 def writePhen(phen, filename, missing = '9', sep="\t"):
     '''
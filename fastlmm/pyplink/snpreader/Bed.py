@@ -6,18 +6,33 @@ from fastlmm.pyplink.altset_list import *
 import pandas as pd
 import logging
 import warnings
+import inspect
 
 WRAPPED_PLINK_PARSER_PRESENT = None
+BED_READER_CLOUD_SIGNATURE = None
+
+def _bed_reader_cloud_signature(reader):
+    #bed_reader 1.0 and later take a cloud-options argument and renamed count_a1 to is_a1_counted
+    try:
+        return 'is_a1_counted' in inspect.signature(reader).parameters
+    except (TypeError, ValueError): #some compiled builds don't expose a signature
+        import bed_reader
+        version = getattr(bed_reader, '__version__', None)
+        if version is None: #bed_reader doesn't always set __version__
+            from pkg_resources import get_distribution
+            version = get_distribution('bed-reader').version
+        return int(version.split('.')[0]) >= 1
 
 def decide_once_on_plink_reader():
     #This is now done in a method, instead of at the top of the file, so that messages can be re-directed to the appropriate stream.
     #(Usually messages go to stdout, but when the code is run on Hadoop, they are sent to stderr)
 
-    global WRAPPED_PLINK_PARSER_PRESENT
+    global WRAPPED_PLINK_PARSER_PRESENT, BED_READER_CLOUD_SIGNATURE
     if WRAPPED_PLINK_PARSER_PRESENT == None:
         # attempt to import wrapped plink parser
         try:
             from bed_reader import read_f32, read_f64
+            BED_READER_CLOUD_SIGNATURE = _bed_reader_cloud_signature(read_f64)
             WRAPPED_PLINK_PARSER_PRESENT = True #!!!does the standardizer work without c++
             logging.info("using Rust-based plink parser")
         except Exception as detail:
@@ -196,7 +211,7 @@ class Bed(object):
     def read_with_specification(snpset_withbbed, order="F", dtype=SP.float64, force_python_only=False):
         # doesn't need to self.run_once() because it is static
         decide_once_on_plink_reader()
-        global WRAPPED_PLINK_PARSER_PRESENT
+        global WRAPPED_PLINK_PARSER_PRESENT, BED_READER_CLOUD_SIGNATURE
 
         bed = snpset_withbbed.bed
         iid_count_in, iid_count_out, iid_index_out, snp_count_in, snp_count_out, snp_index_out = bed.counts_and_indexes(snpset_withbbed)
@@ -217,16 +232,29 @@ class Bed(object):
                     + "'int8', 'float32', and 'float64' are allowed."
                 )
 
-            reader(
-                bed_fn,
-                iid_count=iid_count_in,
-                sid_count=snp_count_in,
-                count_a1=count_A1,
-                iid_index=SP.array(iid_index_out,dtype=SP.uint64),
-                sid_index=SP.array(snp_index_out,dtype=SP.uint64),
-                val=SNPs,
-                num_threads=0
-            )
+            if BED_READER_CLOUD_SIGNATURE:
+                reader(
+                    bed_fn,
+                    {},
+                    iid_count=iid_count_in,
+                    sid_count=snp_count_in,
+                    is_a1_counted=count_A1,
+                    iid_index=SP.array(iid_index_out,dtype=SP.intp),
+                    sid_index=SP.array(snp_index_out,dtype=SP.intp),
+                    val=SNPs,
+                    num_threads=0
+                )
+            else:
+                reader(
+                    bed_fn,
+                    iid_count=iid_count_in,
+                    sid_count=snp_count_in,
+                    count_a1=count_A1,
+                    iid_index=SP.array(iid_index_out,dtype=SP.uint64),
+                    sid_index=SP.array(snp_index_out,dtype=SP.uint64),
+                    val=SNPs,
+                    num_threads=0
+                )
 
         else:
 
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 import numpy as SP
 import subprocess, sys, os.path
+import io
 from itertools import *
 from fastlmm.pyplink.snpset import *
 from fastlmm.pyplink.altset_list import *
@@ -10,16 +11,22 @@ from six.moves import range
 
 class Dat(object):
     '''
-    This is a class that reads into memory from DAT/FAM/MAP files.
+    This is a class that reads from DAT/FAM/MAP files. Only the byte offset of each SNP row is kept in memory;
+    the rows asked for are parsed when read.
     '''
 
 
-    def __init__(self,dat_filename):
+    def __init__(self,dat_filename,index_filename=None,blocksize=1000):
         '''
-        filename    : string of the name of the Dat file.
+        filename        : string of the name of the Dat file.
+        index_filename  : optional file in which to persist the row-offset index (e.g. dat_filename + '.offsets.npy').
+                            It is reused when newer than the Dat file and rebuilt otherwise.
+        blocksize       : number of SNP rows parsed at a time by read
         '''
 
         self.dat_filename = dat_filename
+        self.index_filename = index_filename
+        self.blocksize = blocksize
         self._ran_once = False
 
     #!! similar code in fastlmm
@@ -54,26 +61,58 @@ class Dat(object):
 
         #!!similar code in BED reader
         logging.info("Loading map file {0}".format(mapfile))
-        self.bimfields = pd.read_csv(mapfile,delimiter = '\s',usecols = (0,1,2,3),header=None,index_col=False,engine='python')
+        self.bimfields = pd.read_csv(mapfile,delim_whitespace=True,usecols = (0,1,2,3),header=None,index_col=False)
         self.rs = SP.array(self.bimfields[1].tolist(),dtype='str')
         self.pos = self.bimfields[[0,2,3]].values
-        self._snp_to_index = {}
         logging.info("indexing snps");
-        for i in range(self.snp_count):
-            snp = self.rs[i]
-            if snp in self._snp_to_index : raise Exception("Expect snp to appear in bim file only once. ({0})".format(snp))
-            self._snp_to_index[snp]=i
-
-        #!!could change to just create/find an index to the file position of each row. Instead, reading all into memory
-        datfields = pd.read_csv(self.dat_filename,delimiter = '\s',header=None,index_col=False)
-        if not sp.array_equal(sp.array(datfields[0],dtype="string"), self.rs) : raise Exception("Expect snp list in map file to exactly match snp list in dat file")
-        self.start_column = 3
-        if len(self._original_iids) != datfields.shape[1]-self.start_column : raise Exception("Expect # iids in fam file to match dat file")
-        self.datfields = datfields.T
+        unique_rs, rs_count = SP.unique(self.rs, return_counts=True)
+        if len(unique_rs) != len(self.rs) : raise Exception("Expect snp to appear in bim file only once. ({0})".format(unique_rs[rs_count>1][0]))
+        self._snp_to_index = dict(zip(self.rs, range(len(self.rs))))
 
+        self.start_column = 3
+        self._row_offsets = self._load_or_build_row_offsets()
+        if len(self._row_offsets)-1 != self.snp_count : raise Exception("Expect snp list in map file to exactly match snp list in dat file")
 
         return self
 
+    def _load_or_build_row_offsets(self):
+        '''
+        [S+1] array, row i of the Dat file is found in bytes [offsets[i],offsets[i+1])
+        '''
+        if self.index_filename is not None and os.path.exists(self.index_filename) and os.path.getmtime(self.index_filename) >= os.path.getmtime(self.dat_filename):
+            logging.info("Loading row offsets from {0}".format(self.index_filename))
+            return SP.load(self.index_filename)
+
+        logging.info("Indexing rows of dat file {0}".format(self.dat_filename))
+        row_offsets = Dat.build_row_offsets(self.dat_filename)
+        if self.index_filename is not None:
+            with open(self.index_filename,"wb") as index_filepointer:
+                SP.save(index_filepointer, row_offsets)
+        return row_offsets
+
+    @staticmethod
+    def build_row_offsets(dat_filename, buffer_size=64*1024*1024):
+        '''
+        Scan the file in buffers of buffer_size bytes and return the byte offsets of the start of every non-empty row,
+        followed by the offset of the end of the last row.
+        '''
+        newline_list = []
+        file_size = os.path.getsize(dat_filename)
+        with open(dat_filename,"rb") as dat_filepointer:
+            start = 0
+            while True:
+                buffer = dat_filepointer.read(buffer_size)
+                if not buffer:
+                    break
+                newline_list.append(SP.flatnonzero(SP.frombuffer(buffer,dtype=SP.uint8) == ord('\n')) + start)
+                start += len(buffer)
+        ends = SP.concatenate(newline_list + [SP.empty(0,dtype=SP.int64)]).astype(SP.int64) + 1
+        if len(ends) == 0 or ends[-1] != file_size:
+            ends = SP.append(ends, file_size)
+        starts = SP.concatenate([[0], ends[:-1]])
+        non_empty = ends - starts > 2 #skip blank lines, e.g. a final '\r\n'
+        return SP.append(starts[non_empty], ends[non_empty][-1] if non_empty.any() else 0)
+
     #def __del__(self):
     #    if self._filepointer != None:  # we need to test this because Python doesn't guarantee that __init__ was fully run
     #        self._filepointer.close()
@@ -89,7 +128,7 @@ class Dat(object):
     @property
     def snp_count(self):
         self.run_once()
-        return len(self.bimfields);
+        return len(self.bimfields)
 
     def read(self,snp_set = AllSnps(), order="F", dtype=SP.float64, force_python_only=False):
         '''
@@ -149,9 +188,17 @@ class Dat(object):
         iid_count_in, iid_count_out, iid_index_out, snp_count_in, snp_count_out, snp_index_out = dat.counts_and_indexes(snpset_withdat)
 
         SNPs = SP.zeros((iid_count_out,snp_count_out),order=order, dtype=dtype)
-        for SNPsIndex, bimIndex in enumerate(snp_index_out):
-            row = sp.array(dat.datfields[bimIndex])[dat.start_column:,]
-            SNPs[:,SNPsIndex] = row[iid_index_out]
+        snp_index_out = SP.array(snp_index_out,dtype=SP.int64).reshape(-1)
+        iid_index_out = SP.array(iid_index_out,dtype=SP.int64).reshape(-1)
+
+        #read the needed rows in sorted order, each distinct row once, and parse a block of them in one go
+        row_list, row_inverse = SP.unique(snp_index_out, return_inverse=True)
+        with open(dat.dat_filename,"rb") as dat_filepointer:
+            for start in range(0, len(row_list), dat.blocksize):
+                rows = row_list[start:start+dat.blocksize]
+                values = dat._parse_rows(dat_filepointer, rows)
+                in_block = (row_inverse >= start) & (row_inverse < start+len(rows))
+                SNPs[:,in_block] = values[SP.ix_(row_inverse[in_block]-start, iid_index_out)].T
 
         ret = {
                 'rs'     :dat.rs[snp_index_out],
@@ -162,6 +209,24 @@ class Dat(object):
         return ret
 
 
+    def _parse_rows(self, dat_filepointer, rows):
+        '''
+        rows is a sorted array of row indexes. Runs of consecutive rows are read with a single seek and read.
+        Returns a [len(rows) x N_original] array of values.
+        '''
+        breaks = SP.flatnonzero(SP.diff(rows) != 1) + 1
+        chunk_list = []
+        for run in SP.split(rows, breaks):
+            dat_filepointer.seek(self._row_offsets[run[0]])
+            chunk = dat_filepointer.read(self._row_offsets[run[-1]+1] - self._row_offsets[run[0]])
+            if not chunk.endswith(b'\n'):
+                chunk += b'\n'
+            chunk_list.append(chunk)
+        datfields = pd.read_csv(io.BytesIO(b''.join(chunk_list)),delim_whitespace=True,header=None,index_col=False,dtype={0:str})
+        if not SP.array_equal(datfields[0].values.astype('str'), self.rs[rows]) : raise Exception("Expect snp list in map file to exactly match snp list in dat file")
+        if len(self._original_iids) != datfields.shape[1]-self.start_column : raise Exception("Expect # iids in fam file to match dat file")
+        return datfields.iloc[:,self.start_column:].to_numpy(dtype=SP.float64)
+
     @staticmethod
     def write(snpMatrix, datfile):
         snpsarray = snpMatrix['snps']
@@ -15,7 +15,14 @@ from fastlmm.pyplink.altset_list import *
 class Hdf5(object):
 
 
-    def __init__(self,filename, order = 'F',blocksize=5000):
+    def __init__(self,filename, order = 'F',blocksize=5000, chunk_cache_size=None):
+        '''
+        filename        : the Hdf5 file
+        blocksize       : the largest number of SNPs read in one hyperslab when reading a subset of SNPs and iids
+        chunk_cache_size: size in bytes of the HDF5 chunk cache (default None, uses the HDF5 default of 1MB).
+                            Make it hold at least one row of chunks along the iid axis so that chunks are not
+                            decompressed more than once.
+        '''
         self._ran_once = False
         self.h5 = None
 
@@ -23,6 +30,7 @@ class Hdf5(object):
         self.filename=filename
         self.order = order
         self.blocksize = blocksize
+        self.chunk_cache_size = chunk_cache_size
 
     def copyinputs(self, copier):
         copier.input(self.filename)
@@ -37,7 +45,10 @@ class Hdf5(object):
             return
         self._ran_once = True
         try:
-            self.h5 = h5py.File(self.filename, "r")
+            if self.chunk_cache_size is None:
+                self.h5 = h5py.File(self.filename, "r")
+            else:
+                self.h5 = h5py.File(self.filename, "r", rdcc_nbytes=self.chunk_cache_size)
         except IOError as e:
             raise IOError("Missing or unopenable file '{0}' -- Native error message: {1}".format(self.filename,e))
 
@@ -47,11 +58,10 @@ class Hdf5(object):
         self.pos = sp.array(self.h5['pos'])
 
         ## similar code in bed
-        self._snp_to_index = {}
         logging.info("indexing snps");
-        for i,snp in enumerate(self.rs):
-            if snp in self._snp_to_index : raise Exception("Expect snp to appear in bim file only once. ({0})".format(snp))
-            self._snp_to_index[snp]=i
+        unique_rs, rs_count = sp.unique(self.rs, return_counts=True)
+        if len(unique_rs) != len(self.rs) : raise Exception("Expect snp to appear in bim file only once. ({0})".format(unique_rs[rs_count>1][0]))
+        self._snp_to_index = dict(zip(self.rs, range(len(self.rs))))
 
         self.snpsInFile = self.h5['snps']
 
@@ -87,10 +97,7 @@ class Hdf5(object):
     def is_sorted_without_repeats(list):
         if len(list) < 2:
             return True
-        for i in range(1,len(list)):
-            if not list[i-1] < list[i]:
-                return False
-        return True
+        return bool((SP.diff(list) > 0).all())
     
 
     def __del__(self):
@@ -99,17 +106,16 @@ class Hdf5(object):
 
     def read_direct(self, snps, selection=sp.s_[:,:]):
 
+        #snps is laid out like the file (see create_block), so decide by the file's layout. Deciding by the flags is ambiguous for a single row or column.
         if self.is_snp_major:
             selection = tuple(reversed(selection))
-
-        if snps.flags["F_CONTIGUOUS"]:
             self.snpsInFile.read_direct(snps.T,selection)
         else:
             self.snpsInFile.read_direct(snps,selection)
 
     #!! much code the same as for Bed
-    def create_block(self, blocksize, dtype, order):
-        N_original = len(self.original_iids) #similar code else where -- make a method
+    def create_block(self, blocksize, dtype, order, N_block=None):
+        N_original = len(self.original_iids) if N_block is None else N_block #similar code else where -- make a method
         matches_order = self.is_snp_major == (order =="F") #similar code else where -- make a method
         opposite_order = "C" if order == "F" else "F"#similar code else where -- make a method
         if matches_order:
@@ -148,35 +154,24 @@ class Hdf5(object):
         if is_simple and S == S_original and N == N_original:
             self.read_direct(SNPs)
 
-        # case 2 - some snps and all ids
-        elif is_simple and N == N_original:
-            self.read_direct(SNPs, sp.s_[:,snp_index_list])
-
         # case 3 all snps and some ids
         elif is_simple and S == S_original:
             self.read_direct(SNPs, sp.s_[iid_index_list,:])
 
-        # case 4 some snps and some ids -- use blocks
+        # case 4 some snps and maybe some ids -- read coalesced hyperslabs planned around the chunk layout
         else:
-            blocksize = min(self.blocksize, S)
-            block = self.create_block(blocksize, dtype, order)
-
-            if not snps_are_sorted:
-                snp_index_index_list = sp.argsort(snp_index_list)
-                snp_index_list_sorted = snp_index_list[snp_index_index_list]
-            else:
-                snp_index_index_list = sp.arange(S)
-                snp_index_list_sorted = snp_index_list
-
-            for start in range(0, S, blocksize):
-                #print start
-                end = min(start+blocksize,S)
-                if end-start < blocksize:  #On the last loop, the buffer might be too big, so make it smaller
-                    block = self.create_block(end-start, dtype, order)
-                snp_index_list_forblock = snp_index_list_sorted[start:end]
-                snp_index_index_list_forblock = snp_index_index_list[start:end]
-                self.read_direct(block, sp.s_[:,snp_index_list_forblock])
-                SNPs[:,snp_index_index_list_forblock] = block[iid_index_list,:]
+            iid_index_list = SP.asarray(iid_index_list)
+            iid_start = int(iid_index_list.min()) if N > 0 else 0
+            iid_stop = int(iid_index_list.max()) + 1 if N > 0 else 0
+            iid_is_span = iid_is_sorted and iid_stop - iid_start == N
+            for start, stop, snp_index_index_list_forblock in self._plan_hyperslabs(snp_index_list):
+                block = self.create_block(stop-start, dtype, order, N_block=iid_stop-iid_start)
+                self.read_direct(block, sp.s_[iid_start:iid_stop,start:stop])
+                block_columns = snp_index_list[snp_index_index_list_forblock] - start
+                if iid_is_span:
+                    SNPs[:,snp_index_index_list_forblock] = block[:,block_columns]
+                else:
+                    SNPs[:,snp_index_index_list_forblock] = block[SP.ix_(iid_index_list-iid_start,block_columns)]
 
         rs = self.rs[snp_index_list]
         pos = self.pos[snp_index_list,:]
@@ -196,6 +191,39 @@ class Hdf5(object):
 
 
 
+    def _plan_hyperslabs(self, snp_index_list):
+        '''
+        Group the requested SNPs into contiguous [start,stop) ranges along the SNP axis. Sorted indexes are merged into
+        one range whenever the gap between them stays inside the dataset's chunk extent (those chunks are read anyway),
+        and ranges are cut at chunk boundaries once they reach blocksize SNPs. Yields (start, stop, positions) where
+        positions are the places in snp_index_list served by that range.
+        '''
+        snp_axis = 0 if self.is_snp_major else 1
+        chunks = self.snpsInFile.chunks
+        chunk_length = chunks[snp_axis] if chunks is not None else 1
+        blocksize = max(self.blocksize, chunk_length)
+
+        order = SP.argsort(snp_index_list, kind="mergesort")
+        sorted_list = snp_index_list[order]
+        if len(sorted_list) == 0:
+            return
+        gap_breaks = SP.flatnonzero(SP.diff(sorted_list) > chunk_length) + 1
+        run_starts = SP.concatenate([[0], gap_breaks])
+        run_ends = SP.concatenate([gap_breaks, [len(sorted_list)]])
+        for run_start, run_end in zip(run_starts, run_ends):
+            lo = sorted_list[run_start]
+            while run_start < run_end:
+                #extend to the last chunk boundary that keeps the hyperslab within blocksize SNPs
+                limit = lo + blocksize
+                if chunk_length > 1 and sorted_list[run_end-1] >= limit:
+                    limit = max(lo + 1, (limit // chunk_length) * chunk_length)
+                piece_end = run_start + int(SP.searchsorted(sorted_list[run_start:run_end], limit))
+                hi = sorted_list[piece_end-1] + 1
+                yield int(lo), int(hi), order[run_start:piece_end]
+                run_start = piece_end
+                if run_start < run_end:
+                    lo = sorted_list[run_start]
+
     @property
     def ind_used(self):
         # doesn't need to self.run_once() because only uses original inputs
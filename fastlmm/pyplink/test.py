@@ -23,6 +23,209 @@ class TestDocStrings(unittest.TestCase):
         assert result.failed == 0, "failed doc test: " + __file__
 
 
+class TestVcfToBed(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pysnptools.util import create_directory_if_necessary
+        create_directory_if_necessary(self.tempout_dir, isfile=False)
+
+    tempout_dir = "tempout/vcf_to_bed"
+
+    def file_name(self,testcase_name):
+        temp_fn = os.path.join(self.tempout_dir,testcase_name)
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        return temp_fn
+
+    def test_vcf_to_bed(self):
+        import gzip
+        import shutil
+        from fastlmm.pyplink.vcfpy import vcf_to_bed
+        from pysnptools.snpreader import Bed
+
+        vcf_fn = os.path.join(os.path.dirname(os.path.realpath(__file__)), "chr22.small.vcf")
+        genotype_map = {'0|0': 0.0, '0|1': 1.0, '1|0': 1.0, '1|1': 2.0}
+        expected, expected_dosage = [], []
+        with open(vcf_fn) as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.strip().split('\t')
+                expected.append([genotype_map.get(field[:3], np.nan) for field in fields[9:]])
+                expected_dosage.append([np.rint(float(field.split(':')[1])) for field in fields[9:]])
+        expected, expected_dosage = np.array(expected).T, np.array(expected_dosage).T
+
+        base = self.file_name("whole")
+        assert vcf_to_bed(vcf_fn, base) == expected.shape[1]
+        np.testing.assert_array_equal(Bed(base, count_A1=False).read().val, expected)
+
+        #several byte ranges of one file must give the same bytes as one pass
+        base_parts = self.file_name("parts")
+        vcf_to_bed(vcf_fn, base_parts, parts_per_file=5, chunk_size=7)
+        for suffix in [".bed", ".bim", ".fam"]:
+            with open(base + suffix, 'rb') as f0, open(base_parts + suffix, 'rb') as f1:
+                assert f0.read() == f1.read()
+
+        gz_fn = self.file_name("chr22.small.vcf.gz")
+        with open(vcf_fn, 'rb') as f, gzip.open(gz_fn, 'wb') as g:
+            shutil.copyfileobj(f, g)
+        base_dosage = self.file_name("dosage")
+        assert vcf_to_bed([gz_fn, vcf_fn], base_dosage, dosage=True) == 2 * expected.shape[1]
+        np.testing.assert_array_equal(Bed(base_dosage, count_A1=False).read().val, np.hstack([expected_dosage, expected_dosage]))
+
+    def test_multiallelic_and_missing_dosage(self):
+        from fastlmm.pyplink.vcfpy import vcf_to_bed
+        from pysnptools.snpreader import Bed
+
+        lines = ["##fileformat=VCFv4.2",
+                 "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ta\tb\tc",
+                 "1\t10\trs1\tA\tG\t.\tPASS\t.\tGT:DS\t0|0:0.1\t0|1:.\t1|1:1.9",
+                 "1\t20\trs2\tA\tC,T\t.\tPASS\t.\tGT:DS\t0|2:1.0,1.0\t1|2:1.0,1.0\t0|0:0,0", #multi-allelic, skipped
+                 "1\t30\trs3\tC\tT\t.\tPASS\t.\tGT:DS\t1|0:1.2e0\t0|0\t0|1:0.6", #a sample without its DS subfield
+                 "1\t40\trs4\tG\tA\t.\tPASS\t.\tGT:DS\t1|1:2.0\t0|0:0.4\t./.:"]
+        vcf_fn = self.file_name("small.vcf")
+        with open(vcf_fn, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        for dosage, expected in [(False, [[0, 1, 2], [1, 0, 1], [2, 0, np.nan]]),
+                                 (True, [[0, np.nan, 2], [1, np.nan, 1], [2, 0, np.nan]])]:
+            base = self.file_name("small_{0}".format(dosage))
+            assert vcf_to_bed(vcf_fn, base, dosage=dosage, chunk_size=2) == 3
+            snpdata = Bed(base, count_A1=False).read()
+            assert list(snpdata.sid) == ["rs1", "rs3", "rs4"]
+            np.testing.assert_array_equal(snpdata.val, np.array(expected).T)
+
+        ds_fn = self.file_name("ds_only.vcf") #for example, imputation output without GT
+        with open(ds_fn, "w") as f:
+            f.write("\n".join(lines[:2] + ["1\t10\trs1\tA\tG\t.\tPASS\t.\tDS\t0.1\t1.0\t1.9"]) + "\n")
+        with self.assertRaises(Exception):
+            vcf_to_bed(ds_fn, self.file_name("ds_only"), dosage=False)
+        assert vcf_to_bed(ds_fn, self.file_name("ds_only"), dosage=True) == 1
+
+class TestHdf5(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pysnptools.util import create_directory_if_necessary
+        create_directory_if_necessary(self.tempout_dir, isfile=False)
+
+    tempout_dir = "tempout/hdf5"
+
+    def file_name(self,testcase_name):
+        temp_fn = os.path.join(self.tempout_dir,testcase_name)
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        return temp_fn
+
+    def test_subset_reads(self):
+        from fastlmm.pyplink.snpreader.Hdf5 import Hdf5
+        from fastlmm.pyplink.snpset import SnpIndexList
+
+        randomstate = np.random.RandomState(1)
+        iid_count, snp_count = 40, 500
+        snp_matrix = {'snps': randomstate.randn(iid_count, snp_count),
+                      'iid': np.array([['f{0}'.format(i), 'i{0}'.format(i)] for i in range(iid_count)]).astype('S'),
+                      'pos': np.c_[np.ones(snp_count), np.arange(snp_count), np.arange(snp_count)],
+                      'rs': np.array(['rs{0}'.format(i) for i in range(snp_count)]).astype('S')}
+        for snp_major in [True, False]:
+            hdf5file = self.file_name("snps{0}.hdf5".format(int(snp_major)))
+            Hdf5.write(snp_matrix, hdf5file, snp_major=snp_major)
+            for blocksize in [3, 5000]:
+                reader = Hdf5(hdf5file, blocksize=blocksize, chunk_cache_size=4*1024*1024)
+                assert reader.snp_to_index['rs7'] == 7
+                for iid_index_list in [np.arange(iid_count), np.array([5, 2, 9]), np.arange(3, 11)]:
+                    reader.ind_used = iid_index_list
+                    for snp_index_list in [np.sort(randomstate.choice(snp_count, 50, replace=False)), randomstate.choice(snp_count, 50, replace=False), np.array([4, 4, 1]), np.array([7])]:
+                        for order in ['F', 'C']:
+                            result = reader.read(SnpIndexList(list(snp_index_list)), order=order)
+                            np.testing.assert_array_equal(result['snps'], snp_matrix['snps'][np.ix_(iid_index_list, snp_index_list)])
+                reader.h5.close()
+                reader.h5 = None
+
+class TestDat(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pysnptools.util import create_directory_if_necessary
+        create_directory_if_necessary(self.tempout_dir, isfile=False)
+
+    tempout_dir = "tempout/dat"
+
+    def file_name(self,testcase_name):
+        temp_fn = os.path.join(self.tempout_dir,testcase_name)
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        return temp_fn
+
+    def test_row_offset_reads(self):
+        from fastlmm.pyplink.snpreader.Dat import Dat
+        from fastlmm.pyplink.snpset import SnpIndexList
+
+        randomstate = np.random.RandomState(2)
+        iid_count, snp_count = 20, 150
+        snp_matrix = {'snps': np.round(randomstate.rand(iid_count, snp_count) * 2, 3),
+                      'iid': np.array([['f{0}'.format(i), 'i{0}'.format(i)] for i in range(iid_count)]),
+                      'pos': np.c_[np.ones(snp_count), np.arange(snp_count), np.arange(snp_count)],
+                      'rs': np.array(['rs{0}'.format(i) for i in range(snp_count)])}
+        dat_filename = self.file_name("snps.dat")
+        Dat.write(snp_matrix, dat_filename)
+        index_filename = self.file_name("snps.dat.offsets.npy")
+        for _ in range(2): #the second pass reuses the persisted index
+            reader = Dat(dat_filename, index_filename=index_filename, blocksize=7)
+            np.testing.assert_array_equal(reader.read()['snps'], snp_matrix['snps'])
+            reader.ind_used = np.array([4, 2, 9])
+            snp_index_list = [5, 3, 3, 149, 0, 100, 101, 102]
+            result = reader.read(SnpIndexList(snp_index_list), order='C')
+            np.testing.assert_array_equal(result['snps'], snp_matrix['snps'][np.ix_([4, 2, 9], snp_index_list)])
+            np.testing.assert_array_equal(result['rs'], snp_matrix['rs'][snp_index_list])
+            assert os.path.exists(index_filename)
+
+class TestPlinkText(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pysnptools.util import create_directory_if_necessary
+        create_directory_if_necessary(self.tempout_dir, isfile=False)
+
+    tempout_dir = "tempout/plink_text"
+
+    def file_name(self,testcase_name):
+        temp_fn = os.path.join(self.tempout_dir,testcase_name)
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        return temp_fn
+
+    def test_read_ped(self):
+        from fastlmm.pyplink.plink import readPED
+        from pysnptools.snpreader import Bed
+
+        basefilename = os.path.join(os.path.dirname(os.path.realpath(__file__)), "testdata", "test")
+        expected = np.array([[2, 2, 2], [0, np.nan, 1], [np.nan, 1, 1], [0, 2, np.nan], [0, 2, np.nan], [0, 2, 0]])
+        bed_basefilename = self.file_name("fromped")
+        result = readPED(basefilename, standardize=False, chunk_size=4, bed_basefilename=bed_basefilename)
+        np.testing.assert_array_equal(result['snps'], expected)
+        np.testing.assert_array_equal(result['rs'], ['snp1', 'snp2', 'snp3'])
+        np.testing.assert_array_equal(Bed(bed_basefilename, count_A1=True).read().val, expected)
+        #same genotypes as the PLINK-made BED file, up to which allele is counted
+        plink_val = Bed(basefilename, count_A1=True).read().val
+        np.testing.assert_array_equal(plink_val[:,0], expected[:,0])
+        np.testing.assert_array_equal(plink_val[:,1:], 2 - expected[:,1:])
+
+        standardized = readPED(basefilename)['snps']
+        np.testing.assert_array_almost_equal(standardized.mean(0), 0)
+        np.testing.assert_array_equal(standardized[np.isnan(expected)], 0)
+
+    def test_read_raw(self):
+        from fastlmm.pyplink.plink import readRAW
+
+        basefilename = self.file_name("test")
+        with open(basefilename + ".raw", "w") as f:
+            f.write("FID IID PAT MAT SEX PHENOTYPE snp1_G snp2_1 snp3_C\n1 1 0 0 1 0 2 2 2\n1 2 0 0 1 0 0 NA 1\n1 3 1 2 1 2 NA 1 1\n")
+        result = readRAW(basefilename, standardize=False)
+        np.testing.assert_array_equal(result['snps'], [[2, 2, 2], [0, np.nan, 1], [np.nan, 1, 1]])
+        np.testing.assert_array_equal(result['rs'], ['snp1', 'snp2', 'snp3'])
+        np.testing.assert_array_equal(result['iid'], [['1', '1'], ['1', '2'], ['1', '3']])
+
 
 def getTestSuite():
     """
@@ -31,6 +234,10 @@ def getTestSuite():
     
     test_suite = unittest.TestSuite([])
     test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestDocStrings))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestVcfToBed))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestHdf5))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestDat))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestPlinkText))
 
     return test_suite
 
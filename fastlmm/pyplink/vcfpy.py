@@ -1,114 +1,273 @@
 from __future__ import absolute_import
 from __future__ import print_function
-import sys
-import pdb
 import os
 import gzip
-import re
-import scipy as SP
+import shutil
+import logging
+import numpy as np
 from six.moves import range
-writesmall = 0
-
-datadir = ""
-base = ""
-tbi = base+".tbi"
-basef=os.path.join(datadir,base)
-basefsmall = "chr22.small.txt.gz"
-basefsmall = 'chr22.small.txt'
-baseftbi = basef + ".tbi"
-
-if writesmall:
-    file = gzip.GzipFile(basef, 'r')
-    #outfsmall = gzip.GzipFile(basefsmall,'w')
-    outfsmall = open(basefsmall,'w')
-else:
-    file = open(basefsmall,'r')
-line = file.readline()
-if writesmall:
-    outfsmall.write(line)
-if line != '##fileformat=VCFv4.1\n':
-    print('wrong format')
-iline = 0
-header = ''
-while (line[0:2]=='##'):
-    header = header+line
-    line = file.readline()
-    if writesmall:
-        outfsmall.write(line)
-    iline+=1;
-if line[0:6] == '#CHROM':
-    fields = line[1::].strip().split('\t')
-    indID=fields[9::]
-    fields=fields[0:9]
-
-
-famfile = open('test.fam','w')
-for id in indID:
-   outline = '0 ' + id + ' 0 0 0 -9\n'
-   famfile.write(outline)
-famfile.close()
-ninds = len(indID)
-
-line = file.readline()
-if writesmall:
-    outfsmall.write(line)
-
-bedfile = open('test.bed','wb')
-bimfile = open('test.bim','w')
-
-#init bedfile
-bedfile.write(b'l\x1b')#bed header
-bedfile.write(b'\x01')
-#genomap=[]
-#geno = []
-iline = 0
-if writesmall:
-    maxline =100
-else:
-    maxline = 10000000
-while (iline < maxline ) and (line !=''):
-    vals = line.strip().split('\t')
-    if (vals[6]=='PASS'):
-        linebim = vals[0] + ' ' + vals[2] + ' 0 ' + vals[1] + ' ' + vals[3] + ' ' + vals[4] + '\n'
-        bimfile.write(linebim)
-        #genomap.append(vals[0:9])
-        #geno.append(vals[9::])
-
-        #write bedfile entries
-        nbytes = SP.ceil(ninds/4.0)
-        ndone = 0
-        for i in range(int(SP.ceil(ninds/4.0))):
-            num = min(4,ninds-ndone)
-            geno = vals[9+i*4:9+(i)*4+num]
-            byte = 0
-            #pdb.set_trace()
-            for j in range(num):
-
-                if geno[j][0:3]=='0|0':
-                    #byte += 0*(2**(2*j))
-                    pass
-                elif geno[j][0:3]=='0|1' or geno[j][0:3]=='1|0':
-                    byte += 2*(2**(2*j))
-                elif geno[j][0:3]=='1|1':
-                    byte += 3*(2**(2*j))
-                else:
-                    #pdb.set_trace()
-                    byte += 1*(2**(2*j))
-                pass
-
-            bytestr = '%c'%byte
-            bedfile.write(bytestr)
-            ndone +=num
-            pass
-    line = file.readline()
-    if writesmall:
-        outfsmall.write(line)
-    iline+=1
-file.close()
-if writesmall:
-    outfsmall.close()
-bimfile.close()
-bedfile.close()
-
-#filetbi = open(baseftbi,'r')
-#filetbigz = gzip.GzipFile(baseftbi,'r')
+
+BED_MAGIC = b'l\x1b\x01' #bed header, SNP-major mode
+
+def vcf_to_bed(vcf_filenames, basefilename, dosage=False, pass_only=True, chunk_size=1000, parts_per_file=1, runner=None):
+    '''
+    stream one or more VCF files (plain or gzip) into [basefilename].bed, [basefilename].bim and [basefilename].fam
+    --------------------------------------------------------------------------
+    Input:
+    vcf_filenames   : string or list of strings, e.g. one VCF per chromosome. All files must list the same samples.
+    basefilename    : string of the basename of the output files
+    dosage          : boolean
+                        False   : use the hard calls in the GT field (default)
+                        True    : round the DS field (expected ALT allele count) to the nearest hard call
+    pass_only       : only keep variants whose FILTER is PASS (default True)
+    chunk_size      : number of variants parsed and packed at a time. Bounds the memory used by a
+                        worker to about chunk_size * #samples bytes (default 1000)
+    parts_per_file  : number of byte ranges each plain-text VCF is split into, so that several processes
+                        can work on one file. Gzip files can not be seeked and always form one part. (default 1)
+    runner          : a pysnptools Runner such as LocalMultiProc to work on the parts in parallel.
+                        (default None, runs all parts in the current process)
+    --------------------------------------------------------------------------
+    Output:
+    number of variants written
+    --------------------------------------------------------------------------
+    Genotypes are coded with REF as allele 1 and ALT as allele 2. Unparseable calls are written as missing.
+    Multi-allelic variants (an ALT with a ',') are skipped and their number is logged.
+    '''
+    from pysnptools.util.mapreduce1 import map_reduce
+
+    if isinstance(vcf_filenames, str):
+        vcf_filenames = [vcf_filenames]
+
+    part_list = []
+    for vcf_filename in vcf_filenames:
+        part_list.extend(_file_parts(vcf_filename, parts_per_file))
+    logging.info("converting {0} VCF file(s) in {1} part(s)".format(len(vcf_filenames), len(part_list)))
+
+    def mapper(part_index):
+        vcf_filename, start, end = part_list[part_index]
+        part_basefilename = "{0}.part{1}".format(basefilename, part_index)
+        sample_list, snp_count = _convert_part(vcf_filename, start, end, part_basefilename, dosage=dosage, pass_only=pass_only, chunk_size=chunk_size)
+        return part_basefilename, sample_list, snp_count
+
+    def reducer(result_sequence):
+        return _combine_parts(list(result_sequence), basefilename)
+
+    return map_reduce(range(len(part_list)), mapper=mapper, reducer=reducer, name="vcf_to_bed", runner=runner)
+
+def pack_bed(codes):
+    '''
+    pack an [S*N] array of 2-bit BED genotype codes (0: homozygous allele 1, 1: missing, 2: heterozygous,
+    3: homozygous allele 2) into the SNP-major BED byte layout ([S*ceil(N/4)] uint8)
+    '''
+    codes = np.asarray(codes, dtype=np.uint8)
+    snp_count, iid_count = codes.shape
+    byte_count = (iid_count + 3) // 4
+    padded = np.zeros((snp_count, byte_count * 4), dtype=np.uint8)
+    padded[:, :iid_count] = codes
+    padded = padded.reshape(snp_count, byte_count, 4)
+    return padded[:, :, 0] | (padded[:, :, 1] << 2) | (padded[:, :, 2] << 4) | (padded[:, :, 3] << 6)
+
+def genotype_codes(genotype_fields):
+    '''
+    vectorized translation of an [S*N] array of VCF sample fields (bytes) into BED codes using the GT subfield
+    '''
+    chars = np.asarray(genotype_fields, dtype='S3')
+    chars = chars.view(np.uint8).reshape(chars.shape + (3,))
+    allele0 = chars[..., 0]
+    separator = chars[..., 1]
+    haploid = (separator == 0) | (separator == ord(':')) #haploid calls, e.g. on chrX, count as homozygous
+    allele1 = np.where(haploid, allele0, np.where((separator == ord('|')) | (separator == ord('/')), chars[..., 2], 0))
+    is_ref0, is_alt0 = allele0 == ord('0'), allele0 == ord('1')
+    is_ref1, is_alt1 = allele1 == ord('0'), allele1 == ord('1')
+    codes = np.ones(chars.shape[:-1], dtype=np.uint8)
+    codes[is_ref0 & is_ref1] = 0
+    codes[(is_ref0 & is_alt1) | (is_alt0 & is_ref1)] = 2
+    codes[is_alt0 & is_alt1] = 3
+    return codes
+
+def dosage_codes(dosages):
+    '''
+    round an [S*N] array of ALT allele dosages to BED codes, NaN becomes missing
+    '''
+    dosages = np.asarray(dosages, dtype=np.float64)
+    codes = np.ones(dosages.shape, dtype=np.uint8)
+    rounded = np.rint(dosages)
+    codes[rounded == 0] = 0
+    codes[rounded == 1] = 2
+    codes[rounded == 2] = 3
+    return codes
+
+def _open_vcf(vcf_filename):
+    with open(vcf_filename, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(vcf_filename, 'rb'), True
+    return open(vcf_filename, 'rb'), False
+
+def _read_header(vcf_file):
+    '''
+    read the meta lines and the #CHROM line, returns the sample ids. Leaves the file at the first variant.
+    '''
+    line = vcf_file.readline()
+    if not line.startswith(b'##fileformat=VCF'):
+        raise Exception("expected a VCF file starting with '##fileformat=VCF'")
+    while line.startswith(b'##'):
+        line = vcf_file.readline()
+    if not line.startswith(b'#CHROM'):
+        raise Exception("expected the '#CHROM' header line after the meta lines")
+    fields = line.rstrip(b'\r\n').split(b'\t')
+    return [field.decode('ascii') for field in fields[9:]]
+
+def _file_parts(vcf_filename, parts_per_file):
+    '''
+    split the variant lines of a file into [(vcf_filename, start, end)] byte ranges. A line belongs to the range it starts in.
+    '''
+    vcf_file, is_gzip = _open_vcf(vcf_filename)
+    with vcf_file:
+        if is_gzip or parts_per_file <= 1:
+            return [(vcf_filename, None, None)]
+        _read_header(vcf_file)
+        data_start = vcf_file.tell()
+    file_size = os.path.getsize(vcf_filename)
+    bounds = np.linspace(data_start, file_size, parts_per_file + 1).astype(np.int64)
+    return [(vcf_filename, int(bounds[i]), int(bounds[i + 1])) for i in range(parts_per_file) if bounds[i] < bounds[i + 1]]
+
+def _variant_lines(vcf_file, start, end):
+    if start is not None:
+        vcf_file.seek(start - 1)
+        if vcf_file.read(1) != b'\n':
+            vcf_file.readline() #the partial line belongs to the previous part
+    while True:
+        if end is not None and vcf_file.tell() >= end:
+            return
+        line = vcf_file.readline()
+        if not line:
+            return
+        yield line
+
+def _convert_part(vcf_filename, start, end, part_basefilename, dosage, pass_only, chunk_size):
+    vcf_file, _ = _open_vcf(vcf_filename)
+    snp_count = 0
+    multiallelic_count = 0
+    with vcf_file, open(part_basefilename + ".bed", 'wb') as bed_file, open(part_basefilename + ".bim", 'w') as bim_file:
+        sample_list = _read_header(vcf_file)
+        chunk = []
+        for line in _variant_lines(vcf_file, start, end):
+            fields = line.rstrip(b'\r\n').split(b'\t', 9) #the sample fields stay joined in fields[9]
+            if len(fields) < 10:
+                continue #blank line
+            if pass_only and fields[6] != b'PASS':
+                continue
+            if b',' in fields[4]:
+                multiallelic_count += 1 #a .bim file holds one ALT allele
+                continue
+            if not dosage and not fields[8].startswith(b'GT'):
+                raise Exception("variant at {0}:{1} has FORMAT '{2}', which doesn't start with GT. (For dosage-only files, use dosage=True.)".format(fields[0].decode('ascii'), fields[1].decode('ascii'), fields[8].decode('ascii')))
+            chunk.append(fields)
+            if len(chunk) == chunk_size:
+                snp_count += _write_chunk(chunk, len(sample_list), dosage, bed_file, bim_file)
+                chunk = []
+        if chunk:
+            snp_count += _write_chunk(chunk, len(sample_list), dosage, bed_file, bim_file)
+    if multiallelic_count > 0:
+        logging.info("skipped {0} multi-allelic variant(s) in {1}".format(multiallelic_count, vcf_filename))
+    return sample_list, snp_count
+
+def _write_chunk(chunk, iid_count, dosage, bed_file, bim_file):
+    for fields in chunk:
+        if fields[9].count(b'\t') + 1 != iid_count:
+            raise Exception("variant at {0}:{1} has {2} sample fields, expected {3}".format(fields[0].decode('ascii'), fields[1].decode('ascii'), fields[9].count(b'\t') + 1, iid_count))
+    if dosage:
+        codes = dosage_codes(_dosage_chunk(chunk, iid_count))
+    else:
+        codes = genotype_codes([fields[9].split(b'\t') for fields in chunk])
+    bed_file.write(pack_bed(codes).tobytes())
+
+    bim_lines = []
+    for fields in chunk:
+        chrom, pos, rsid, ref, alt = [field.decode('ascii') for field in fields[:5]]
+        if rsid == '.':
+            rsid = "{0}:{1}".format(chrom, pos)
+        bim_lines.append("{0}\t{1}\t0\t{2}\t{3}\t{4}\n".format(chrom, rsid, pos, ref, alt))
+    bim_file.write(''.join(bim_lines))
+    return len(chunk)
+
+def _dosage_chunk(chunk, iid_count):
+    '''
+    the [S*N] DS values of a chunk. Variants that share a FORMAT are parsed together: their (still tab-joined) sample
+    fields are joined into one byte string, the subfield boundaries found with numpy and the DS subfields converted by
+    :func:`parse_floats`. A group in which some sample field lacks trailing subfields falls back to parsing one sample
+    field at a time.
+    '''
+    result = np.full((len(chunk), iid_count), np.nan)
+    group_dict = {}
+    for index, fields in enumerate(chunk):
+        group_dict.setdefault(fields[8], []).append(index)
+    for format_field, index_list in group_dict.items():
+        format_list = format_field.split(b':')
+        ds_index = _ds_index(chunk[index_list[0]], format_list)
+        buf = np.frombuffer(b'\t'.join(chunk[index][9] for index in index_list), dtype=np.uint8)
+        separators = np.flatnonzero((buf == ord(':')) | (buf == ord('\t')))
+        if len(separators) + 1 != len(index_list) * iid_count * len(format_list):
+            for index in index_list:
+                result[index] = _dosage_field(chunk[index])
+            continue
+        starts = np.r_[0, separators + 1][ds_index::len(format_list)]
+        ends = np.r_[separators, len(buf)][ds_index::len(format_list)]
+        result[index_list] = parse_floats(buf, starts, ends).reshape(len(index_list), iid_count)
+    return result
+
+def parse_floats(buf, starts, ends):
+    '''
+    vectorized float() of the byte tokens buf[starts[i]:ends[i]] of a uint8 array. The tokens are gathered into one
+    fixed-width bytes array and cast by numpy. '.' and empty tokens become NaN.
+
+    >>> buf = np.frombuffer(b'0.125:2:.:-1.5:1e-3:', dtype=np.uint8)
+    >>> parse_floats(buf, np.array([0, 6, 8, 10, 15, 20]), np.array([5, 7, 9, 14, 19, 20])).tolist()
+    [0.125, 2.0, nan, -1.5, 0.001, nan]
+    '''
+    lengths = ends - starts
+    width = max(int(lengths.max()) if len(lengths) > 0 else 0, 3) #room for 'nan'
+    padded = np.zeros(len(buf) + width, dtype=np.uint8) #so every token can be read at full width
+    padded[:len(buf)] = buf
+    chars = padded[starts[:, np.newaxis] + np.arange(width)]
+    chars[np.arange(width) >= lengths[:, np.newaxis]] = 0 #a bytes array ends each value at its first 0
+    tokens = chars.view('S{0}'.format(width)).reshape(-1)
+    tokens[(tokens == b'.') | (tokens == b'')] = b'nan'
+    return tokens.astype(np.float64)
+
+def _ds_index(fields, format_list):
+    if b'DS' not in format_list:
+        raise Exception("dosage requested, but variant at {0}:{1} has no DS field".format(fields[0].decode('ascii'), fields[1].decode('ascii')))
+    return format_list.index(b'DS')
+
+def _dosage_field(fields):
+    ds_index = _ds_index(fields, fields[8].split(b':'))
+    sample_fields = fields[9].split(b'\t')
+    result = np.full(len(sample_fields), np.nan)
+    for i, sample_field in enumerate(sample_fields):
+        subfields = sample_field.split(b':')
+        if len(subfields) > ds_index and subfields[ds_index] != b'.':
+            result[i] = float(subfields[ds_index])
+    return result
+
+def _combine_parts(part_results, basefilename):
+    sample_list = None
+    snp_count = 0
+    with open(basefilename + ".bed", 'wb') as bed_file, open(basefilename + ".bim", 'w') as bim_file:
+        bed_file.write(BED_MAGIC)
+        for part_basefilename, part_sample_list, part_snp_count in part_results:
+            if sample_list is None:
+                sample_list = part_sample_list
+            elif sample_list != part_sample_list:
+                raise Exception("all VCF files must list the same samples in the same order")
+            for suffix, out_file, mode in [(".bed", bed_file, 'rb'), (".bim", bim_file, 'r')]:
+                with open(part_basefilename + suffix, mode) as part_file:
+                    shutil.copyfileobj(part_file, out_file)
+                os.remove(part_basefilename + suffix)
+            snp_count += part_snp_count
+
+    with open(basefilename + ".fam", 'w') as fam_file:
+        fam_file.write(''.join('0 {0} 0 0 0 -9\n'.format(sample) for sample in sample_list))
+    logging.info("wrote {0} variants for {1} samples to {2}.bed".format(snp_count, len(sample_list), basefilename))
+    return snp_count
@@ -51,7 +51,8 @@ def compute_auto_pcs(snpreader, cutoff=.1, k_values=np.arange(11), output_file_n
         #use vertex cut to find just parents
         logging.info("Finding relatedness of all iids")
         from pysnptools.standardizer import Identity
-        rrm = all_std_snpdata.kernel(Identity()) / snpreader.sid_count
+        from fastlmm.util.matrix.kernel_store import build_kernel
+        rrm = build_kernel(all_std_snpdata, standardizer=Identity()).val / snpreader.sid_count #upper triangle only, via SYRK
         import fastlmm.util.VertexCut as vc
         remove_set = set(vc.VertexCut().work(rrm,cutoff)) #These are the indexes of the IIDs to remove
         logging.info("removing {0} of {1} iids".format(len(remove_set), snpreader.iid_count))
@@ -70,8 +71,9 @@ def compute_auto_pcs(snpreader, cutoff=.1, k_values=np.arange(11), output_file_n
         folds = KFold(n_splits = n_folds, shuffle=True, random_state=randomstate).split(list(range(nofam_snpreader.sid_count)))
         
         scores = np.zeros((k_values.shape[0],n_folds))
+        max_k = max(k_values)
         for i_fold, [train_idx,test_idx] in enumerate(folds):
-            Utr,Str,Vtr,mean = None, None, None, None
+            Str,Vtr,mean,total_variance = None, None, None, None
             logging.info('test set size: {0}'.format(len(test_idx)))
 
             logging.info('creating X_train for fold {0}'.format(i_fold))
@@ -84,11 +86,11 @@ def compute_auto_pcs(snpreader, cutoff=.1, k_values=np.arange(11), output_file_n
             X_test = nofam_snpreader[:,test_idx].read(order='F').val.T
             logging.info("done after %.4f seconds" % (time.time() - t0))
 
-            logging.info('Creating svd')
+            logging.info('Creating truncated svd with {0} components'.format(max_k))
             t0 = time.time()
-            for i_k, k in enumerate(k_values):
+            for i_k, k in enumerate(k_values): #Every k reuses the leading components of one decomposition
                 pca = PCA(n_components = k, copy=False)
-                Utr,Str,Vtr,mean = pca._fit(X_train,Utr,Str,Vtr,mean)
+                Str,Vtr,mean,total_variance = pca._fit_truncated(X_train,max_k,Str,Vtr,mean,total_variance)
                 if t0 is not None:
                     logging.info("done after %.4f seconds" % (time.time() - t0))
                     t0 = None
@@ -3,36 +3,43 @@ from __future__ import print_function
 import fastlmm.inference.lmm_cov as lmm_cov
 import numpy as np
 
-def est_h2(Y, K, covariates=None, nGridH2=10000, plot=True, verbose=True):
+def est_h2(Y, K, covariates=None, nGridH2=10000, plot=True, verbose=True, credible_level=0.95):
     """
     This function implements the Bayesian heritability estimate from Furlotte et al., 2014
 
     Furlotte, Nicholas A., David Heckerman, and Christoph Lippert.
     "Quantifying the uncertainty in heritability." Journal of human genetics 59.5 (2014): 269-275.
 
+    The likelihood of the whole h2 grid is evaluated for all phenotypes at once (see lmm_cov.LMM.posterior_h2_summary).
+
     Args:
-        Y:              [N x 1] np.ndarray of phenotype values
+        Y:              [N x 1] np.ndarray of phenotype values, or [N x P] for P phenotypes
         K:              [N x N] np.ndarray of kinship values
         covariates:     [N x D] np.ndarray of covariate values [default: None]
         plot:           Boolean, create a plot? [default: True]
         verbose:        print results? [default: True]
+        credible_level: probability mass of the credible interval that is printed [default: 0.95]
 
     returns:
-        REML estimate of h^2 (as in Yang et al. 2010)
-        posterior mean of h^2
-        posterior variance of h^2
+        REML estimate of h^2 (as in Yang et al. 2010), a list of estimates for P>1
+        posterior mean of h^2, a [P] np.ndarray for P>1
+        posterior variance of h^2, a [P] np.ndarray for P>1
         h2 values on a grid
-        posterior for h2 values on a grid
+        posterior for h2 values on a grid, [nGrid x P]
     """
     lmm = lmm_cov.LMM(forcefullrank=False, X=covariates, linreg=None, Y=Y, G=None, K=K, regressX=True, inplace=False)
-    h2 = lmm.findH2()
-    h2_posterior = lmm.posterior_h2(nGridH2=nGridH2)
-    logp = -h2_posterior[2]
-    grid = h2_posterior[1]
-    post_h2 = np.exp(logp-logp.max())/np.exp(logp-logp.max()).sum()*logp.shape[0]
-    h2_mean = (np.exp(logp-logp.max())*grid[:,np.newaxis]).sum()/np.exp(logp-logp.max()).sum()
-    h2_var = (np.exp(logp-logp.max())*(grid[:,np.newaxis] - h2_mean)**2.0).sum()/np.exp(logp-logp.max()).sum()
+    P = lmm.Y.shape[1]
+    h2 = lmm.findH2(vectorized=P > 1)
+    summary = lmm.posterior_h2_summary(nGridH2=nGridH2, credible_level=credible_level)
+    grid = summary['grid']
+    post_h2 = summary['posterior'] * grid.shape[0]
+    h2_mean = summary['mean']
+    h2_var = summary['var']
+    if P == 1:
+        h2_mean = h2_mean[0]
+        h2_var = h2_var[0]
     if plot:
+        assert P == 1, "plotting is only supported for a single phenotype"
         import pylab as plt
         plt.figure()
         plt.plot([h2['h2'],h2['h2']],[0,1],"r")
@@ -42,5 +49,7 @@ def est_h2(Y, K, covariates=None, nGridH2=10000, plot=True, verbose=True):
         plt.xlabel("$h^2$")
         plt.ylabel("$p( h^2 | Data)$")
     if verbose:
-        print("max[h^2] = %.5f  E[h^2] = %.5f +- %.5f" % (h2['h2'], h2_mean,np.sqrt(h2_var)))
-    return h2, h2_mean, h2_var, grid, post_h2 
\ No newline at end of file
+        h2_list = [h2] if P == 1 else h2
+        for i in range(P):
+            print("max[h^2] = %.5f  E[h^2] = %.5f +- %.5f  %g%% credible interval [%.5f, %.5f]" % (np.ravel(h2_list[i]['h2'])[0], summary['mean'][i], np.sqrt(summary['var'][i]), 100*credible_level, summary['lower'][i], summary['upper'][i]))
+    return h2, h2_mean, h2_var, grid, post_h2
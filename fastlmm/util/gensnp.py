@@ -59,3 +59,207 @@ def gensnps(numSnp,nInd,minMaf=0.05,maxMaf=0.4,standardize=False):
         raise NotImplementedError()
 
     return snpDat
+
+def simulate_cohort(basefilename, iid_count, sid_count, chrom_count=22, pop_count=1, fst=0.1, family_size=0,
+                    ld_block_size=20, ld_rho=0.8, min_maf=0.05, max_maf=0.5, pheno_count=1, h2=0.5, causal_fraction=0.01,
+                    genetic_correlation=0.0, covar_count=0, covar_variance=0.1, chunk_size=1000, part_count=1, seed=0, runner=None):
+    """
+    Simulate a cohort and stream it to [basefilename].bed/.bim/.fam, [basefilename].phe and, if covar_count>0, [basefilename].cov.
+    Genotypes are generated and written one chunk of SNPs at a time and nothing of size N*N is ever formed, so cohorts of
+    100k-1M individuals can be simulated with memory proportional to chunk_size*iid_count.
+    --------------------------------------------------------------------------
+    Input:
+    basefilename        : string of the basename of the output files
+    iid_count           : number of individuals
+    sid_count           : number of SNPs, spread evenly over the chromosomes
+    chrom_count         : number of chromosomes (default 22)
+    pop_count           : number of populations. Their allele frequencies differ from the ancestral ones by the
+                            Balding-Nichols model with the given fst. (default 1, no population structure)
+    fst                 : fixation index between the populations (default 0.1)
+    family_size         : if at least 3, the individuals form nuclear families of two parents and family_size-2 children.
+                            Each child inherits one haplotype of each parent per LD block. (default 0, unrelated individuals)
+    ld_block_size       : number of SNPs per LD block. Blocks are independent. (default 20)
+    ld_rho              : correlation between the latent haplotype values of neighboring SNPs in a block (default 0.8)
+    min_maf, max_maf    : the ancestral allele frequencies are uniform between these (default 0.05, 0.5)
+    pheno_count         : number of phenotypes (default 1)
+    h2                  : heritability, a number or a list with one per phenotype (default 0.5)
+    causal_fraction     : probability that a SNP is causal (default 0.01). Causal SNPs are shared by all phenotypes.
+    genetic_correlation : correlation of the SNP effects between phenotypes, less than 1 (default 0.0)
+    covar_count         : number of standard normal covariates (default 0)
+    covar_variance      : phenotype variance added by the covariates (default 0.1)
+    chunk_size          : number of SNPs generated and written at a time, rounded to whole LD blocks (default 1000)
+    part_count          : number of parts the chunks are split into, so several processes can work on them (default 1)
+    seed                : random seed. The genotypes do not depend on part_count or runner, the phenotypes only up to rounding. (default 0)
+    runner              : a pysnptools Runner such as LocalMultiProc to simulate the parts in parallel.
+                            (default None, runs all parts in the current process)
+    --------------------------------------------------------------------------
+    Output dictionary:
+    'bed'       : name of the .bed file
+    'pheno'     : name of the phenotype file
+    'covar'     : name of the covariate file (None if covar_count is 0)
+    'causal_sid': array of the ids of the causal SNPs
+    --------------------------------------------------------------------------
+    The .bed file is written so that Bed(..., count_A1=False) reads the number of copies of the simulated (second) allele.
+    """
+    import numpy as np
+    import pandas as pd
+    from pysnptools.util.mapreduce1 import map_reduce
+
+    h2 = np.broadcast_to(np.asarray(h2, dtype=float), (pheno_count,))
+    if ((h2 < 0) | (h2 > 1)).any(): raise Exception('h2 must be between 0 and 1')
+    if (min_maf <= 0) | (max_maf > 0.5) | (max_maf < min_maf): raise Exception('invalid min_maf/max_maf combo provided')
+
+    founder, fam = _simulate_founders(iid_count, pop_count, family_size, np.random.RandomState([seed, 0]))
+    chunk_list = _snp_chunks(sid_count, chrom_count, ld_block_size, chunk_size)
+    part_bounds = np.linspace(0, len(chunk_list), min(part_count, len(chunk_list)) + 1).astype(int)
+    settings = dict(pop_count=pop_count, fst=fst, ld_rho=ld_rho, min_maf=min_maf, max_maf=max_maf, pheno_count=pheno_count,
+                    causal_fraction=causal_fraction, genetic_correlation=genetic_correlation, seed=seed)
+
+    def mapper(part_index):
+        part_basefilename = "{0}.part{1}".format(basefilename, part_index)
+        genetic_value = np.zeros((iid_count, pheno_count))
+        causal_list = []
+        with open(part_basefilename + ".bed", 'wb') as bed_file, open(part_basefilename + ".bim", 'w') as bim_file:
+            for chunk_index in range(part_bounds[part_index], part_bounds[part_index + 1]):
+                causal_list.append(_simulate_chunk(chunk_index, chunk_list[chunk_index], founder, fam, bed_file, bim_file, genetic_value, **settings))
+        return part_basefilename, genetic_value, np.concatenate(causal_list)
+
+    def reducer(result_sequence):
+        from fastlmm.pyplink.vcfpy import BED_MAGIC
+        import shutil, os
+        genetic_value = np.zeros((iid_count, pheno_count))
+        causal_list = []
+        with open(basefilename + ".bed", 'wb') as bed_file, open(basefilename + ".bim", 'w') as bim_file:
+            bed_file.write(BED_MAGIC)
+            for part_basefilename, part_genetic_value, part_causal in result_sequence:
+                for suffix, out_file, mode in [(".bed", bed_file, 'rb'), (".bim", bim_file, 'r')]:
+                    with open(part_basefilename + suffix, mode) as part_file:
+                        shutil.copyfileobj(part_file, out_file)
+                    os.remove(part_basefilename + suffix)
+                genetic_value += part_genetic_value
+                causal_list.append(part_causal)
+        return genetic_value, np.concatenate(causal_list)
+
+    genetic_value, causal_sid = map_reduce(range(len(part_bounds) - 1), mapper=mapper, reducer=reducer, name="simulate_cohort", runner=runner)
+    fam.to_csv(basefilename + ".fam", sep=" ", header=False, index=False)
+
+    randomstate = np.random.RandomState([seed, 1])
+    std = genetic_value.std(0)
+    std[std == 0] = 1.0
+    y = (genetic_value - genetic_value.mean(0)) / std * np.sqrt(h2) + randomstate.randn(iid_count, pheno_count) * np.sqrt(1.0 - h2)
+    covar_filename = None
+    if covar_count > 0:
+        covar = randomstate.randn(iid_count, covar_count)
+        y += covar.dot(randomstate.randn(covar_count, pheno_count)) * np.sqrt(covar_variance / covar_count)
+        covar_filename = basefilename + ".cov"
+        pd.concat([fam.iloc[:, :2], pd.DataFrame(covar)], axis=1).to_csv(covar_filename, sep="\t", header=False, index=False)
+    pheno_filename = basefilename + ".phe"
+    pd.concat([fam.iloc[:, :2], pd.DataFrame(y)], axis=1).to_csv(pheno_filename, sep="\t", header=False, index=False)
+
+    return {'bed': basefilename + ".bed", 'pheno': pheno_filename, 'covar': covar_filename, 'causal_sid': causal_sid}
+
+def _simulate_founders(iid_count, pop_count, family_size, randomstate):
+    """
+    returns (founder, fam). founder is an [iid_count*3] int array with the population of each individual and the indexes of
+    its two parents (-1 for founders). fam is the DataFrame of the .fam file.
+    """
+    import numpy as np
+    import pandas as pd
+
+    population = np.zeros(iid_count, dtype=int)
+    parents = np.full((iid_count, 2), -1, dtype=int)
+    family_id = np.arange(iid_count)
+    if family_size >= 3:
+        family_count = iid_count // family_size
+        family_pop = randomstate.randint(pop_count, size=family_count)
+        start = np.arange(family_count) * family_size
+        for member in range(family_size):
+            population[start + member] = family_pop
+            family_id[start + member] = np.arange(family_count)
+            if member >= 2:
+                parents[start + member] = np.c_[start, start + 1]
+        rest = np.arange(family_count * family_size, iid_count)
+        population[rest] = randomstate.randint(pop_count, size=len(rest))
+        family_id[rest] = family_count + np.arange(len(rest))
+    else:
+        population = randomstate.randint(pop_count, size=iid_count)
+    founder = np.c_[population, parents]
+
+    iid = np.array(["iid{0}".format(i) for i in range(iid_count)])
+    parent_id = np.where(parents >= 0, iid[np.maximum(parents, 0)], "0")
+    fam = pd.DataFrame({'fid': ["fam{0}".format(f) for f in family_id], 'iid': iid, 'father': parent_id[:, 0], 'mother': parent_id[:, 1],
+                        'sex': np.where(np.arange(iid_count) % 2 == 0, 1, 2), 'pheno': -9})
+    return founder, fam
+
+def _snp_chunks(sid_count, chrom_count, ld_block_size, chunk_size):
+    """
+    split the SNPs into chunks of whole LD blocks that do not cross chromosomes.
+    Returns [(chrom, start within the chromosome, start, [block sizes])].
+    """
+    import numpy as np
+
+    chunk_list = []
+    chrom_bounds = np.linspace(0, sid_count, chrom_count + 1).astype(int)
+    for chrom in range(chrom_count):
+        for start in range(chrom_bounds[chrom], chrom_bounds[chrom + 1], max(chunk_size // ld_block_size, 1) * ld_block_size):
+            end = min(start + max(chunk_size // ld_block_size, 1) * ld_block_size, chrom_bounds[chrom + 1])
+            block_list = [min(ld_block_size, end - block_start) for block_start in range(start, end, ld_block_size)]
+            chunk_list.append((chrom + 1, start - chrom_bounds[chrom], start, block_list))
+    return chunk_list
+
+def _simulate_chunk(chunk_index, chunk, founder, fam, bed_file, bim_file, genetic_value, pop_count, fst, ld_rho, min_maf, max_maf,
+                    pheno_count, causal_fraction, genetic_correlation, seed):
+    """
+    simulate one chunk of SNPs, write it to the open .bed and .bim files, add the effects of its causal SNPs to genetic_value
+    and return the ids of its causal SNPs
+    """
+    import numpy as np
+    import scipy.stats as st
+    from fastlmm.pyplink.vcfpy import pack_bed
+
+    chrom, chrom_start, sid_start, block_list = chunk
+    randomstate = np.random.RandomState([seed, 2, chunk_index])
+    snp_count = sum(block_list)
+    iid_count = founder.shape[0]
+    population = founder[:, 0]
+    is_founder = founder[:, 1] < 0
+    founder_index = np.flatnonzero(is_founder)
+    child_index = np.flatnonzero(~is_founder)
+
+    maf = randomstate.uniform(min_maf, max_maf, size=snp_count)
+    if pop_count > 1 and fst > 0:
+        pop_maf = randomstate.beta(maf * (1 - fst) / fst, (1 - maf) * (1 - fst) / fst, size=(pop_count, snp_count))
+        pop_maf = np.clip(pop_maf, 1e-3, 1 - 1e-3)
+    else:
+        pop_maf = np.tile(maf, (pop_count, 1))
+    threshold = st.norm.ppf(pop_maf)[population[founder_index]] #[founders*SNPs], allele 2 where the latent value is below
+
+    dosage = np.empty((snp_count, iid_count), dtype=np.int8)
+    haplotype = np.empty((iid_count, 2), dtype=bool)
+    snp_index = 0
+    for block_size in block_list:
+        latent = randomstate.randn(len(founder_index), 2)
+        transmitted = randomstate.randint(2, size=(len(child_index), 2)) #which haplotype of each parent a child gets in this block
+        for _ in range(block_size):
+            haplotype[founder_index] = latent < threshold[:, snp_index, np.newaxis]
+            if len(child_index) > 0:
+                for parent in range(2):
+                    haplotype[child_index, parent] = haplotype[founder[child_index, 1 + parent], transmitted[:, parent]]
+            dosage[snp_index] = haplotype.sum(1)
+            latent = ld_rho * latent + np.sqrt(1 - ld_rho * ld_rho) * randomstate.randn(len(founder_index), 2)
+            snp_index += 1
+
+    bed_file.write(pack_bed(np.array([0, 2, 3], dtype=np.uint8)[dosage]).tobytes())
+    sid = np.array(["sim{0}".format(sid_start + i) for i in range(snp_count)])
+    pos = (chrom_start + np.arange(snp_count) + 1) * 1000
+    bim_file.write(''.join("{0}\t{1}\t0\t{2}\tA\tC\n".format(chrom, s, p) for s, p in zip(sid, pos)))
+
+    causal = randomstate.uniform(size=snp_count) < causal_fraction
+    correlation = np.full((pheno_count, pheno_count), genetic_correlation) + (1 - genetic_correlation) * np.eye(pheno_count)
+    effect = randomstate.randn(snp_count, pheno_count).dot(np.linalg.cholesky(correlation).T)
+    if causal.any():
+        x = dosage[causal].astype(np.float64)
+        std = x.std(1)
+        std[std == 0] = np.inf
+        genetic_value += ((x - x.mean(1)[:, np.newaxis]) / std[:, np.newaxis]).T.dot(effect[causal])
+    return sid[causal]
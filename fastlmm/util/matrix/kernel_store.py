@@ -0,0 +1,278 @@
+'''
+Blocked kernel construction with symmetric rank-k (SYRK) updates.
+
+:func:`build_kernel` streams standardized blocks of SNPs and accumulates only the upper triangle of G G^T.
+:class:`ChromKernelStore` does the same per chromosome, writing the partial kernels (and their total) to one memory-mapped
+file, so each SNP is read once and a leave-out-one-chromosome kernel is just the total minus one partial kernel.
+Leave-out-one-chromosome runs of :func:`.single_snp` use a store when given its kernel_store option (or when given
+:meth:`ChromKernelStore.loco_dict` as K0).
+'''
+import os
+import time
+import hashlib
+import logging
+import numpy as np
+from scipy.linalg import blas
+from pysnptools.kernelreader import KernelReader, KernelData
+from pysnptools.standardizer import Unit
+from pysnptools.util import format_delta, create_directory_if_necessary
+from pysnptools.util.mapreduce1 import map_reduce
+
+
+def syrk_update(K, G):
+    '''
+    In place, add the upper triangle of G G^T to the upper triangle of K. K must be a square, 'F'-order float64 array
+    (a numpy.memmap is fine). The lower triangle of K is left untouched; use :func:`symmetrize_upper` when done.
+    '''
+    assert K.dtype == np.float64 and K.flags["F_CONTIGUOUS"], "Expect K to be 'F'-order float64"
+    assert K.shape == (G.shape[0], G.shape[0]), "Expect K to be iid_count x iid_count"
+    if G.shape[1] == 0:
+        return K
+    result = blas.dsyrk(1.0, G, beta=1.0, c=K, trans=0, lower=0, overwrite_c=1)
+    if result is not K and not np.shares_memory(result, K): #only happens if BLAS couldn't work in place
+        K[...] = result
+    return K
+
+
+def symmetrize_upper(K, out=None, block_size=1000):
+    '''
+    Return the symmetric matrix whose upper triangle is that of K. The result goes into out, if given (out may be K).
+    Works in blocks of block_size columns, so it needs little memory beyond out.
+    '''
+    if out is None:
+        out = np.array(K, order="F")
+    elif out is not K:
+        out[...] = K
+    iid_count = out.shape[0]
+    for start, stop in _block_list(iid_count, block_size):
+        diagonal = out[start:stop, start:stop]
+        out[start:stop, start:stop] = np.triu(diagonal) + np.triu(diagonal, 1).T
+        out[stop:, start:stop] = out[start:stop, stop:].T
+    return out
+
+
+def _symmetric_block(K, row_index, col_index):
+    '''
+    The row_index x col_index block of the symmetric matrix whose upper triangle is that of K, reading only those entries of K.
+    '''
+    upper = row_index[:, None] <= col_index[None, :]
+    return np.where(upper, K[np.ix_(row_index, col_index)], K[np.ix_(col_index, row_index)].T)
+
+
+def _block_list(sid_count, block_size):
+    return [(start, min(start + block_size, sid_count)) for start in range(0, sid_count, block_size)]
+
+
+def build_kernel(snpreader, standardizer=Unit(), block_size=1000, K=None):
+    '''
+    Build G G^T for the SNPs of snpreader (after standardizing each block of block_size SNPs) with SYRK updates.
+
+    :param K: If given, a 'F'-order float64 iid_count x iid_count array (for example, a numpy.memmap) to accumulate into.
+    :rtype: :class:`.KernelData`
+
+    >>> from pysnptools.snpreader import Bed
+    >>> from fastlmm.util import example_file # Download and return local file name
+    >>> snpreader = Bed(example_file('tests/datasets/synth/all.*','*.bed'),count_A1=True)[:,:500]
+    >>> kernel = build_kernel(snpreader, block_size=128)
+    >>> print(kernel.iid_count, round(kernel.val[0,0],5) == round(snpreader.read_kernel(Unit()).val[0,0],5))
+    500 True
+    '''
+    t0 = time.time()
+    if K is None:
+        K = np.zeros((snpreader.iid_count, snpreader.iid_count), order="F")
+    for start, stop in _block_list(snpreader.sid_count, block_size):
+        snpdata = snpreader[:, start:stop].read(order="F", dtype=np.float64).standardize(standardizer)
+        syrk_update(K, snpdata.val)
+    logging.info("build_kernel: {0} SNPs in {1}".format(snpreader.sid_count, format_delta(time.time() - t0)))
+    return KernelData(iid=snpreader.iid, val=symmetrize_upper(K))
+
+
+class ChromKernelStore(object):
+    '''
+    Per-chromosome partial kernels, G_c G_c^T, and their total, stored in one 'F'-order float64 memmap of shape
+    (iid_count, iid_count, chrom_count+1). Only the upper triangles are filled. A small '.npz' file next to the memmap
+    holds the iids, the chromosomes and the number of SNPs per chromosome; it is written last and so marks a complete store.
+
+    The memmap takes (chrom_count+1)*iid_count*iid_count*8 bytes of disk, for example, about 1.9 TB for 50,000 iids and
+    22 chromosomes, so check the free space before writing a store for a large cohort.
+
+    Create with :meth:`ChromKernelStore.write`; open an existing one with ChromKernelStore(filename).
+
+    >>> from pysnptools.snpreader import Bed
+    >>> from fastlmm.util import example_file # Download and return local file name
+    >>> snpreader = Bed(example_file('tests/datasets/synth/all.*','*.bed'),count_A1=True)
+    >>> store = ChromKernelStore.write("tempout/kernel_store/example.kernels", snpreader[:,::5], block_size=500)
+    >>> print(store.chrom_list, store.iid_count, store.matches(snpreader[:,::5]))
+    [1.0, 2.0, 3.0, 4.0, 5.0] 500 True
+    >>> loco = store.loco_dict() # Use as K0 in single_snp
+    >>> print(loco[3].read().val.shape)
+    (500, 500)
+    >>> del loco
+    >>> store.remove()
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with np.load(self._metadata_filename(filename), allow_pickle=False) as data:
+            self.iid = data["iid"]
+            self.chrom_list = [float(chrom) for chrom in data["chrom_list"]]
+            self.sid_count_list = [int(count) for count in data["sid_count_list"]]
+            self.sid_digest = str(data["sid_digest"]) if "sid_digest" in data else None
+
+    @staticmethod
+    def _metadata_filename(filename):
+        return filename + ".npz"
+
+    @staticmethod
+    def _sid_digest(sid):
+        return hashlib.sha256("\t".join(np.array(sid, dtype=str)).encode()).hexdigest()
+
+    def matches(self, snpreader):
+        '''
+        True if this store was written from the SNPs (and iids) of snpreader, so it can be reused rather than rewritten.
+        '''
+        return (self.sid_digest == self._sid_digest(snpreader.sid) and np.array_equal(self.iid, snpreader.iid.astype("str"))
+                and self.chrom_list == [float(chrom) for chrom in sorted(set(snpreader.pos[:, 0]))])
+
+    def remove(self):
+        '''
+        Delete the store's files.
+        '''
+        for filename in [self._metadata_filename(self.filename), self.filename]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def __repr__(self):
+        return "{0}('{1}')".format(self.__class__.__name__, self.filename)
+
+    @property
+    def iid_count(self):
+        return len(self.iid)
+
+    def _memmap(self, mode="r"):
+        return np.memmap(self.filename, dtype=np.float64, mode=mode, order="F",
+                         shape=(self.iid_count, self.iid_count, len(self.chrom_list) + 1))
+
+    @staticmethod
+    def write(filename, snpreader, standardizer=Unit(), block_size=1000, runner=None):
+        '''
+        Read each SNP of snpreader once (in blocks of block_size, standardized with standardizer) and write the
+        per-chromosome partial kernels and their total to filename. With a runner, the chromosomes are processed in
+        parallel, each task writing its own slice of the memmap.
+
+        :rtype: :class:`ChromKernelStore`
+        '''
+        chrom_list = sorted(set(snpreader.pos[:, 0]))
+        assert not np.isnan(chrom_list).any(), "chrom list should not contain NaN"
+        iid_count = snpreader.iid_count
+        create_directory_if_necessary(filename)
+        if os.path.exists(ChromKernelStore._metadata_filename(filename)):
+            os.remove(ChromKernelStore._metadata_filename(filename))
+        np.memmap(filename, dtype=np.float64, mode="w+", order="F", shape=(iid_count, iid_count, len(chrom_list) + 1)).flush()
+
+        def mapper_closure(chrom_index):
+            t0 = time.time()
+            sid_index = np.flatnonzero(snpreader.pos[:, 0] == chrom_list[chrom_index])
+            memmap = np.memmap(filename, dtype=np.float64, mode="r+", order="F", shape=(iid_count, iid_count, len(chrom_list) + 1))
+            K = memmap[:, :, chrom_index]
+            for start, stop in _block_list(len(sid_index), block_size):
+                snpdata = snpreader[:, sid_index[start:stop]].read(order="F", dtype=np.float64).standardize(standardizer)
+                syrk_update(K, snpdata.val)
+            memmap.flush()
+            logging.info("chrom {0}: {1} SNPs in {2}".format(chrom_list[chrom_index], len(sid_index), format_delta(time.time() - t0)))
+            return len(sid_index)
+
+        def reducer_closure(sid_count_sequence):
+            sid_count_list = list(sid_count_sequence) #Without a runner, the mappers run as this is consumed
+            memmap = np.memmap(filename, dtype=np.float64, mode="r+", order="F", shape=(iid_count, iid_count, len(chrom_list) + 1))
+            total = memmap[:, :, -1]
+            for chrom_index in range(len(chrom_list)):
+                total += memmap[:, :, chrom_index]
+            memmap.flush()
+            del memmap
+            np.savez(ChromKernelStore._metadata_filename(filename), iid=snpreader.iid.astype("str"),
+                     chrom_list=np.array(chrom_list), sid_count_list=np.array(sid_count_list),
+                     sid_digest=np.array(ChromKernelStore._sid_digest(snpreader.sid)))
+            return ChromKernelStore(filename)
+
+        return map_reduce(range(len(chrom_list)),
+                          mapper=mapper_closure,
+                          reducer=reducer_closure,
+                          input_files=[snpreader],
+                          output_files=[filename],
+                          name="ChromKernelStore.write('{0}')".format(filename),
+                          runner=runner)
+
+    def kernel(self, exclude_chrom=None, chrom=None):
+        '''
+        The kernel (a :class:`.KernelData`) of all the chromosomes except exclude_chrom or, if chrom is given, of only chrom.
+        (Excluding a chromosome without SNPs in the store gives the whole kernel.)
+        '''
+        assert exclude_chrom is None or chrom is None, "Give at most one of exclude_chrom and chrom"
+        memmap = self._memmap()
+        if chrom is not None:
+            K = np.array(memmap[:, :, self.chrom_list.index(chrom)], order="F")
+        elif exclude_chrom is not None and exclude_chrom in self.chrom_list:
+            K = memmap[:, :, -1] - memmap[:, :, self.chrom_list.index(exclude_chrom)]
+        else:
+            K = np.array(memmap[:, :, -1], order="F")
+        return KernelData(iid=self.iid, val=symmetrize_upper(K, out=K))
+
+    def loco_dict(self, chrom_list=None):
+        '''
+        A dictionary from each chromosome to a (lazy) :class:`.KernelReader` of all the other chromosomes. It can be given
+        as K0 (or K1) to :func:`.single_snp` with leave_out_one_chrom=True.
+
+        :param chrom_list: the chromosomes to include. Defaults to those of the store. A chromosome without SNPs in the
+            store gets the whole kernel.
+        '''
+        return {chrom: _LocoKernel(self.filename, chrom) for chrom in (self.chrom_list if chrom_list is None else chrom_list)}
+
+
+class _LocoKernel(KernelReader):
+    '''
+    A KernelReader of a :class:`ChromKernelStore`'s kernel excluding one chromosome. It holds only the file name, so it
+    is cheap to pickle to other processes.
+    '''
+    def __init__(self, filename, exclude_chrom):
+        super(_LocoKernel, self).__init__()
+        self.filename = filename
+        self.exclude_chrom = exclude_chrom
+        self._iid = None
+
+    def __repr__(self):
+        return "{0}('{1}',exclude_chrom={2})".format(self.__class__.__name__, self.filename, self.exclude_chrom)
+
+    @property
+    def row(self):
+        if self._iid is None:
+            self._iid = ChromKernelStore(self.filename).iid
+        return self._iid
+
+    @property
+    def col(self):
+        return self.row
+
+    def copyinputs(self, copier):
+        copier.input(self.filename)
+        copier.input(ChromKernelStore._metadata_filename(self.filename))
+
+    def _read(self, row_index_or_none, col_index_or_none, order, dtype, force_python_only, view_ok, num_threads):
+        if self._is_all_slice(row_index_or_none) and self._is_all_slice(col_index_or_none):
+            val = ChromKernelStore(self.filename).kernel(exclude_chrom=self.exclude_chrom).val
+            val, _ = self._apply_sparray_or_slice_to_val(val, None, None, order, dtype, force_python_only, num_threads)
+            return val
+        #read only the requested block, not the whole iid_count x iid_count kernel
+        store = ChromKernelStore(self.filename)
+        row_index = self._make_sparray_from_sparray_or_slice(self.row_count, self._make_sparray_or_slice(row_index_or_none))
+        col_index = self._make_sparray_from_sparray_or_slice(self.col_count, self._make_sparray_or_slice(col_index_or_none))
+        memmap = store._memmap()
+        val = _symmetric_block(memmap[:, :, -1], row_index, col_index)
+        if self.exclude_chrom in store.chrom_list:
+            val -= _symmetric_block(memmap[:, :, store.chrom_list.index(self.exclude_chrom)], row_index, col_index)
+        return np.array(val, dtype=dtype, order="F" if order == "A" else order)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    import doctest
+
+    doctest.testmod()
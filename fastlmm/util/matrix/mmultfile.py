@@ -9,6 +9,7 @@ import time
 from pysnptools.util import format_delta
 from pysnptools.snpreader import SnpMemMap
 from bed_reader import file_dot_piece, file_b_less_aatbx, get_num_threads
+from fastlmm.util.thread_budget import threads_per_task, limit_threads
 
 
 def mmultfile_ata(memmap_lambda,writer,sid,work_count,name,runner,force_python_only=False):
@@ -42,7 +43,7 @@ def mmultfile_ata(memmap_lambda,writer,sid,work_count,name,runner,force_python_o
         return result
 
     gtg_npz_lambda = map_reduce(range(work_count),
-               mapper=mapper_closure,
+               mapper=limit_threads(mapper_closure, threads_per_task(runner)),
                reducer=reducer_closure,
                runner=runner,
                name=name,
@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import numpy as np
 import scipy as SP
 import scipy.optimize as opt
 from six.moves import range
@@ -105,3 +106,187 @@ def evalgrid1D(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, dimF=
     return (evalgrid,resultgrid)
 
 
+
+def evalgrid1D_batch(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999):
+    '''
+    evaluate a vectorized function f(x) on all values of a grid with a single call.
+    --------------------------------------------------------------------------
+    Input:
+    f(x)    : callable target function for P independent problems. Given x of shape
+              [M*P] (or [M*1], broadcast over the problems) it returns an [M*P]
+              array of function values, where column p belongs to problem p.
+    evalgrid: 1-D array prespecified grid of x-values
+    nGrid   : number of x-grid points to evaluate f(x)
+    minval  : minimum x-value for optimization of f(x)
+    maxval  : maximum x-value for optimization of f(x)
+    --------------------------------------------------------------------------
+    Output:
+    evalgrid    : x-values
+    resultgrid  : [nGrid*P] f(x)-values
+    --------------------------------------------------------------------------
+    '''
+    if evalgrid is None:
+        step = (maxval-minval)/(nGrid)
+        evalgrid = np.arange(minval,maxval+step,step)
+    resultgrid = np.asarray(f(evalgrid[:,np.newaxis]),dtype=float)
+    if resultgrid.ndim == 1:
+        resultgrid = resultgrid[:,np.newaxis]
+    assert resultgrid.shape[0] == evalgrid.shape[0], "function should return one row per grid point"
+    return (evalgrid,resultgrid)
+
+
+def minimize1D_batch(f, evalgrid = None, nGrid=10, minval=0.0, maxval = 0.99999, brent=True, check_boundaries = True, resultgrid=None, return_grid=False, xtol=1e-5, maxiter=500):
+    '''
+    minimize P independent functions in lockstep, each in the grid between minval and maxval.
+    This is the vectorized counterpart of minimize1D: f is evaluated on the whole grid with one call and
+    then the same triplets (and boundary intervals) that minimize1D would explore are refined with a
+    batched version of Brent's bounded search, which evaluates f for all problems at once in every iteration.
+    --------------------------------------------------------------------------
+    Input:
+    f(x)    : callable target function for P independent problems. Given x of shape
+              [M*P] (or [M*1], broadcast over the problems) it returns an [M*P]
+              array of function values, where column p belongs to problem p.
+    evalgrid: 1-D array prespecified grid of x-values
+    nGrid   : number of x-grid points to evaluate f(x)
+    minval  : minimum x-value for optimization of f(x)
+    maxval  : maximum x-value for optimization of f(x)
+    brent   : boolean indicator whether to do Brent search or not.
+              (default: True)
+    xtol    : absolute tolerance of the Brent search (default: 1e-5, as in scipy.optimize.fminbound)
+    maxiter : maximum number of iterations of the Brent search
+    --------------------------------------------------------------------------
+    Output list:
+    [xopt, f(xopt)]
+    xopt    : [P] x-values at the optima
+    f(xopt) : [P] function values at the optima
+    --------------------------------------------------------------------------
+    '''
+    if evalgrid is not None and brent:# if brent we need to sort the input values
+        i_sort = evalgrid.argsort()
+        evalgrid = evalgrid[i_sort]
+        if resultgrid is not None:
+            resultgrid = resultgrid[i_sort]
+    if resultgrid is None:
+        [evalgrid,resultgrid] = evalgrid1D_batch(f, evalgrid = evalgrid, nGrid=nGrid, minval=minval, maxval = maxval)
+    nP = resultgrid.shape[1]
+
+    i_currentmin = resultgrid.argmin(0)
+    xglobal = evalgrid[i_currentmin]
+    fglobal = resultgrid[i_currentmin,np.arange(nP)]
+
+    if brent and evalgrid.shape[0] > 1:
+        #collect the intervals that minimize1D would search, as (problem, lower, upper)
+        intervals = []
+        if check_boundaries:
+            for p in np.flatnonzero(resultgrid[0]<resultgrid[1]):
+                intervals.append((p,evalgrid[0],evalgrid[1]))
+            for p in np.flatnonzero(resultgrid[-1]<resultgrid[-2]):
+                intervals.append((p,evalgrid[-2],evalgrid[-1]))
+        if evalgrid.shape[0] > 2:
+            is_triplet = (resultgrid[1:-1]<resultgrid[2:]) & (resultgrid[1:-1]<resultgrid[:-2])
+            for i,p in zip(*np.nonzero(is_triplet)):
+                intervals.append((p,evalgrid[i],evalgrid[i+2]))
+
+        #a problem may have several intervals, so search them in rounds with at most one interval per problem
+        while len(intervals) > 0:
+            lower = xglobal.copy()
+            upper = xglobal.copy()
+            active = np.zeros(nP,dtype=bool)
+            remaining = []
+            for (p,a,b) in intervals:
+                if active[p]:
+                    remaining.append((p,a,b))
+                else:
+                    active[p] = True
+                    lower[p], upper[p] = a, b
+            xlocal, flocal = _fminbound_batch(f, lower, upper, active, xtol=xtol, maxiter=maxiter)
+            improved = active & (flocal < fglobal)
+            xglobal[improved] = xlocal[improved]
+            fglobal[improved] = flocal[improved]
+            intervals = remaining
+
+    if return_grid:
+        return (xglobal, fglobal, evalgrid, resultgrid)
+    else:
+        return (xglobal, fglobal)
+
+
+def _fminbound_batch(f, lower, upper, active, xtol=1e-5, maxiter=500):
+    '''
+    Brent's bounded scalar minimization (as in scipy.optimize.fminbound) run in lockstep on P problems.
+    Problems that are not active (or have converged) keep their current point and are ignored.
+    '''
+    sqrt_eps = np.sqrt(2.2e-16)
+    golden_mean = 0.5 * (3.0 - np.sqrt(5.0))
+    a = np.array(lower,dtype=float)
+    b = np.array(upper,dtype=float)
+    fulc = a + golden_mean * (b - a)
+    nfc, xf = fulc.copy(), fulc.copy()
+    rat = np.zeros_like(a)
+    e = np.zeros_like(a)
+    x = xf.copy()
+    fx = _eval_batch(f, x)
+    ffulc = fx.copy()
+    fnfc = fx.copy()
+    xm = 0.5 * (a + b)
+    tol1 = sqrt_eps * np.abs(xf) + xtol / 3.0
+    tol2 = 2.0 * tol1
+
+    for _ in range(maxiter):
+        running = active & (np.abs(xf - xm) > (tol2 - 0.5 * (b - a)))
+        if not running.any():
+            break
+
+        #check for parabolic fit
+        parabolic = np.abs(e) > tol1
+        r = (xf - nfc) * (fx - ffulc)
+        q = (xf - fulc) * (fx - fnfc)
+        p = (xf - fulc) * q - (xf - nfc) * r
+        q = 2.0 * (q - r)
+        p = np.where(q > 0.0, -p, p)
+        q = np.abs(q)
+        r = e
+        e = np.where(parabolic, rat, e)
+        acceptable = parabolic & (np.abs(p) < np.abs(0.5 * q * r)) & (p > q * (a - xf)) & (p < q * (b - xf))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rat_parabola = np.where(acceptable, p / np.where(acceptable, q, 1.0), 0.0)
+        x_parabola = xf + rat_parabola
+        si = np.sign(xm - xf) + ((xm - xf) == 0)
+        rat_parabola = np.where(((x_parabola - a) < tol2) | ((b - x_parabola) < tol2), tol1 * si, rat_parabola)
+
+        #otherwise do a golden-section step
+        golden = ~acceptable
+        e = np.where(golden, np.where(xf >= xm, a - xf, b - xf), e)
+        rat_new = np.where(golden, golden_mean * e, rat_parabola)
+        rat = np.where(running, rat_new, rat)
+        e = np.where(running, e, r)
+
+        si = np.sign(rat) + (rat == 0)
+        x = np.where(running, xf + si * np.maximum(np.abs(rat), tol1), xf)
+        fu = _eval_batch(f, x)
+
+        better = running & (fu <= fx)
+        worse = running & ~better
+        a = np.where(better & (x >= xf), xf, np.where(worse & (x < xf), x, a))
+        b = np.where(better & (x < xf), xf, np.where(worse & (x >= xf), x, b))
+
+        second = worse & ((fu <= fnfc) | (nfc == xf))
+        third = worse & ~second & ((fu <= ffulc) | (fulc == xf) | (fulc == nfc))
+        fulc_new = np.where(better | second, nfc, np.where(third, x, fulc))
+        ffulc_new = np.where(better | second, fnfc, np.where(third, fu, ffulc))
+        nfc_new = np.where(better, xf, np.where(second, x, nfc))
+        fnfc_new = np.where(better, fx, np.where(second, fu, fnfc))
+        xf = np.where(better, x, xf)
+        fx = np.where(better, fu, fx)
+        fulc, ffulc, nfc, fnfc = fulc_new, ffulc_new, nfc_new, fnfc_new
+
+        xm = 0.5 * (a + b)
+        tol1 = sqrt_eps * np.abs(xf) + xtol / 3.0
+        tol2 = 2.0 * tol1
+
+    return xf, fx
+
+
+def _eval_batch(f, x):
+    fx = np.asarray(f(x[np.newaxis,:]),dtype=float)
+    return fx.reshape(-1)
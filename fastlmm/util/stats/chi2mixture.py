@@ -1,4 +1,5 @@
 from __future__ import absolute_import
+import numpy as np
 import scipy as sp
 import scipy.stats as st
 import scipy.special
@@ -238,6 +239,119 @@ class chi2mixture(object):
         pv[i0]=1.0
         return (pv,mixture,scale,dof,i0)
 
+class chi2mixture_batch(object):
+    '''
+    Fits chi2mixture models to many independent vectors of test statistics (e.g. one per phenotype or per set-test run) at once.
+    The statistics are sorted once for all vectors and the quantile-regression objective is evaluated for all vectors
+    (and, when fitting dof, all candidate dofs) with single array operations, using mingrid.minimize1D_batch.
+
+    mixture here denotes the weight on the non-zero dof component
+    '''
+
+    def __init__(self, lrt, qmax, alteqnull = None, scalemin = 0.1, scalemax = 5.0,
+                 dofmin = 0.1, dofmax = 5.0, abserr=None, fitdof=None, dof=1.0):
+        '''
+        Input:
+        lrt             [B*Ntests] array of test statistics, one row per independent fit. Rows of different lengths
+                        can be padded with NaN, which is ignored.
+        qmax            only the top qmax quantile is used for the fit
+        alteqnull       [B*Ntests] boolean array marking the statistics in the chi2_0 component (default None, uses lrt==0)
+        scalemin (0.1)  minimum value used for fitting the scale parameter
+        scalemax (5.0)  maximum value used for fitting scale parameter
+        dofmin (0.1)    minimum value used for fitting the dof parameter
+        dofmax (5.0)    maximum value used for fitting dof parameter
+        abserr          if True, minimize the absolute instead of the squared error of the log quantiles
+        fitdof          if True, fit both scale and dof, else only the scale
+        dof (1.0)       dof used when fitdof is False, a scalar or a [B] array
+        '''
+        self.lrt = np.atleast_2d(np.asarray(lrt, dtype=float))
+        self.valid = ~np.isnan(self.lrt)
+        if alteqnull is None:
+            logging.info("WARNING: alteqnull not provided, so using alteqnull=(lrt==0)")
+            alteqnull = self.lrt==0
+        self.alteqnull = np.atleast_2d(np.asarray(alteqnull, dtype=bool)) & self.valid
+        self.qmax = qmax
+        self.scalemin = scalemin
+        self.scalemax = scalemax
+        self.dofmin = dofmin
+        self.dofmax = dofmax
+        self.abserr = abserr
+        self.fitdof = fitdof
+        B = self.lrt.shape[0]
+        self.dof = np.ones(B) * dof
+        self.scale = None
+
+        nfalse = self.valid.sum(1) - self.alteqnull.sum(1)
+        self.mixture = nfalse / (1.0 * self.valid.sum(1))
+        self.imax = np.ceil(self.qmax*nfalse).astype(int)
+        Imax = self.imax.max()
+        self.lrtsort = -np.sort(np.where(self.valid, -self.lrt, np.inf), axis=1)[:,:Imax] #descending, padding last
+        self.fitmask = np.arange(Imax) < self.imax[:,np.newaxis]
+        self.logqnulllrtsort = np.log((0.5+np.arange(Imax))/np.maximum(nfalse,1)[:,np.newaxis])
+
+    def scale_dof_obj(self, scale, dof, rows):
+        '''
+        the quantile regression error for the [P] scale and dof values of the [P] fits in rows
+        '''
+        logp = st.chi2.logsf(self.lrtsort[rows]/scale[:,np.newaxis], dof[:,np.newaxis])
+        r = np.where(self.fitmask[rows], self.logqnulllrtsort[rows]-logp, 0.0)
+        if self.abserr:
+            return np.absolute(r).sum(1)
+        else:#mean square error
+            return (r*r).sum(1) / self.imax[rows]
+
+    def fit_scale_logP(self, dof=None, rows=None):
+        '''
+        Fit the scale of the fits in rows (default all) for the given dof values. Returns the [P] scales and errors.
+        '''
+        if rows is None:
+            rows = np.arange(self.lrt.shape[0])
+        if dof is None:
+            dof = self.dof[rows]
+        def f(x):
+            x = np.broadcast_to(x, (x.shape[0], len(rows)))
+            return np.array([self.scale_dof_obj(x_row, dof, rows) for x_row in x])
+        return mingrid.minimize1D_batch(f=f, nGrid=10, minval=self.scalemin, maxval=self.scalemax)
+
+    def fit_params_Qreg(self):
+        '''
+        Fit the scale (and, if fitdof, the dof) parameters of all B models by minimizing the squared error between
+        the model log quantiles and the log P-values obtained on the lrt values.
+        Returns a dictionary of [B] arrays with the keys 'mse', 'dof', 'scale' and 'imax'.
+        '''
+        B = self.lrt.shape[0]
+        if self.fitdof: #fit both scale and dof
+            def f(x): #for each candidate dof, the best mse over the scale
+                x = np.broadcast_to(x, (x.shape[0], B))
+                rows = np.tile(np.arange(B), x.shape[0])
+                return self.fit_scale_logP(dof=x.reshape(-1), rows=rows)[1].reshape(x.shape)
+            self.dof = mingrid.minimize1D_batch(f=f, nGrid=10, minval=self.dofmin, maxval=self.dofmax)[0]
+        self.scale, mse = self.fit_scale_logP()
+        return {'mse':mse, 'dof':self.dof, 'scale':self.scale, 'imax':self.imax}
+
+    def sf(self, lrt = None, alteqnull=None):
+        '''
+        compute the survival function of the B fitted mixtures of scaled chi-square_0 and scaled chi-square_dof
+        ---------------------------------------------------------------------------
+        Input:
+        lrt (optional)     [B*N] statistics to compute the survival function for, row b with model b.
+                           if None, compute survival function for original self.lrt
+        alteqnull          [B*N] boolean array marking the statistics in the chi2_0 component
+        ---------------------------------------------------------------------------
+        Output:
+        pv                 [B*N] P-values (NaN where lrt is NaN)
+        ---------------------------------------------------------------------------
+        '''
+        if lrt is None:
+            lrt = self.lrt
+            alteqnull=self.alteqnull
+        else:
+            assert alteqnull is not None, "alteqnull is none, but lrt is not"
+            lrt = np.atleast_2d(lrt)
+        pv = st.chi2.sf(lrt/self.scale[:,np.newaxis],self.dof[:,np.newaxis])*self.mixture[:,np.newaxis]
+        pv[np.atleast_2d(alteqnull)]=1.0
+        return pv
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     logging.info("generate chi-2 distributed values")
@@ -6,6 +6,7 @@ import scipy.linalg as la
 import pylab as pl
 from fastlmm.association.tests import Cv
 import fastlmm.util.util as ut
+from fastlmm.util.stats.pvalue_summary import PValueSummary, summarize_files
 
 def pnames():
     '''
@@ -423,7 +424,7 @@ def qqplotdir(dirin,filepattern='*.txt',savefiles=False, pnames=pnames(), rownam
     Currently only saves the qqplots to file, not the histograms.
     filepattern can use python regular expressions. For e.g. "wtcbf*P[0-2]*.txt" allows any digit from 0 to 2 after P
 
-    aggregate=True puts all the p-values in one plot
+    aggregate=True puts all the p-values in one plot. The files are streamed into a PValueSummary, so they need not fit in memory.
     '''
     import glob   
     filepatternorig=filepattern 
@@ -443,9 +444,9 @@ def qqplotdir(dirin,filepattern='*.txt',savefiles=False, pnames=pnames(), rownam
     ycoord=-ycoordshift
     ii=0 
     
-    allp=[]   
+    allp=PValueSummary()
 
-    assert f>0, "no files found"
+    assert len(myfiles)>0, "no files found"
         
     for f in myfiles:       
         ii=ii+1
@@ -457,12 +458,10 @@ def qqplotdir(dirin,filepattern='*.txt',savefiles=False, pnames=pnames(), rownam
         if (not aggregate):  
             qqplotfile(f, fileout, pnames,rownames, alphalevel,legend,xlim,ylim,str(ycoord),plotsize,dohist=dohist)        
         else:
-            pv,rowids,garb1,garb2=extractpvals(f,pnames,rownames)
-            #allp.append(pv) #this gives all seperate plots on one (makes several series)
-            allp=allp+pv.tolist() #this just makes one series
+            allp.merge(summarize_files(f,pnames=pnames))
     if aggregate:
-        title="agg over " + filepatternorig + " (" + str(len(allp)) + " p-values)"
-        qqplotp(sp.array(allp),fileout = None, pnames=pnames, rownames=rownames,alphalevel =alphalevel,legend=None,title=title,dohist=dohist)
+        title="agg over " + filepatternorig + " (" + str(allp.count) + " p-values)"
+        qqplotp(allp,fileout = None, pnames=pnames, rownames=rownames,alphalevel =alphalevel,legend=None,title=title,dohist=dohist)
    
 
 def extractpvals(filein,pnames=pnames(), rownames=rownames(),sort=False,includefilename=True,verbose=True,altname="LogLikeAlt",nullname="LogLikeNull"):
@@ -544,10 +543,16 @@ def qqplotp(pv,fileout = None, pnames=pnames(), rownames=rownames(),alphalevel =
 def pvalhist(pv,numbins=50,linewidth=3.0,linespec='--r'):    
     '''
     Plots normalized histogram, plus theoretical null-only line.
+    pv can also be a PValueSummary, whose histogram is re-binned.
     '''
     import pylab as pl   
     h2=pl.figure()  
-    [nn,bins,patches]=pl.hist(pv,numbins,normed=1)    
+    if isinstance(pv,PValueSummary):
+        edges=np.floor(np.linspace(0,pv.median_bins,numbins+1)).astype(int)
+        nn=np.add.reduceat(pv.median_hist,edges[:-1])
+        pl.bar(edges[:-1]/float(pv.median_bins),nn*float(pv.median_bins)/(np.diff(edges)*max(pv.count,1)),width=np.diff(edges)/float(pv.median_bins),align='edge')
+    else:
+        [nn,bins,patches]=pl.hist(pv,numbins,density=True)    
     pl.plot([0, 1],[1,1],linespec,linewidth=linewidth)
         
 def tmp():
@@ -622,7 +627,8 @@ def qqplot(pvals, fileout = None, alphalevel = 0.05,legend=None,xlim=None,ylim=N
     performs a P-value QQ-plot in -log10(P-value) space
     -----------------------------------------------------------------------
     Args:
-        pvals       P-values, for multiple methods this should be a list (each element will be flattened)
+        pvals       P-values, for multiple methods this should be a list (each element will be flattened).
+                    An element can also be a PValueSummary, which is plotted from its thinned QQ points.
         fileout    if specified, the plot will be saved to the file (optional)
         alphalevel  significance level for the error bars (default 0.05)
                     if None: no error bars are plotted
@@ -652,30 +658,38 @@ def qqplot(pvals, fileout = None, alphalevel = 0.05,legend=None,xlim=None,ylim=N
     if h1 is None:
         h1=pl.figure(figsize=figsize) 
     
-    pl.grid(b=grid, alpha = 0.5)
+    pl.grid(grid, alpha = 0.5)
          
     maxval = 0
 
     for i in range(len(pvallist)):        
-        pval =pvallist[i].flatten()
-        M = pval.shape[0]
-        pnull = (0.5 + sp.arange(M))/M
-        # pnull = np.sort(np.random.uniform(size = tests))
-                
-        pval[pval<minpval]=minpval
-        pval[pval>=1]=1
-
-        if distr == 'chi2':
-            qnull = st.chi2.isf(pnull, 1)
-            qemp = (st.chi2.isf(sp.sort(pval),1))
-            xl = 'LOD scores'
-            yl = '$\chi^2$ quantiles'
-
-        if distr == 'log10':
-            qnull = -sp.log10(pnull)            
-            qemp = -sp.log10(sp.sort(pval)) #sorts the object, returns nothing
+        if isinstance(pvallist[i],PValueSummary):
+            pval = pvallist[i]
+            M = pval.count
+            qnull, qemp = pval.qq_points()
+            qemp = np.minimum(qemp,-np.log10(minpval))
             xl = '-log10(P) observed'
             yl = '-log10(P) expected'
+        else:
+            pval =pvallist[i].flatten()
+            M = pval.shape[0]
+            pnull = (0.5 + sp.arange(M))/M
+            # pnull = np.sort(np.random.uniform(size = tests))
+                
+            pval[pval<minpval]=minpval
+            pval[pval>=1]=1
+
+            if distr == 'chi2':
+                qnull = st.chi2.isf(pnull, 1)
+                qemp = (st.chi2.isf(sp.sort(pval),1))
+                xl = 'LOD scores'
+                yl = '$\chi^2$ quantiles'
+
+            if distr == 'log10':
+                qnull = -sp.log10(pnull)            
+                qemp = -sp.log10(sp.sort(pval)) #sorts the object, returns nothing
+                xl = '-log10(P) observed'
+                yl = '-log10(P) expected'
         if not (sp.isreal(qemp)).all(): raise Exception("imaginary qemp found")
         if qnull.max()>maxval:
             maxval = qnull.max()                
@@ -714,11 +728,13 @@ def estimate_lambda(pv):
     '''
     estimate the lambda for a given array of P-values
     ------------------------------------------------------------------
-    pv          numpy array containing the P-values
+    pv          numpy array containing the P-values, or a PValueSummary
     ------------------------------------------------------------------
     L           lambda value
     ------------------------------------------------------------------
     '''
+    if isinstance(pv,PValueSummary):
+        return pv.estimate_lambda()
     LOD2 = sp.median(st.chi2.isf(pv, 1))
     L = (LOD2/0.456)
     return L
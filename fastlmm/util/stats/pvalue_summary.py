@@ -0,0 +1,225 @@
+from __future__ import absolute_import
+import logging
+import numpy as np
+import pandas as pd
+import scipy.stats as st
+from six.moves import range
+
+def pvalue_names():
+    '''
+    P-value column names looked for in result files. The nearer the start of the list takes precedence if multiple ones
+    are present.
+    '''
+    return ['PValue', 'P-value_adjusted', "P-value", "pValue", "p", "P-value(50/50)", "Pvalue"]
+
+class PValueSummary(object):
+    '''
+    A one-pass, fixed-size summary of a (possibly huge) set of P-values that is enough to compute the genomic control
+    lambda and to draw a QQ plot.
+    --------------------------------------------------------------------------
+    Input:
+    tail_count      : number of smallest P-values kept exactly. These are the QQ points that stand out in a plot. (default 10000)
+    log_bin_width   : bin width, in -log10(P) units, of the histogram used for the QQ points beyond the exact tail (default 0.005)
+    max_log10       : -log10(P) values above this go into the last histogram bin (default 100)
+    median_bins     : number of equal-width bins over [0,1] used to locate the median P-value. The median, and so lambda,
+                        is interpolated within one bin, i.e. to about 1/median_bins in P. (default 2**16)
+    --------------------------------------------------------------------------
+    Summaries with the same settings can be combined with merge(), so files or chunks can be summarized in parallel.
+    '''
+    def __init__(self, tail_count=10000, log_bin_width=0.005, max_log10=100.0, median_bins=2**16):
+        self.tail_count = tail_count
+        self.log_bin_width = log_bin_width
+        self.max_log10 = max_log10
+        self.median_bins = median_bins
+        self.count = 0
+        self.missing_count = 0
+        self.tail = np.empty(0)
+        self.log_hist = np.zeros(int(np.ceil(max_log10 / log_bin_width)) + 1, dtype=np.int64)
+        self.median_hist = np.zeros(median_bins, dtype=np.int64)
+
+    def add(self, pv):
+        '''
+        add an array of P-values to the summary. NaN values are counted as missing and otherwise ignored.
+        '''
+        pv = np.asarray(pv, dtype=np.float64).reshape(-1)
+        isnan = np.isnan(pv)
+        if isnan.any():
+            self.missing_count += int(isnan.sum())
+            pv = pv[~isnan]
+        if len(pv) == 0:
+            return self
+        pv = np.clip(pv, 0.0, 1.0)
+        self.count += len(pv)
+
+        with np.errstate(divide='ignore'):
+            log_index = np.minimum(-np.log10(pv) / self.log_bin_width, len(self.log_hist) - 1).astype(np.int64)
+        self.log_hist += np.bincount(log_index, minlength=len(self.log_hist))
+        median_index = np.minimum((pv * self.median_bins).astype(np.int64), self.median_bins - 1)
+        self.median_hist += np.bincount(median_index, minlength=self.median_bins)
+
+        self._merge_tail(pv)
+        return self
+
+    def merge(self, other):
+        '''
+        add the P-values summarized in other, which must use the same settings, to this summary
+        '''
+        if (other.tail_count, other.log_bin_width, other.max_log10, other.median_bins) != (self.tail_count, self.log_bin_width, self.max_log10, self.median_bins):
+            raise Exception("can only merge P-value summaries with the same settings")
+        self.count += other.count
+        self.missing_count += other.missing_count
+        self.log_hist += other.log_hist
+        self.median_hist += other.median_hist
+        self._merge_tail(other.tail)
+        return self
+
+    def _merge_tail(self, pv):
+        tail = np.concatenate([self.tail, pv])
+        if len(tail) > self.tail_count:
+            tail = np.partition(tail, self.tail_count - 1)[:self.tail_count]
+        self.tail = np.sort(tail)
+
+    def median_bracket(self):
+        '''
+        returns (lower, upper, below_count): the median P-value lies in [lower, upper] and below_count P-values are less than lower.
+        Collecting the P-values in the bracket in a second pass gives the exact median, see median(values_in_bracket).
+        '''
+        if self.count == 0:
+            raise Exception("no P-values summarized")
+        cumulative = np.cumsum(self.median_hist)
+        first_bin = np.searchsorted(cumulative, (self.count - 1) // 2, side='right')
+        last_bin = np.searchsorted(cumulative, self.count // 2, side='right')
+        below_count = int(cumulative[first_bin] - self.median_hist[first_bin])
+        return first_bin / float(self.median_bins), (last_bin + 1) / float(self.median_bins), below_count
+
+    def median(self, values_in_bracket=None):
+        '''
+        the median P-value. Without values_in_bracket it is interpolated within the histogram bins. With all the P-values
+        that fall in median_bracket() it is exact.
+        '''
+        lower, upper, below_count = self.median_bracket()
+        ranks = [(self.count - 1) // 2, self.count // 2]
+        if values_in_bracket is not None:
+            values = np.sort(np.asarray(values_in_bracket, dtype=np.float64).reshape(-1))
+            return 0.5 * (values[ranks[0] - below_count] + values[ranks[1] - below_count])
+
+        cumulative = np.cumsum(self.median_hist)
+        result = 0.0
+        for rank in ranks:
+            bin_index = np.searchsorted(cumulative, rank, side='right')
+            before = cumulative[bin_index] - self.median_hist[bin_index]
+            fraction = (rank - before + 0.5) / self.median_hist[bin_index]
+            result += 0.5 * (bin_index + fraction) / self.median_bins
+        return result
+
+    def estimate_lambda(self, values_in_bracket=None):
+        '''
+        the genomic control lambda, computed like estimate_lambda(pv) from the median P-value
+        '''
+        return st.chi2.isf(self.median(values_in_bracket), 1) / 0.456
+
+    def qq_points(self):
+        '''
+        returns (qnull, qemp), the -log10 expected and observed P-values of a thinned QQ plot sorted by decreasing significance.
+        The tail_count smallest P-values give one point each. Beyond them there is one point per histogram bin, placed at the
+        middle rank of the bin.
+        '''
+        M = self.count
+        with np.errstate(divide='ignore'):
+            tail_qemp = -np.log10(self.tail)
+        tail_rank = np.arange(len(self.tail), dtype=np.float64)
+
+        counts = self.log_hist[::-1] #most significant first
+        centers = (np.arange(len(self.log_hist))[::-1] + 0.5) * self.log_bin_width
+        cumulative = np.cumsum(counts)
+        start = np.maximum(cumulative - counts, len(self.tail))
+        keep = cumulative > start
+        bin_rank = 0.5 * (start[keep] + cumulative[keep] - 1)
+        bin_qemp = np.minimum(centers[keep], tail_qemp[-1] if len(self.tail) > 0 else np.inf)
+
+        rank = np.concatenate([tail_rank, bin_rank])
+        qnull = -np.log10((0.5 + rank) / M)
+        qemp = np.concatenate([tail_qemp, bin_qemp])
+        return qnull, qemp
+
+def summarize_files(filenames, pnames=None, by=None, chunk_size=1000000, sep="\t", exact_median=False, runner=None, **summary_kwargs):
+    '''
+    summarize the P-values in one or more FaST-LMM result files in one streaming pass
+    --------------------------------------------------------------------------
+    Input:
+    filenames       : string or list of strings of tab-delimited result files with a header line
+    pnames          : name of the P-value column, or a list of candidate names of which the first found in the header is used
+                        (default None, uses pvalue_names())
+    by              : name of a column, e.g. 'Pheno', to summarize separately by. (default None, one summary for all rows)
+    chunk_size      : number of rows read at a time (default 1000000)
+    sep             : column delimiter (default "\\t")
+    exact_median    : if True, make a second pass collecting the P-values near the median, so lambda is exact (default False)
+    runner          : a pysnptools Runner such as LocalMultiProc to summarize the files in parallel. (default None, in process)
+    **summary_kwargs: settings passed to PValueSummary
+    --------------------------------------------------------------------------
+    Output:
+    a PValueSummary, or if by is given, a dictionary from each value of the column to a PValueSummary.
+    With exact_median, each summary also has the attribute median_values that median() and estimate_lambda() can be given.
+    --------------------------------------------------------------------------
+    '''
+    from pysnptools.util.mapreduce1 import map_reduce
+
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    pname_list = [_find_pname(filename, pnames or pvalue_names(), sep) for filename in filenames]
+
+    def mapper(file_index):
+        summary_dict = {}
+        for key, pv in _read_pvalues(filenames[file_index], pname_list[file_index], by, chunk_size, sep):
+            if key not in summary_dict:
+                summary_dict[key] = PValueSummary(**summary_kwargs)
+            summary_dict[key].add(pv)
+        return summary_dict
+
+    def reducer(summary_dict_sequence):
+        result = {}
+        for summary_dict in summary_dict_sequence:
+            for key, summary in summary_dict.items():
+                if key in result:
+                    result[key].merge(summary)
+                else:
+                    result[key] = summary
+        return result
+
+    result = map_reduce(range(len(filenames)), mapper=mapper, reducer=reducer, name="summarize_files", runner=runner)
+    logging.info("summarized {0} P-values in {1} group(s)".format(sum(summary.count for summary in result.values()), len(result)))
+
+    if exact_median:
+        bracket_dict = dict((key, summary.median_bracket()) for key, summary in result.items())
+        value_dict = dict((key, []) for key in result)
+        for file_index, filename in enumerate(filenames):
+            for key, pv in _read_pvalues(filename, pname_list[file_index], by, chunk_size, sep):
+                lower, upper = bracket_dict[key][:2]
+                value_dict[key].append(pv[(pv >= lower) & (pv <= upper)])
+        for key, summary in result.items():
+            summary.median_values = np.concatenate(value_dict[key])
+
+    if by is None:
+        return result.get(None) or PValueSummary(**summary_kwargs)
+    return result
+
+def _find_pname(filename, pnames, sep):
+    if isinstance(pnames, str):
+        pnames = [pnames]
+    header = pd.read_csv(filename, sep=sep, nrows=0).columns
+    for name in pnames:
+        if name in header:
+            return name
+    raise Exception("none of the P-value columns {0} found in the header of '{1}': {2}".format(pnames, filename, list(header)))
+
+def _read_pvalues(filename, pname, by, chunk_size, sep):
+    '''
+    yield (group, pvalues) pairs from each chunk of rows, reading only the needed columns
+    '''
+    usecols = [pname] if by is None else [pname, by]
+    for chunk in pd.read_csv(filename, sep=sep, usecols=usecols, dtype={pname: np.float64}, chunksize=chunk_size):
+        if by is None:
+            yield None, np.clip(chunk[pname].values, 0.0, 1.0)
+        else:
+            for key, group in chunk.groupby(by, sort=False):
+                yield key, np.clip(group[pname].values, 0.0, 1.0)
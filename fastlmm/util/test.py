@@ -43,6 +43,284 @@ class TestDocStrings(unittest.TestCase):
         os.chdir(old_dir)
         assert result.failed == 0, "failed doc test: " + __file__
 
+class TestPValueSummary(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pysnptools.util import create_directory_if_necessary
+        create_directory_if_necessary(self.tempout_dir, isfile=False)
+
+    tempout_dir = "tempout/pvalue_summary"
+
+    def file_name(self,testcase_name):
+        temp_fn = os.path.join(self.tempout_dir,testcase_name)
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        return temp_fn
+
+    def test_matches_full_pvalues(self):
+        import pandas as pd
+        import scipy.stats as st
+        from fastlmm.util.stats.pvalue_summary import PValueSummary, summarize_files
+
+        randomstate = np.random.RandomState(1)
+        pv = st.chi2.sf(randomstate.chisquare(1, size=100001) * 1.1, 1)
+        pv[::97] = np.nan
+        observed = pv[~np.isnan(pv)]
+        lambda_gc = np.median(st.chi2.isf(observed, 1)) / 0.456
+
+        summary = PValueSummary(tail_count=500, median_bins=2**12)
+        for chunk in np.array_split(pv, 9):
+            summary.add(chunk)
+        assert summary.count == len(observed) and summary.missing_count == len(pv) - len(observed)
+        assert abs(summary.estimate_lambda() - lambda_gc) < 1e-3
+
+        qnull, qemp = summary.qq_points()
+        M = len(observed)
+        qnull_full = -np.log10((0.5 + np.arange(M)) / M)
+        qemp_full = -np.log10(np.sort(observed))
+        np.testing.assert_array_almost_equal(qemp[:500], qemp_full[:500])
+        assert np.abs(np.interp(qnull[::-1], qnull_full[::-1], qemp_full[::-1]) - qemp[::-1]).max() < 0.01
+
+        filename = self.file_name("results.txt")
+        pd.DataFrame({'SNP': np.arange(len(pv)), 'Pheno': np.arange(len(pv)) % 2, 'PValue': pv}).to_csv(filename, sep="\t", index=False)
+        summary_dict = summarize_files(filename, by='Pheno', chunk_size=7000, exact_median=True, tail_count=500, median_bins=2**12)
+        for pheno, summary in summary_dict.items():
+            values = pv[pheno::2]
+            values = values[~np.isnan(values)]
+            self.assertAlmostEqual(summary.estimate_lambda(summary.median_values), np.median(st.chi2.isf(values, 1)) / 0.456, places=10)
+
+class TestChi2MixtureBatch(unittest.TestCase):
+
+    def test_matches_one_fit_at_a_time(self):
+        import fastlmm.util.stats.chi2mixture as c2
+
+        randomstate = np.random.RandomState(3)
+        lrt = 2.0 * randomstate.chisquare(1.5, size=(4, 2000))
+        lrt[randomstate.rand(*lrt.shape) < 0.4] = 0.0
+        lrt[2, 1500:] = np.nan #a shorter run
+
+        for fitdof in [False, True]:
+            batch = c2.chi2mixture_batch(lrt, qmax=0.1, alteqnull=lrt==0, fitdof=fitdof, dof=1.0)
+            res = batch.fit_params_Qreg()
+            pv = batch.sf()
+            for b in range(lrt.shape[0]):
+                one_lrt = lrt[b][~np.isnan(lrt[b])]
+                one = c2.chi2mixture(lrt=one_lrt, qmax=0.1, alteqnull=one_lrt==0, fitdof=fitdof, dof=1.0)
+                one_res = one.fit_params_Qreg()
+                self.assertAlmostEqual(res['scale'][b], one_res['scale'], places=4)
+                self.assertAlmostEqual(res['dof'][b], one_res['dof'], places=4)
+                self.assertAlmostEqual(res['mse'][b], one_res['mse'], places=8)
+                np.testing.assert_array_almost_equal(pv[b][:len(one_lrt)], one.sf(), decimal=6)
+            assert np.isnan(pv[2, 1500:]).all()
+
+class TestSimulateCohort(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pysnptools.util import create_directory_if_necessary
+        create_directory_if_necessary(self.tempout_dir, isfile=False)
+
+    tempout_dir = "tempout/simulate_cohort"
+
+    def file_name(self,testcase_name):
+        temp_fn = os.path.join(self.tempout_dir,testcase_name)
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        return temp_fn
+
+    def test_simulate_cohort(self):
+        from pysnptools.snpreader import Bed, Pheno
+        from fastlmm.util.gensnp import simulate_cohort
+
+        settings = dict(iid_count=400, sid_count=900, chrom_count=3, pop_count=2, family_size=4, pheno_count=2, h2=[0.5, 0.9],
+                        causal_fraction=0.05, covar_count=2, chunk_size=200, seed=5)
+        result = simulate_cohort(self.file_name("one"), **settings)
+        result_parts = simulate_cohort(self.file_name("parts"), part_count=3, **settings)
+        for suffix in [".bed", ".bim", ".fam", ".cov"]:
+            with open(os.path.join(self.tempout_dir, "one" + suffix), 'rb') as f1, open(os.path.join(self.tempout_dir, "parts" + suffix), 'rb') as f2:
+                assert f1.read() == f2.read(), "part_count changed " + suffix
+        np.testing.assert_array_equal(result['causal_sid'], result_parts['causal_sid'])
+
+        snpdata = Bed(result['bed'], count_A1=False).read()
+        assert snpdata.val.shape == (400, 900) and set(np.unique(snpdata.val)) <= set([0.0, 1.0, 2.0])
+        assert list(np.unique(snpdata.pos[:,0])) == [1, 2, 3]
+        val = snpdata.val[:, snpdata.val.std(0) > 0]
+        standardized = (val - val.mean(0)) / val.std(0)
+        kinship = standardized.dot(standardized.T) / val.shape[1]
+        assert 0.35 < kinship[0, 2] < 0.65 and kinship[2, 3] > 0.35 #parent-child and siblings
+        neighbor_corr = [np.corrcoef(snpdata.val[:,i], snpdata.val[:,i+1])[0,1] for i in range(0, 100, 2)]
+        assert np.nanmean(neighbor_corr) > 0.2 #LD
+
+        pheno = Pheno(result['pheno']).read()
+        np.testing.assert_array_equal(pheno.iid, snpdata.iid)
+        np.testing.assert_array_almost_equal(pheno.val, Pheno(result_parts['pheno']).read().val)
+        assert pheno.val.shape == (400, 2)
+
+
+class TestThreadBudget(unittest.TestCase):
+
+    def test_threads_per_task(self):
+        from unittest.mock import patch
+        from pysnptools.util.mapreduce1.runner import Local, LocalMultiProc
+        from fastlmm.util.thread_budget import threads_per_task, _env_names
+        environ = {name: value for name, value in os.environ.items() if name not in _env_names}
+        with patch.dict(os.environ, environ, clear=True):
+            assert threads_per_task(LocalMultiProc(4), cpu_count=64) == 16
+            assert threads_per_task(LocalMultiProc(4, just_one_process=True), cpu_count=64) is None
+            assert threads_per_task(LocalMultiProc(4), num_threads=3, cpu_count=64) == 3
+            assert threads_per_task(Local(), cpu_count=64) is None and threads_per_task() is None
+            os.environ["OPENBLAS_NUM_THREADS"] = "5"
+            assert threads_per_task(LocalMultiProc(4), cpu_count=64) == 5
+
+    def test_default_leaves_user_limits(self):
+        from unittest.mock import patch
+        from threadpoolctl import threadpool_limits, threadpool_info
+        from pysnptools.util.mapreduce1 import map_reduce
+        from pysnptools.util.mapreduce1.runner import Local
+        from fastlmm.util.thread_budget import threads_per_task, limit_threads
+
+        def mapper(work):
+            return os.environ["OMP_NUM_THREADS"], max([pool["num_threads"] for pool in threadpool_info()] or [1])
+
+        with patch.dict(os.environ, {"OMP_NUM_THREADS": "4"}), threadpool_limits(limits=1):
+            result = map_reduce(range(2), mapper=limit_threads(mapper, threads_per_task(Local(), cpu_count=64)), runner=Local())
+            assert list(result) == [("4", 1)] * 2
+
+    def test_thread_limits(self):
+        from bed_reader import get_num_threads
+        from fastlmm.util.thread_budget import thread_limits, limit_threads, thread_info
+        old_environ = dict(os.environ)
+        with thread_limits(2):
+            assert get_num_threads(None) == 2
+            info = thread_info()
+            assert info["bed_reader"] == 2
+            assert isinstance(info["blas"], str) or all(pool["num_threads"] <= 2 for pool in info["blas"])
+        assert dict(os.environ) == old_environ
+        assert limit_threads(lambda work: get_num_threads(None), 3)(0) == 3
+
+    def test_thread_limits_overlapping(self):
+        import threading
+        from bed_reader import get_num_threads
+        from pysnptools.util.mapreduce1 import map_reduce
+        from pysnptools.util.mapreduce1.runner import LocalMultiThread
+        from fastlmm.util.thread_budget import thread_limits, limit_threads
+        old_environ = dict(os.environ)
+
+        # The first task leaves while the second is still running, so a per-task save/restore would restore the
+        # first's view of the environment too soon and the second's (limited) view last.
+        first_in, second_in, first_out = threading.Event(), threading.Event(), threading.Event()
+        seen = []
+        def first():
+            with thread_limits(4):
+                first_in.set()
+                second_in.wait()
+            first_out.set()
+        def second():
+            first_in.wait()
+            with thread_limits(4):
+                second_in.set()
+                first_out.wait()
+                seen.append((os.environ["NUM_THREADS"], get_num_threads(None)))
+        thread_list = [threading.Thread(target=first), threading.Thread(target=second)]
+        for thread in thread_list:
+            thread.start()
+        for thread in thread_list:
+            thread.join()
+        assert seen == [("4", 4)]
+        assert dict(os.environ) == old_environ
+
+        result = map_reduce(range(20), mapper=limit_threads(lambda work: get_num_threads(None), 4), runner=LocalMultiThread(5))
+        assert list(result) == [4] * 20
+        assert dict(os.environ) == old_environ
+
+    def test_doctest(self):
+        import fastlmm.util.thread_budget
+        result = doctest.testmod(fastlmm.util.thread_budget)
+        assert result.failed == 0, "failed doc test: " + __file__
+
+
+
+class TestKernelStore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        from pysnptools.util import create_directory_if_necessary
+        create_directory_if_necessary(self.tempout_dir, isfile=False)
+
+    tempout_dir = "tempout/kernel_store"
+
+    def file_name(self,testcase_name):
+        temp_fn = os.path.join(self.tempout_dir,testcase_name)
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+        return temp_fn
+
+    def test_loco_kernels(self):
+        from pysnptools.snpreader import SnpData
+        from fastlmm.util.matrix.kernel_store import ChromKernelStore, build_kernel
+
+        randomstate = np.random.RandomState(2)
+        iid_count, sid_count = 60, 250
+        val = randomstate.randint(0, 3, (iid_count, sid_count)).astype(float)
+        snpdata = SnpData(iid=[["f", str(i)] for i in range(iid_count)], sid=["s{0}".format(j) for j in range(sid_count)], val=val,
+                          pos=np.c_[randomstate.randint(1, 4, sid_count), np.arange(sid_count), np.arange(sid_count)])
+        std_val = snpdata.read().standardize().val
+        np.testing.assert_array_almost_equal(build_kernel(snpdata, block_size=33).val, std_val.dot(std_val.T))
+
+        store = ChromKernelStore.write(self.file_name("kernels"), snpdata, block_size=17)
+        assert store.chrom_list == [1.0, 2.0, 3.0] and sum(store.sid_count_list) == sid_count
+        for chrom, loco in store.loco_dict().items():
+            other = std_val[:, snpdata.pos[:, 0] != chrom]
+            np.testing.assert_array_almost_equal(loco.read().val, other.dot(other.T))
+            np.testing.assert_array_almost_equal(loco[:5, 3:9].read().val, other[:5].dot(other[3:9].T))
+            row_index, col_index = [40, 2, 7, 59], [7, 0, 40, 33, 2]
+            np.testing.assert_array_almost_equal(loco[row_index, col_index].read(order="C", dtype=np.float32).val,
+                                                 other[row_index].dot(other[col_index].T), decimal=3)
+        np.testing.assert_array_almost_equal(ChromKernelStore(store.filename).kernel().val, std_val.dot(std_val.T))
+        loco = store.loco_dict([1.0, 7.0])[7.0] #no SNPs on chromosome 7, so the whole kernel
+        np.testing.assert_array_almost_equal(loco.read().val, std_val.dot(std_val.T))
+        np.testing.assert_array_almost_equal(loco[:4, 2:5].read().val, std_val[:4].dot(std_val[2:5].T))
+        assert store.matches(snpdata) and not store.matches(snpdata[:, 1:])
+
+        kernel = ChromKernelStore.kernel
+        ChromKernelStore.kernel = None #a sub-block read shouldn't build the whole kernel
+        try:
+            assert store.loco_dict()[2.0][3:6, 10:12].read().val.shape == (3, 2)
+        finally:
+            ChromKernelStore.kernel = kernel
+
+    def test_doctest(self):
+        import fastlmm.util.matrix.kernel_store
+        old_dir = os.getcwd()
+        os.chdir(os.path.dirname(os.path.realpath(__file__)))
+        result = doctest.testmod(fastlmm.util.matrix.kernel_store)
+        os.chdir(old_dir)
+        assert result.failed == 0, "failed doc test: " + __file__
+
+
+
+class TestPCATruncated(unittest.TestCase):
+
+    def test_matches_full_fit(self):
+        from fastlmm.external.pca import PCA
+
+        randomstate = np.random.RandomState(4)
+        for n_samples, n_features in [(20, 50), (50, 20)]: #n<p and n>p
+            X = randomstate.randn(n_samples, n_features).dot(randomstate.randn(n_features, n_features))
+            S, V, mean, total_variance = None, None, None, None
+            for n_components in [1, 3, 7]:
+                full = PCA(n_components=n_components)
+                full.fit(X.copy())
+                truncated = PCA(n_components=n_components)
+                S, V, mean, total_variance = truncated._fit_truncated(X.copy(), 7, S, V, mean, total_variance)
+
+                signs = np.sign((full.components_ * truncated.components_).sum(axis=1)) #singular vectors are unique only up to sign
+                np.testing.assert_array_almost_equal(full.components_, truncated.components_ * signs[:, np.newaxis])
+                np.testing.assert_array_almost_equal(full.explained_variance_, truncated.explained_variance_)
+                np.testing.assert_array_almost_equal(full.explained_variance_ratio_, truncated.explained_variance_ratio_)
+                np.testing.assert_array_almost_equal(full.mean_, truncated.mean_)
+                self.assertAlmostEqual(full.noise_variance_, truncated.noise_variance_)
 
 
 def getTestSuite():
@@ -52,6 +330,12 @@ def getTestSuite():
     
     test_suite = unittest.TestSuite([])
     test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestDocStrings))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestPValueSummary))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestChi2MixtureBatch))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestSimulateCohort))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestThreadBudget))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestKernelStore))
+    test_suite.addTests(unittest.TestLoader().loadTestsFromTestCase(TestPCATruncated))
 
     return test_suite
 
@@ -0,0 +1,159 @@
+'''
+Divides the machine's cores among the tasks of a runner and limits the BLAS/OpenMP and Rust (bed_reader) threads
+inside each task, so that, for example, LocalMultiProc(64) on a 64-core machine doesn't run 64x64 threads.
+
+The caller (which knows the runner) computes the per-task budget with :func:`threads_per_task`. Each mapper then runs
+under :func:`thread_limits`, which sets the limits at task start (whatever process the task ends up in) and restores
+them after the last overlapping task in that process finishes.
+'''
+import os
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+
+_env_names = ["NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "OMP_NUM_THREADS"]
+
+# The limits are process-wide, so tasks running at once on threads (for example, under LocalMultiThread) share one
+# setting: the first to enter saves and sets it, and the last to leave restores it.
+_limits_lock = threading.Lock()
+_limits_count = 0
+_limits_saved = None
+
+
+def _runner_taskcount(runner):
+    '''
+    the number of tasks the runner runs at once on this machine
+    '''
+    if runner is None:
+        return 1
+    from pysnptools.util.mapreduce1.runner import LocalMultiProc, LocalMultiThread
+
+    if isinstance(runner, LocalMultiProc):
+        return 1 if runner.just_one_process else runner.taskcount
+    if isinstance(runner, LocalMultiThread):
+        return runner.taskcount
+    return 1 #Local, LocalInParts and cluster runners run one task per process (or per machine)
+
+
+def threads_per_task(runner=None, num_threads=None, cpu_count=None):
+    '''
+    The number of threads each task of the runner may use, or None if the threads shouldn't be limited.
+
+    :param runner: a :class:`.Runner`. LocalMultiProc and LocalMultiThread share the machine among their tasks. Other
+        runners (and no runner) run one task at a time, so their threads are left as the user (or environment) set them.
+    :param num_threads: If given, the answer (a user override). Otherwise, for a runner that runs several tasks at once,
+        the value of the first of the environment variables NUM_THREADS, MKL_NUM_THREADS, OPENBLAS_NUM_THREADS and
+        OMP_NUM_THREADS that is set (for example, by LocalMultiProc's mkl_num_threads).
+    :param cpu_count: the number of cores to divide. Defaults to multiprocessing.cpu_count().
+    :rtype: int or None
+
+    >>> from pysnptools.util.mapreduce1.runner import Local, LocalMultiProc
+    >>> threads_per_task(LocalMultiProc(8), cpu_count=64)
+    8
+    >>> threads_per_task(LocalMultiProc(100), cpu_count=64)
+    1
+    >>> print(threads_per_task(Local(), cpu_count=64))
+    None
+    '''
+    if num_threads is not None:
+        return max(1, int(num_threads))
+    if _runner_taskcount(runner) == 1:
+        return None
+    for name in _env_names:
+        if name in os.environ:
+            return max(1, int(os.environ[name]))
+    cpu_count = cpu_count or multiprocessing.cpu_count()
+    return max(1, cpu_count // _runner_taskcount(runner))
+
+
+@contextmanager
+def thread_limits(num_threads):
+    '''
+    A context manager that limits BLAS/OpenMP (via threadpoolctl, if installed) and bed_reader's Rust code to num_threads
+    threads. If num_threads is None, it does nothing.
+
+    The limits are process-wide. When contexts overlap (on several threads, or nested), the first one's limits stay in
+    effect until the last one exits, and then the original settings are restored.
+    '''
+    if num_threads is None:
+        yield
+        return
+
+    _enter_limits(num_threads)
+    try:
+        yield
+    finally:
+        _exit_limits()
+
+
+def _enter_limits(num_threads):
+    global _limits_count, _limits_saved
+    with _limits_lock:
+        if _limits_count == 0:
+            old_environ = {name: os.environ.get(name) for name in _env_names}
+            os.environ.update({name: str(num_threads) for name in _env_names}) #bed_reader's Rust code reads NUM_THREADS on each call
+            try:
+                from threadpoolctl import threadpool_limits
+            except ImportError:
+                logging.info("threadpoolctl is not installed, so only bed_reader's threads are limited")
+                limiter = None
+            else:
+                limiter = threadpool_limits(limits=num_threads)
+            _limits_saved = (num_threads, old_environ, limiter)
+        elif _limits_saved[0] != num_threads:
+            logging.info("thread limit {0} requested while {1} is in effect, so keeping {1}".format(num_threads, _limits_saved[0]))
+        _limits_count += 1
+
+
+def _exit_limits():
+    global _limits_count, _limits_saved
+    with _limits_lock:
+        _limits_count -= 1
+        if _limits_count == 0:
+            _, old_environ, limiter = _limits_saved
+            _limits_saved = None
+            if limiter is not None:
+                limiter.restore_original_limits()
+            for name, value in old_environ.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+
+
+def limit_threads(mapper, num_threads):
+    '''
+    Wraps a map_reduce mapper so that each task runs under :func:`thread_limits`.
+    '''
+    if num_threads is None:
+        return mapper
+
+    def mapper_closure(work):
+        with thread_limits(num_threads):
+            return mapper(work)
+
+    return mapper_closure
+
+
+def thread_info():
+    '''
+    A dictionary of the effective thread settings in this process, suitable for storing with results.
+    '''
+    from bed_reader import get_num_threads
+
+    info = {"cpu_count": multiprocessing.cpu_count(), "bed_reader": get_num_threads(None)}
+    try:
+        from threadpoolctl import threadpool_info
+    except ImportError:
+        info["blas"] = "<threadpoolctl not installed>"
+    else:
+        info["blas"] = [{key: pool.get(key) for key in ["user_api", "internal_api", "num_threads"]} for pool in threadpool_info()]
+    return info
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    import doctest
+
+    doctest.testmod()
@@ -364,6 +364,14 @@ def excludeinds(pos0, pos1, mindist = 10.0,idist = 2):
     i_exclude   : [S] 1-D boolean array indicating excluson of SNPs
                   (True: exclude, False: do not exclude)
     --------------------------------------------------------------------------
+    Positions are matched per chromosome with a binary search over the sorted
+    alternative-model positions, so memory is linear in the number of SNPs.
+
+    >>> import numpy as np
+    >>> pos0 = np.array([[1,0,100],[1,0,125],[1,0,300],[2,0,120]],dtype=float)
+    >>> pos1 = np.array([[1,0,110],[2,0,500]],dtype=float)
+    >>> excludeinds(pos0, pos1, mindist=15.0, idist=2)
+    array([ True,  True, False, False])
     '''
     chromosomes1 = np.unique(pos1[:,0])
     i_exclude = np.zeros(pos0[:,0].shape[0],dtype = 'bool')
@@ -371,12 +379,29 @@ def excludeinds(pos0, pos1, mindist = 10.0,idist = 2):
         for ichr in range(chromosomes1.shape[0]):
             i_SNPs1_chr=pos1[:,0] == chromosomes1[ichr]
             i_SNPs0_chr=pos0[:,0] == chromosomes1[ichr]
-            pos1_ = pos1[i_SNPs1_chr,idist]
+            pos1_ = np.sort(pos1[i_SNPs1_chr,idist])
             pos0_ = pos0[i_SNPs0_chr,idist]
-            distmatrix = pos1_[np.newaxis,:] - pos0_[:,np.newaxis]
-            i_exclude[i_SNPs0_chr] = (np.absolute(distmatrix)<=mindist).any(1)
+            i_exclude[i_SNPs0_chr] = _within_mindist(pos0_, pos1_, mindist)
     return i_exclude
 
+def _within_mindist(pos0, pos1_sorted, mindist):
+    '''
+    For each position in pos0, is there a position in the sorted array pos1_sorted within mindist of it?
+
+    Only the nearest neighbors on either side of each insertion point can be closest, so this
+    takes O((m0+m1) log m1) time and O(m0+m1) memory instead of building the full m0 x m1 distance matrix.
+    The distance is computed exactly as abs(pos1-pos0) so the result matches the dense comparison.
+    '''
+    result = np.zeros(len(pos0),dtype='bool')
+    if len(pos0) == 0 or len(pos1_sorted) == 0:
+        return result
+    right = np.searchsorted(pos1_sorted, pos0, side='left')
+    for neighbor in (right-1, right):
+        valid = (neighbor >= 0) & (neighbor < len(pos1_sorted))
+        dist = np.absolute(pos1_sorted[neighbor[valid]] - pos0[valid])
+        result[valid] |= dist <= mindist
+    return result
+
 
 def dotDotRange(dotDotString):
     '''
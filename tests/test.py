@@ -143,6 +143,8 @@ if __name__ == '__main__':
     import fastlmm.association.tests.test_gwas
     import fastlmm.association.tests.test_heritability_spatial_correction
     import fastlmm.association.tests.test_single_snp_scale
+    import fastlmm.association.tests.test_meta_analysis
+    import fastlmm.association.tests.cpu_perf
     import fastlmm.inference.tests.test_fastlmm_predictor
     import fastlmm.inference.tests.test_linear_regression
     import fastlmm.inference.tests.test
@@ -169,6 +171,8 @@ if __name__ == '__main__':
                                     fastlmm.inference.tests.test.getTestSuite(), 
                                     fastlmm.association.tests.test_single_snp.getTestSuite(), 
                                     fastlmm.association.tests.test_single_snp_linreg.getTestSuite(), 
+                                    fastlmm.association.tests.test_meta_analysis.getTestSuite(),
+                                    fastlmm.association.tests.cpu_perf.getTestSuite(),
                                     ])
 
     